@@ -0,0 +1,382 @@
+''' Throughput benchmarks of the pipeline on synthetic data, results saved as JSON to compare runs.
+
+Minute folders are generated with stars (gaussian profiles, log-uniform fluxes), a drift from frame to frame and noise:
+.rcd files (384 byte header with the timestamp at byte 152, both gains as interleaved 12-bit packed rows) and
+.fits files (JD in the header), with Bias and Dark folders. The readers, calibration, stacking, detection, centroiding,
+photometry, text export, median lightcurve and a whole getLightcurves run are timed at several numbers of stars and frames.
+Runs with float32 and float64 frames (lightcurve_maker.imageDtype) are also timed and their lightcurves compared.
+
+    python benchmark.py [previous results .json to compare with] '''
+
+import numpy as np
+import pathlib
+import tempfile
+import shutil
+import json
+import time
+import datetime
+import platform
+import os
+import sys
+import contextlib
+from astropy.io import fits
+import lightcurve_maker as maker
+import lightcurve_store
+import relative_photometry as photo
+
+rcdSize = 2048              #rcd images are always 2048 x 2048 (getSizeRCD)
+psfSigma = 1.5              #gaussian profile of the stars [px]
+stampRadius = 6             #half size of the stamp a star is drawn in [px]
+
+
+##################
+# Synthetic data #
+##################
+
+def makeStars(num_stars, size, rng):
+    ''' random star field: x, y positions [px] and total fluxes [ADU] (arrays) '''
+
+    x = rng.uniform(50, size - 50, num_stars)
+    y = rng.uniform(50, size - 50, num_stars)
+    flux = 10**rng.uniform(3, 5, num_stars)
+
+    return x, y, flux
+
+def renderFrame(stars, dx, dy, size, rng, background = 50., readnoise = 5.):
+    ''' image of the star field shifted by (dx, dy), with photon and read noise
+    input: (x, y, flux) of the stars, drift of the frame [px], image size [px], random generator, sky level and read noise [ADU]
+    output: image (2D float64 array, background included, bias not included) '''
+
+    x, y, flux = stars[0] + dx, stars[1] + dy, stars[2]
+    offsets = np.arange(-stampRadius, stampRadius + 1)
+
+    '''gaussian stamp of every star, added all at once'''
+    xi, yi = np.rint(x).astype(int), np.rint(y).astype(int)
+    cols = xi[:, None, None] + offsets[None, None, :]
+    rows = yi[:, None, None] + offsets[None, :, None]
+    stamps = np.exp(-((cols - x[:, None, None])**2 + (rows - y[:, None, None])**2)/(2*psfSigma**2))
+    stamps *= (flux/stamps.sum(axis = (1, 2)))[:, None, None]
+
+    image = np.full((size, size), background)
+    np.add.at(image, (np.broadcast_to(rows, stamps.shape).ravel(), np.broadcast_to(cols, stamps.shape).ravel()), stamps.ravel())
+
+    return rng.poisson(image).astype(np.float64) + rng.normal(0, readnoise, image.shape)
+
+def packRCD(image):
+    ''' pack a uint16 image into 12-bit triplets, as nb_read_data unpacks them (1D uint8 array) '''
+
+    pairs = image.reshape(-1, 2).astype(np.uint16)
+    packed = np.empty((len(pairs), 3), dtype = np.uint8)
+    packed[:, 0] = pairs[:, 0] >> 4
+    packed[:, 1] = ((pairs[:, 0] & 0xF) << 4) | (pairs[:, 1] >> 8)
+    packed[:, 2] = pairs[:, 1] & 0xFF
+
+    return packed.ravel()
+
+def writeRCD(filename, low, high, timestamp):
+    ''' write an .rcd file: header with the serial number and timestamp, then the low and high gain rows interleaved
+    input: filename, low and high gain images (2048 x 2048 uint16, 12-bit values), timestamp (29 character ISO string) '''
+
+    header = bytearray(384)
+    header[63:72] = b'BENCHMARK'
+    header[152:181] = timestamp.encode('utf-8')[:29].ljust(29, b'0')
+
+    interleaved = np.empty((2*low.shape[0], low.shape[1]), dtype = np.uint16)
+    interleaved[0::2] = low
+    interleaved[1::2] = high
+
+    with open(filename, 'wb') as filehandle:
+        filehandle.write(bytes(header))
+        filehandle.write(packRCD(interleaved).tobytes())
+
+def rcdGains(image, low_bias = 100., high_bias = 200., gain_ratio = 8.):
+    ''' 12-bit low and high gain images of a frame, the low gain sees gain_ratio times less signal '''
+
+    high = np.clip(np.rint(image + high_bias), 0, 4095).astype(np.uint16)
+    low = np.clip(np.rint(image/gain_ratio + low_bias), 0, 4095).astype(np.uint16)
+
+    return low, high
+
+def makeMinute(folder, num_frames, num_stars, RCDfiles, size = 2048, seed = 0, drift = (0.05, 0.03), num_calibration = 10):
+    ''' write a minute folder of synthetic images with its Bias and Dark folders
+    input: minute folder to create (named YYYYMMDD_HH.MM.SS.mmm), number of frames and stars, .rcd or .fits files (bool),
+    size of the .fits images [px], random seed, drift per frame (dx, dy) [px], number of bias and dark frames
+    output: (x, y, flux) of the stars in the first frame '''
+
+    rng = np.random.default_rng(seed)
+    size = rcdSize if RCDfiles else size
+    folder = pathlib.Path(folder)
+    start = datetime.datetime.strptime(folder.name, '%Y%m%d_%H.%M.%S.%f')
+
+    for calibration in ['Bias', 'Dark']:
+        folder.joinpath(calibration).mkdir(parents = True, exist_ok = True)
+        for i in range(num_calibration):
+            noise = rng.normal(0, 5, (size, size)) + (0 if calibration == 'Bias' else 2)
+            if RCDfiles:
+                writeRCD(folder.joinpath(calibration, calibration + '_%06i.rcd' % i), *rcdGains(noise), start.strftime('%Y-%m-%dT%H:%M:%S.%f000'))
+            else:
+                fits.writeto(folder.joinpath(calibration, calibration + '_%04i.fits' % i), (100 + noise).astype(np.float32), overwrite = True)
+
+    stars = makeStars(num_stars, size, rng)
+    for t in range(num_frames):
+        image = renderFrame(stars, drift[0]*t, drift[1]*t, size, rng)
+        frameTime = start + datetime.timedelta(seconds = 0.025*t)
+
+        if RCDfiles:
+            writeRCD(folder.joinpath('field1_%06i.rcd' % t), *rcdGains(image), frameTime.strftime('%Y-%m-%dT%H:%M:%S.%f000'))
+        else:
+            header = fits.Header()
+            header['JD'] = 2440587.5 + frameTime.replace(tzinfo = datetime.timezone.utc).timestamp()/86400.
+            fits.writeto(folder.joinpath('field1_%06i.fits' % t), (100 + image).astype(np.float32), header, overwrite = True)
+
+    return stars
+
+def linkMinute(source, folder, num_frames, RCDfiles):
+    ''' minute folder holding the first num_frames images of source (symbolic links), with the same calibration folders '''
+
+    folder.mkdir(parents = True, exist_ok = True)
+    for calibration in ['Bias', 'Dark']:
+        folder.joinpath(calibration).symlink_to(source.joinpath(calibration).resolve(), target_is_directory = True)
+    for filename in maker.getImageFiles(source, RCDfiles)[:num_frames]:
+        folder.joinpath(filename.name).symlink_to(filename.resolve())
+
+    return folder
+
+
+##########
+# Timing #
+##########
+
+@contextlib.contextmanager
+def quiet():
+    ''' silence the printouts and progress bars of the pipeline while timing it '''
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+def timeCall(function, repeat = 5, warmup = 1):
+    ''' wall time of function() over repeated calls, after warmup calls (numba compilation, file cache)
+    output: list of times [s] '''
+
+    with quiet():
+        for i in range(warmup):
+            function()
+
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+    return times
+
+def record(results, name, times, items = 1, unit = 'call', **parameters):
+    ''' add a benchmark result: minimum and median time, items processed per second at the median time '''
+
+    result = dict(name = name, **parameters, repeat = len(times), min = min(times), median = float(np.median(times)),
+                  unit = unit, rate = items/float(np.median(times)))
+    results.append(result)
+    print('%-22s %-40s median %9.4f s  %10.1f %s/s' % (name, ' '.join('%s=%s' % item for item in parameters.items()), result['median'], result['rate'], unit))
+
+def benchmarkReaders(results, folder, RCDfiles, calibration, repeat):
+    ''' file readers and frame import of a minute '''
+
+    filenames = maker.getImageFiles(folder, RCDfiles)
+    bias, dark, flat = calibration
+    num = len(filenames)
+    fmt = 'rcd' if RCDfiles else 'fits'
+
+    if RCDfiles:
+        payload = maker.readRCD(filenames[0])[0]
+        record(results, 'nb_read_data', timeCall(lambda: maker.nb_read_data(payload), repeat), 1, 'frame', format = fmt)
+        record(results, 'readRCD', timeCall(lambda: maker.readRCD(filenames[0]), repeat), 1, 'frame', format = fmt)
+        record(results, 'importFramesRCD', timeCall(lambda: maker.importFramesRCD(folder, filenames, 0, num, bias, 'high'), repeat),
+               num, 'frame', format = fmt, frames = num)
+    else:
+        record(results, 'importFramesFITS', timeCall(lambda: maker.importFramesFITS(folder, filenames, 0, num, bias, dark, flat), repeat),
+               num, 'frame', format = fmt, frames = num)
+
+def benchmarkFrame(results, folder, savefolder, RCDfiles, calibration, stars, repeat):
+    ''' stacking, detection, centroiding and photometry on the frames of a minute '''
+
+    filenames = maker.getImageFiles(folder, RCDfiles)
+    bias, dark, flat = calibration
+    fmt = 'rcd' if RCDfiles else 'fits'
+    parameters = dict(format = fmt, stars = len(stars[0]))
+
+    num = min(10, len(filenames) - 2)
+    record(results, 'stackImages', timeCall(lambda: maker.stackImages(folder, savefolder, 2, num, bias, dark, flat, 'high', RCDfiles), repeat),
+           num, 'frame', frames = num, **parameters)
+
+    with quiet():
+        stacked = maker.stackImages(folder, savefolder, 2, num, bias, dark, flat, 'high', RCDfiles)
+    record(results, 'initialFindFITS', timeCall(lambda: tuple(maker.initialFindFITS(stacked, 3)), repeat), 1, 'frame', **parameters)
+
+    if RCDfiles:
+        frame = maker.importFramesRCD(folder, filenames, 0, 1, bias, 'high')
+    else:
+        frame = maker.importFramesFITS(folder, filenames, 0, 1, bias, dark, flat)
+
+    positions = np.column_stack(stars[:2])
+    size = frame[0].shape
+    record(results, 'refineCentroid', timeCall(lambda: maker.refineCentroid(frame[0], frame[1], positions, psfSigma), repeat),
+           len(positions), 'star', **parameters)
+    record(results, 'timeEvolveFITS', timeCall(lambda: maker.timeEvolveFITS(frame[0], frame[1], positions, 4, len(positions), size[1], size[0]), repeat),
+           len(positions), 'star', **parameters)
+
+def benchmarkRun(results, folder, savefolder, RCDfiles, num_stars, repeat):
+    ''' whole getLightcurves run of a minute (calibration included), then the text export and median lightcurve of its store '''
+
+    fmt = 'rcd' if RCDfiles else 'fits'
+    num = len(maker.getImageFiles(folder, RCDfiles))
+    parameters = dict(format = fmt, stars = num_stars, frames = num)
+
+    def run():
+        shutil.rmtree(savefolder, ignore_errors = True)
+        savefolder.mkdir(parents = True)
+        maker.getLightcurves(folder, savefolder, 4, 'high', 'Red', 3, RCDfiles, checkpoint_every = None)
+
+    record(results, 'getLightcurves', timeCall(run, repeat, warmup = 0), num, 'frame', **parameters)
+
+    store = maker.storePath(savefolder, 'high', 3, folder.name)
+    found = len(lightcurve_store.getStars(store))
+    textfolder = savefolder.joinpath('text')
+    record(results, 'exportText', timeCall(lambda: lightcurve_store.exportText(store, textfolder), repeat), found, 'star',
+           found = found, **parameters)
+    record(results, 'get_medianLightcurve', timeCall(lambda: photo.get_medianLightcurve(store, list(range(found))), repeat), found, 'star',
+           found = found, **parameters)
+
+def benchmarkPrecision(results, folder, savefolder, RCDfiles, num_stars, repeat):
+    ''' float32 frames (lightcurve_maker.imageDtype) against float64: read and calibration time, whole run time, and the
+    differences of the fluxes, flux errors and positions of the stores of the two runs (dual gain for .rcd files)
+    output: precision summary (dict): largest absolute and relative differences of each column, fraction of values that differ '''
+
+    fmt = 'rcd' if RCDfiles else 'fits'
+    gain = 'dual' if RCDfiles else 'high'
+    filenames = maker.getImageFiles(folder, RCDfiles)
+    num = len(filenames)
+    parameters = dict(format = fmt, stars = num_stars, frames = num)
+
+    stores = {}
+    default = maker.imageDtype
+    try:
+        for dtype in [np.float64, np.float32]:
+            maker.imageDtype = dtype
+            name = np.dtype(dtype).name
+            with quiet():
+                bias, dark, flat = maker.getCalibration(folder, gain, RCDfiles)
+
+            if RCDfiles:
+                read = lambda: maker.importFramesRCD(folder, filenames, 0, num, bias, gain)
+            else:
+                read = lambda: maker.importFramesFITS(folder, filenames, 0, num, bias, dark, flat)
+            record(results, 'read+calibrate', timeCall(read, repeat), num, 'frame', dtype = name, gain = gain, **parameters)
+
+            runfolder = savefolder.joinpath(name)
+            def run():
+                shutil.rmtree(runfolder, ignore_errors = True)
+                runfolder.mkdir(parents = True)
+                maker.getLightcurves(folder, runfolder, 4, gain, 'Red', 3, RCDfiles, checkpoint_every = None)
+            record(results, 'getLightcurves', timeCall(run, repeat, warmup = 0), num, 'frame', dtype = name, gain = gain, **parameters)
+
+            stores[name] = runfolder
+    finally:
+        maker.imageDtype = default
+
+    '''float32 stores against float64 stores'''
+    summary = dict(gain = gain, **parameters, columns = {})
+    for setname in (['high', 'low', 'hdr'] if RCDfiles else [gain]):
+        single, double = [maker.storePath(stores[name], setname, 3, folder.name) for name in ['float32', 'float64']]
+        assert np.array_equal(lightcurve_store.getStars(single)['star'], lightcurve_store.getStars(double)['star']), 'different stars found'
+
+        for column in lightcurve_store.columns:
+            a, b = lightcurve_store.getColumn(single, column), lightcurve_store.getColumn(double, column)
+            difference = np.abs(a - b)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                relative = np.where(b != 0, difference/np.abs(b), 0.)
+            key = setname + ' ' + column
+            summary['columns'][key] = {'max_abs': float(np.nanmax(difference)), 'max_rel': float(np.nanmax(relative)),
+                                       'differ': float(np.mean(~((a == b) | (np.isnan(a) & np.isnan(b)))))}
+            print('%-12s float32 - float64: max |diff| %.3g, max relative %.3g, %.2f%% of values differ'
+                  % (key, summary['columns'][key]['max_abs'], summary['columns'][key]['max_rel'], 100*summary['columns'][key]['differ']))
+
+    return summary
+
+def runBenchmarks(workfolder, star_counts = (100, 1000), frame_counts = (20, 50), formats = ('rcd', 'fits'), repeat = 3, fits_size = 2048):
+    ''' generate the synthetic minutes and time the pipeline on them
+    input: folder for the synthetic data (pathlib.Path object), numbers of stars and of frames, file formats ('rcd', 'fits'),
+    timed calls per benchmark, size of the .fits images [px]
+    output: results (dict, see saveResults) '''
+
+    results = []
+    precision = []
+    for fmt in formats:
+        RCDfiles = (fmt == 'rcd')
+
+        for num_stars in star_counts:
+            print(datetime.datetime.now(), 'generating', fmt, 'minute with', num_stars, 'stars and', max(frame_counts), 'frames')
+            source = workfolder.joinpath('%s_%i' % (fmt, num_stars), '20220731_04.44.41.609')
+            stars = makeMinute(source, max(frame_counts), num_stars, RCDfiles, size = fits_size)
+
+            with quiet():
+                calibration = maker.getCalibration(source, 'high', RCDfiles)
+            savefolder = workfolder.joinpath('%s_%i_results' % (fmt, num_stars))
+            savefolder.mkdir()
+
+            if num_stars == star_counts[0]:
+                benchmarkReaders(results, source, RCDfiles, calibration, repeat)
+            benchmarkFrame(results, source, savefolder, RCDfiles, calibration, stars, repeat)
+
+            for num_frames in frame_counts:
+                folder = linkMinute(source, workfolder.joinpath('%s_%i_%i' % (fmt, num_stars, num_frames), source.name), num_frames, RCDfiles)
+                benchmarkRun(results, folder, workfolder.joinpath('%s_%i_%i_results' % (fmt, num_stars, num_frames)), RCDfiles, num_stars, repeat)
+
+            if num_stars == star_counts[-1]:
+                precision.append(benchmarkPrecision(results, source, workfolder.joinpath('%s_%i_precision' % (fmt, num_stars)), RCDfiles,
+                                                    num_stars, repeat))
+
+    return {'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'parameters': {'star_counts': list(star_counts), 'frame_counts': list(frame_counts), 'formats': list(formats),
+                           'repeat': repeat, 'fits_size': fits_size},
+            'results': results, 'precision': precision}
+
+def saveResults(results, savefile):
+    ''' write benchmark results as JSON '''
+
+    with open(savefile, 'w') as filehandle:
+        json.dump(results, filehandle, indent = 1)
+
+def compareResults(old, new):
+    ''' print the change of median time of each benchmark between two result files (or dicts), < 1 is faster
+    output: {benchmark key: new median/old median} '''
+
+    runs = []
+    for results in [old, new]:
+        if not isinstance(results, dict):
+            with open(results, 'r') as filehandle:
+                results = json.load(filehandle)
+        runs.append({tuple((k, v) for k, v in sorted(r.items()) if k not in ['repeat', 'min', 'median', 'rate', 'unit']): r for r in results['results']})
+
+    ratios = {}
+    for key in sorted(set(runs[0]) & set(runs[1])):
+        ratios[key] = runs[1][key]['median']/runs[0][key]['median']
+        print('%-70s %8.4f s -> %8.4f s  x%.2f' % (' '.join('%s=%s' % item for item in key), runs[0][key]['median'], runs[1][key]['median'], ratios[key]))
+
+    return ratios
+
+
+if __name__ == '__main__':
+    workfolder = pathlib.Path(tempfile.mkdtemp(prefix = 'lightcurve_benchmark_'))
+    savefile = pathlib.Path('benchmark_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+
+    try:
+        results = runBenchmarks(workfolder)
+    finally:
+        shutil.rmtree(workfolder, ignore_errors = True)
+
+    saveResults(results, savefile)
+    print('results saved in', savefile)
+
+    if len(sys.argv) > 1:
+        compareResults(sys.argv[1], results)
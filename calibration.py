@@ -0,0 +1,246 @@
+''' Persistent library of master calibration images (bias, dark, flat), indexed by time.
+Masters are built once from the raw calibration frames and saved as .npy files, they are
+memory-mapped when loaded so that later runs over the same night cost no calibration time '''
+
+import lightcurve_maker as maker
+import numpy as np
+import pathlib
+import datetime
+import hashlib
+import json
+import os
+import multiprocessing
+from astropy.io import fits
+from astropy.time import Time
+from concurrent.futures import ProcessPoolExecutor
+
+#number of raw frames combined into each master
+numOfFrames = {'Bias': 10, 'Dark': 10, 'Flat': 60}
+
+indexName = 'index.json'
+
+
+def getCalibrationSets(calib_root, kind, isRCD):
+    ''' find the sets of raw calibration frames of one kind, frames are either directly in
+    calib_root/kind or in time-stamped subfolders of it (eg. Bias/20220731_04.44.41.609)
+    input: folder holding the Bias, Dark and Flat directories (pathlib.Path object), 'Bias', 'Dark' or 'Flat', RCD or fits files (bool)
+    output: list of (set folder, list of frames to combine) '''
+
+    extension = '*.rcd' if isRCD else '*.fits'
+    kind_folder = calib_root.joinpath(kind)
+
+    if not kind_folder.is_dir():
+        return []
+
+    folders = [kind_folder] + sorted(f for f in kind_folder.iterdir() if f.is_dir())
+
+    sets = []
+    for folder in folders:
+        files = sorted(folder.glob(extension))[:numOfFrames[kind]]
+        if len(files) > 0:
+            sets.append((folder, files))
+
+    return sets
+
+def setKey(kind, gain, files, dark_key = None):
+    ''' key identifying a master, changes whenever one of the source frames is modified
+    input: 'Bias', 'Dark' or 'Flat', gain level, list of source frames, key of the dark used by a flat
+    output: hexadecimal key (str) '''
+
+    sources = []
+    for f in files:
+        stat = os.stat(f)
+        sources.append((str(pathlib.Path(f).resolve()), stat.st_size, stat.st_mtime_ns))
+
+    description = json.dumps([kind, gain, dark_key, sources])
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+def frameDateTime(filename, isRCD):
+    ''' time of a frame from its header, falls back on the file modification time
+    input: frame filename (pathlib.Path object), RCD or fits files (bool)
+    output: datetime object '''
+
+    try:
+        if isRCD:
+            with open(filename, 'rb') as fid:
+                fid.seek(152, 0)
+                headerTime = fid.read(29).decode('utf-8')
+        else:
+            headerTime = fits.getheader(filename)['JD']
+
+        return Time(maker.headerTimeJD(headerTime)[0], format = 'jd').to_datetime()
+
+    except (KeyError, ValueError, UnicodeDecodeError):
+        return datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+
+def folderDateTime(folder, files, isRCD):
+    ''' time of a set of frames, from the folder name when it is time-stamped, otherwise from the first frame
+    input: folder (pathlib.Path object), list of frames in the folder, RCD or fits files (bool)
+    output: datetime object '''
+
+    try:
+        return maker.getDateTime(folder)
+    except (IndexError, ValueError):
+        return frameDateTime(files[0], isRCD)
+
+def loadIndex(library_folder):
+    ''' read the index of the library, {key: {kind, gain, time, folder, file}} '''
+
+    indexfile = library_folder.joinpath(indexName)
+    if not indexfile.exists():
+        return {}
+
+    with open(indexfile, 'r') as filehandle:
+        return json.load(filehandle)
+
+def saveIndex(library_folder, index):
+    ''' write the index of the library, replaced in one step so readers never see a partial index '''
+
+    indexfile = library_folder.joinpath(indexName)
+    tmpfile = library_folder.joinpath(indexName + '.tmp')
+
+    with open(tmpfile, 'w') as filehandle:
+        json.dump(index, filehandle, indent = 1)
+    os.replace(tmpfile, indexfile)
+
+def buildMaster(kind, files, gain, isRCD, savefile, darkfile = None):
+    ''' combine raw calibration frames into a master and save it, runs in a worker process
+    input: 'Bias', 'Dark' or 'Flat', list of frames, gain level, RCD or fits files (bool),
+    .npy file to save master in, master dark .npy file (flats only)
+    output: savefile '''
+
+    if kind == 'Bias':
+        master = maker.combineBiases(files, gain, isRCD)
+    elif kind == 'Dark':
+        master = maker.combineDarks(files, gain, isRCD)
+    else:
+        master = maker.combineFlats(files, np.load(darkfile), gain, isRCD)
+
+    tmpfile = savefile.with_suffix('.tmp.npy')
+    np.save(tmpfile, master)
+    os.replace(tmpfile, savefile)
+
+    return savefile
+
+def nearestEntry(index, kind, gain, when):
+    ''' find the master of a kind and gain closest in time
+    input: library index (dict), 'Bias', 'Dark' or 'Flat', gain level, datetime object
+    output: (key, entry) or None if the library has no such master '''
+
+    entries = [(key, entry) for key, entry in index.items() if entry['kind'] == kind and entry['gain'] == gain]
+    if len(entries) == 0:
+        return None
+
+    diffs = [abs(datetime.datetime.fromisoformat(entry['time']) - when) for key, entry in entries]
+    return entries[int(np.argmin(diffs))]
+
+def buildLibrary(calib_root, library_folder, gain, isRCD, workers = None):
+    ''' build the masters of every calibration set that isn't already in the library, in parallel.
+    Sets whose frames are unchanged since the last run are skipped
+    input: folder holding the Bias, Dark and Flat directories (pathlib.Path object), folder of the library (pathlib.Path object),
+    gain level ('low', 'high' or 'dual'), RCD or fits files (bool), number of worker processes (int, defaults to the number of cores)
+    output: library index (dict) '''
+
+    if not library_folder.exists():
+        library_folder.mkdir(parents = True)
+
+    index = loadIndex(library_folder)
+
+    def addMasters(executor, kind, sets, darkIndex = None):
+        ''' submit the sets missing from the library, returns the futures and their index entries '''
+        jobs = []
+        for folder, files in sets:
+            when = folderDateTime(folder, files, isRCD)
+
+            darkfile, dark_key = None, None
+            if kind == 'Flat':
+                nearest = nearestEntry(darkIndex, 'Dark', gain, when)
+                if nearest is None:
+                    print('no dark for flats in', folder)
+                    continue
+                dark_key = nearest[0]
+                darkfile = library_folder.joinpath(nearest[1]['file'])
+
+            key = setKey(kind, gain, files, dark_key)
+            if key in index and library_folder.joinpath(index[key]['file']).exists():
+                continue
+
+            entry = {'kind': kind, 'gain': gain, 'time': when.isoformat(), 'folder': str(folder.resolve()), 'file': kind + '_' + gain + '_' + key + '.npy'}
+            future = executor.submit(buildMaster, kind, files, gain, isRCD, library_folder.joinpath(entry['file']), darkfile)
+            jobs.append((key, entry, future))
+
+        return jobs
+
+    def collect(jobs):
+        ''' add the finished masters to the index, replacing older masters of the same set '''
+        for key, entry, future in jobs:
+            future.result()
+            #a master rebuilt because its file was missing keeps its key and file, it isn't stale
+            stale = [k for k, e in index.items() if e['folder'] == entry['folder'] and e['kind'] == entry['kind'] and e['gain'] == entry['gain']
+                     and k != key]
+            for k in stale:
+                staleFile = library_folder.joinpath(index.pop(k)['file'])
+                if staleFile.exists():
+                    os.remove(staleFile)
+            index[key] = entry
+            print(datetime.datetime.now(), 'built master', entry['kind'], entry['folder'])
+
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+        #flats need the master darks, so they are made after biases and darks
+        jobs = addMasters(executor, 'Bias', getCalibrationSets(calib_root, 'Bias', isRCD))
+        jobs += addMasters(executor, 'Dark', getCalibrationSets(calib_root, 'Dark', isRCD))
+        collect(jobs)
+
+        jobs = addMasters(executor, 'Flat', getCalibrationSets(calib_root, 'Flat', isRCD), index)
+        collect(jobs)
+
+    saveIndex(library_folder, index)
+
+    return index
+
+def getMaster(library_folder, kind, gain, when, index = None):
+    ''' load the master closest in time, memory-mapped (read only)
+    input: folder of the library (pathlib.Path object), 'Bias', 'Dark' or 'Flat', gain level, datetime object,
+    library index (dict, read from disk if not given)
+    output: master image (2D array, [low, high] 3D array for dual gain), None if the library has no such master '''
+
+    if index is None:
+        index = loadIndex(library_folder)
+
+    nearest = nearestEntry(index, kind, gain, when)
+    if nearest is None:
+        return None
+
+    return np.load(library_folder.joinpath(nearest[1]['file']), mmap_mode = 'r')
+
+def getMasters(library_folder, obs_folder, gain, isRCD):
+    ''' load the bias, dark and flat closest in time to a minute of observations, in the format
+    expected by the calibration argument of getLightcurves
+    input: folder of the library (pathlib.Path object), minute directory (pathlib.Path object), gain level, RCD or fits files (bool)
+    output: bias, dark and flat images '''
+
+    index = loadIndex(library_folder)
+
+    extension = '*.rcd' if isRCD else '*.fits'
+    when = folderDateTime(obs_folder, sorted(obs_folder.glob(extension)), isRCD)
+
+    bias = getMaster(library_folder, 'Bias', gain, when, index)
+    if bias is None:
+        raise ValueError('no master bias for gain ' + gain + ' in ' + str(library_folder))
+
+    dark = getMaster(library_folder, 'Dark', gain, when, index)
+    if dark is None:
+        dark = np.zeros(bias.shape)
+
+    flat = getMaster(library_folder, 'Flat', gain, when, index)
+    if flat is None:
+        flat = np.ones(bias.shape)
+
+    return bias, dark, flat
+
+
+if __name__ == '__main__':
+    night_folder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/2022-06-18')
+    library_folder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/masterCalibration')
+
+    buildLibrary(night_folder, library_folder, 'high', isRCD = False)
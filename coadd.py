@@ -1,9 +1,8 @@
 import numpy as np
 from astropy.io import fits
-from lightcurve_makerBen import importFramesFITS, importFramesRCD, getBias
+from lightcurve_maker import importFramesFITS, importFramesRCD, getBias, stackFiles
 import os
 import pathlib
-from tqdm import trange
 
 def stackImages(folder, save_path, startIndex, numImages, bias, gain, RCDfiles = True):
     """make mean combined image of numImages in a directory
@@ -15,37 +14,30 @@ def stackImages(folder, save_path, startIndex, numImages, bias, gain, RCDfiles =
     if RCDfiles == False: 
         fitsimageFileList = sorted(folder.glob('*.fits'))
         fitsimageFileList.sort(key=lambda f: int(f.name.split('_')[2].split('.')[0]))
-        fitsimages = []   #list to hold bias data
     
-        '''append data from each image to list of images'''
-    #    for i in range(startIndex, numImages):
-    #        fitsimages.append(fits.getdata(fitsimageFileList[i]))
-        
-        fitsimages, time = importFramesFITS(fitsimageFileList, startIndex, numImages, bias)
-        time = time[0]
+        '''mean of bias subtracted images, combined tile by tile'''
+        imageStacked = stackFiles(fitsimageFileList[startIndex:startIndex + numImages], gain, False, 'mean', offset = bias)
+        time = importFramesFITS(folder, fitsimageFileList, startIndex, 1, bias, None, None)[1][0]
 
-    
-        '''take median of images and subtract bias'''
-        imageStacked = np.mean(fitsimages, axis=0)
         hdu = fits.PrimaryHDU(imageStacked)
     
     else:
         #for rcd files:
         '''get list of images to combine'''
         rcdimageFileList = sorted(folder.glob('*.rcd'))         #list of .rcd images
-        imageStacked = np.zeros((2048,2048))
         if len(rcdimageFileList)<2400:
             return None
-        for i in trange(numImages-startIndex):
-                rcdimage, time = importFramesRCD(folder, rcdimageFileList, startIndex+i, 1, bias, gain)    #import images & subtract bias
-                time = time[0].split('T')[1]
-                time = time.split(':')
-                time = time[0]+'_'+time[1]+'_'+time[2]
-                
-                imageStacked += rcdimage
-                  #get average value
-        imageStacked /= numImages-startIndex
-        '''save median combined bias subtracted image as .fits'''
+
+        '''mean of bias subtracted images, combined tile by tile'''
+        imageStacked = stackFiles(rcdimageFileList[startIndex:numImages], gain, True, 'mean', offset = bias)
+
+        #time of the last image
+        time = importFramesRCD(folder, rcdimageFileList, numImages - 1, 1, bias, gain)[1][0]
+        time = time.split('T')[1]
+        time = time.split(':')
+        time = time[0]+'_'+time[1]+'_'+time[2]
+
+        '''save mean combined bias subtracted image as .fits'''
         hdu = fits.PrimaryHDU(imageStacked) 
 
     medFilepath = save_path.joinpath(gain +  str(time) +'.fits')     #save stacked image
@@ -0,0 +1,249 @@
+''' Cache of postage stamps of the tracked stars, written by getLightcurves(..., cutout_size = N).
+
+A cache is a directory holding:
+    meta.json                   run information and the stamp size
+    stamps_<first frame>.npy    frames x stars x size x size calibrated pixels around each star, in chunks of frames
+    origins_<first frame>.npy   frames x stars x 2 (x, y) position of the corner pixel of each stamp in the frame
+    positions_<first frame>.npy frames x stars x 2 (x, y) tracked position of each star in the frame
+
+The position of a star in its stamp (sub-pixel offset) is position - origin. Photometry, centroids and backgrounds
+can be measured again from the cache alone (photometry, centroids, backgrounds): all the stamps of a chunk are laid
+end to end as one tall image so sep measures a whole chunk in a single call. '''
+
+import numpy as np
+import sep
+import pathlib
+import json
+import os
+import lightcurve_store
+
+arrays = ['stamps', 'origins', 'positions']
+
+
+def extract(image, positions, size, stamps, origins):
+    ''' cut the stamps of the stars out of a frame, stamps are moved inside the frame for stars near the edge
+    input: image (2D array), star positions ((stars, 2) array), stamp size (int),
+    (stars, size, size) array and (stars, 2) int array to write the stamps and their corners into
+    output: None '''
+
+    corner = np.rint(np.nan_to_num(positions)).astype(np.int64) - size//2
+    origins[:, 0] = np.clip(corner[:, 0], 0, image.shape[1] - size)
+    origins[:, 1] = np.clip(corner[:, 1], 0, image.shape[0] - size)
+
+    pixels = np.arange(size)
+    stamps[:] = image[(origins[:, 1, None] + pixels)[:, :, None], (origins[:, 0, None] + pixels)[:, None, :]]
+
+
+class CutoutWriter:
+    ''' Writes the stamps of a run frame by frame into a cache.
+    Stamps go to preallocated buffers of chunk_frames frames that are saved when full (or on flush),
+    each chunk is named after its first frame so a resumed run can drop the frames past its checkpoint. '''
+
+    def __init__(self, cache, size, num_stars, meta, start = 0, chunk_bytes = 2**28, dtype = np.float32):
+        ''' input: cache directory (pathlib.Path object), stamp size (int), number of stars, run information (dict),
+        first frame written (frames from start on are removed from an existing cache, 0 starts a new one),
+        size of the stamp buffer (bytes), dtype of the stamps '''
+
+        self.cache = cache
+        self.size = size
+        self.start = start
+
+        frameBytes = num_stars*size*size*np.dtype(dtype).itemsize
+        self.chunk_frames = int(max(1, chunk_bytes//max(frameBytes, 1)))
+        self.stamps = np.empty((self.chunk_frames, num_stars, size, size), dtype = dtype)
+        self.origins = np.empty((self.chunk_frames, num_stars, 2), dtype = np.int32)
+        self.positions = np.empty((self.chunk_frames, num_stars, 2), dtype = np.float64)
+        self.count = 0
+
+        cache.mkdir(parents = True, exist_ok = True)
+        truncate(cache, start)
+
+        with open(cache.joinpath('meta.json'), 'w') as filehandle:
+            json.dump(dict(meta, size = size), filehandle, indent = 1)
+
+    def add(self, image, positions):
+        ''' cut and buffer the stamps of the next frame
+        input: image (2D array), star positions ((stars, 2) array) '''
+
+        extract(image, positions, self.size, self.stamps[self.count], self.origins[self.count])
+        self.positions[self.count] = positions[:, :2]
+        self.count += 1
+
+        if self.count == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        ''' save the buffered frames as a chunk '''
+
+        if self.count == 0:
+            return
+
+        name = '_%06i.npy' % self.start
+        for array in arrays:
+            lightcurve_store.saveArray(self.cache.joinpath(array + name), getattr(self, array)[:self.count])
+
+        self.start += self.count
+        self.count = 0
+
+
+def chunkStarts(cache):
+    ''' first frame of each chunk of a cache (sorted list), the .tmp.npy files of a save cut short by a crash aren't chunks '''
+
+    names = [chunk.stem.split('_', 1)[1] for chunk in pathlib.Path(cache).glob('stamps_*.npy')]
+    return sorted(int(name) for name in names if name.isdigit())
+
+def truncate(cache, start):
+    ''' remove the frames from start on, the chunk holding frame start is cut short,
+    and the partial files of a run stopped while saving a chunk '''
+
+    for tmpfile in cache.glob('*.tmp.npy'):
+        os.remove(tmpfile)
+
+    for first in chunkStarts(cache):
+        name = '_%06i.npy' % first
+        if first >= start:
+            for array in arrays:
+                if cache.joinpath(array + name).exists():
+                    os.remove(cache.joinpath(array + name))
+        else:
+            for array in arrays:
+                part = np.load(cache.joinpath(array + name), mmap_mode = 'r')
+                if len(part) > start - first:
+                    lightcurve_store.saveArray(cache.joinpath(array + name), np.array(part[:start - first]))
+
+###############
+# Readers API #
+###############
+
+def getMeta(cache):
+    ''' run information of a cache (dict) '''
+
+    with open(pathlib.Path(cache).joinpath('meta.json'), 'r') as filehandle:
+        return json.load(filehandle)
+
+def getChunks(cache, stars = None):
+    ''' iterator over the chunks of a cache
+    input: cache directory, star numbers (list of int, all stars if None)
+    output: (stamps, origins, positions) of each chunk, memory-mapped when all the stars are read '''
+
+    cache = pathlib.Path(cache)
+    for first in chunkStarts(cache):
+        parts = [np.load(cache.joinpath(array + '_%06i.npy' % first), mmap_mode = 'r') for array in arrays]
+        yield tuple(part if stars is None else part[:, stars] for part in parts)
+
+def getArray(cache, array, stars = None):
+    ''' one array of a cache for all the frames: 'stamps', 'origins' or 'positions' (frames x stars x ...) '''
+    return np.concatenate([chunk[arrays.index(array)] for chunk in getChunks(cache, stars)])
+
+def mosaic(stamps, positions, origins):
+    ''' lay the stamps of a chunk end to end as one image
+    input: frames x stars x size x size stamps, frames x stars x 2 positions and origins
+    output: (frames*stars*size, size) image, x and y positions of the stars on it (1D arrays) '''
+
+    frames, stars, size = stamps.shape[:3]
+    image = np.array(stamps, order = 'C').reshape(frames*stars*size, size)         #sep needs a writeable copy of memory-mapped chunks
+
+    offsets = (positions - origins).reshape(-1, 2)
+    return image, offsets[:, 0], offsets[:, 1] + size*np.arange(frames*stars)
+
+def checkRadius(radius, size):
+    ''' radii reaching past the stamp would measure the neighbouring stamps '''
+
+    if radius > size/2. - 1:
+        raise ValueError('radius %.1f too large for %i pixel stamps, use at most %.1f' % (radius, size, size/2. - 1))
+
+def photometry(cache, r, bkgann = None, stars = None):
+    ''' aperture photometry from the stamps, as done by getLightcurves on the full frames
+    input: cache directory, aperture radius [px], (inner, outer) background annulus radii [px] or None,
+    star numbers (list of int, all stars if None)
+    output: frames x stars fluxes, frames x stars flux errors '''
+
+    size = getMeta(cache)['size']
+    checkRadius(bkgann[1] if bkgann is not None else r, size)
+
+    fluxes, sigmas = [], []
+    for stamps, origins, positions in getChunks(cache, stars):
+        image, x, y = mosaic(stamps, positions, origins)
+        flux, sigma = sep.sum_circle(image, x, y, r, bkgann = bkgann)[0:2]
+        fluxes.append(flux.reshape(stamps.shape[:2]))
+        sigmas.append(sigma.reshape(stamps.shape[:2]))
+
+    return np.concatenate(fluxes), np.concatenate(sigmas)
+
+def centroids(cache, sigma, stars = None):
+    ''' re-centre the stars on the stamps with sep.winpos, starting from the tracked positions
+    input: cache directory, winpos gaussian sigma [px], star numbers (list of int, all stars if None)
+    output: frames x stars x 2 positions in the frames, frames x stars winpos flags '''
+
+    size = getMeta(cache)['size']
+    checkRadius(4*sigma, size)          #winpos window
+
+    found, flags = [], []
+    for stamps, origins, positions in getChunks(cache, stars):
+        image, x, y = mosaic(stamps, positions, origins)
+        xc, yc, flag = sep.winpos(image, x, y, sigma, subpix = 5)
+
+        frames, count = stamps.shape[:2]
+        local = np.column_stack([xc, yc - size*np.arange(frames*count)]).reshape(frames, count, 2)
+        found.append(local + origins)
+        flags.append(flag.reshape(frames, count))
+
+    return np.concatenate(found), np.concatenate(flags)
+
+def backgrounds(cache, rin, rout, stars = None):
+    ''' median background level per pixel in an annulus around each star, less sensitive to neighbours than the annulus mean of sep
+    input: cache directory, inner and outer annulus radii [px], star numbers (list of int, all stars if None)
+    output: frames x stars background levels '''
+
+    size = getMeta(cache)['size']
+    checkRadius(rout, size)
+    yy, xx = np.mgrid[0:size, 0:size]
+
+    levels = []
+    for stamps, origins, positions in getChunks(cache, stars):
+        offsets = positions - origins
+        distance = np.hypot(xx - offsets[..., 0, None, None], yy - offsets[..., 1, None, None])
+        annulus = (distance >= rin) & (distance <= rout)
+        levels.append(np.nanmedian(np.where(annulus, stamps, np.nan), axis = (-2, -1)))
+
+    return np.concatenate(levels)
+
+
+def checkResume(folder, size = 8, num_stars = 5, num_frames = 12, chunk_frames = 4):
+    ''' check that a cache survives a run stopped while saving a chunk: a partial .tmp.npy file is left in the cache,
+    readers skip it and the resumed writer removes it and rewrites the frames past the checkpoint
+    input: empty directory to write the cache in (pathlib.Path object), stamp size, number of stars and frames, frames per chunk
+    output: None, raises AssertionError on failure '''
+
+    cache = pathlib.Path(folder).joinpath('cache')
+    rng = np.random.default_rng(0)
+    images = rng.normal(100., 10., (num_frames, 64, 64)).astype(np.float32)
+    positions = rng.uniform(size, 64 - size, (num_stars, 2))
+    chunk_bytes = chunk_frames*num_stars*size*size*4
+
+    writer = CutoutWriter(cache, size, num_stars, {}, chunk_bytes = chunk_bytes)
+    for image in images:
+        writer.add(image, positions)
+    writer.flush()
+    expected = getArray(cache, 'stamps')
+
+    '''run stopped while saving the chunk starting at frame 8, checkpointed at frame 6'''
+    np.save(cache.joinpath('stamps_%06i.tmp.npy' % 8), expected[:1])
+    assert chunkStarts(cache) == [0, 4, 8]
+    assert np.array_equal(getArray(cache, 'stamps'), expected)
+
+    writer = CutoutWriter(cache, size, num_stars, {}, start = 6, chunk_bytes = chunk_bytes)
+    assert not list(cache.glob('*.tmp.npy'))
+    for image in images[6:]:
+        writer.add(image, positions)
+    writer.flush()
+
+    assert np.array_equal(getArray(cache, 'stamps'), expected)
+    assert np.array_equal(getArray(cache, 'origins')[:, :, 0] + size//2, np.broadcast_to(np.rint(positions[:, 0]), (num_frames, num_stars)))
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        checkResume(folder)
+    print('cutout cache resume check passed')
@@ -0,0 +1,112 @@
+''' Tiled star detection for initialFindFITS.
+
+The background-subtracted image is cut into square tiles extended by an overlap on each side, sep.extract runs on each
+tile (in worker processes when asked, sep holds the GIL) and the objects are moved back to image coordinates.
+Each tile keeps the objects found up to half the overlap past its own square, so objects near the borders of the squares
+are found twice: the copies closer than merge_radius are merged with a spatial hash, keeping the one found furthest
+from the edge of its tile (the one least likely to be cut by the tile). Objects smaller than half the overlap are
+measured on the same pixels as with a single sep.extract over the image. '''
+
+import numpy as np
+import sep
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#position fields of the sep.extract records moved back to image coordinates
+xFields = ['x', 'xmin', 'xmax', 'xpeak', 'xcpeak']
+yFields = ['y', 'ymin', 'ymax', 'ypeak', 'ycpeak']
+
+
+def tileBounds(shape, tile, overlap):
+    ''' tiles covering an image
+    input: image shape (rows, columns), size of the tiles and of their overlap [px]
+    output: list of ((y0, y1, x0, x1) extended tile, (y0, y1, x0, x1) square of the tile) '''
+
+    tiles = []
+    for y in range(0, shape[0], tile):
+        for x in range(0, shape[1], tile):
+            square = (y, min(y + tile, shape[0]), x, min(x + tile, shape[1]))
+            extended = (max(y - overlap, 0), min(square[1] + overlap, shape[0]), max(x - overlap, 0), min(square[3] + overlap, shape[1]))
+            tiles.append((extended, square))
+
+    return tiles
+
+def extractTile(data, thresh, origin):
+    ''' sep.extract on one tile, positions moved to image coordinates
+    input: background-subtracted tile (2D array), detection threshold, (y0, x0) corner of the tile in the image
+    output: sep.extract records '''
+
+    objects = sep.extract(np.ascontiguousarray(data), thresh)
+    for field in xFields:
+        objects[field] += origin[1]
+    for field in yFields:
+        objects[field] += origin[0]
+
+    return objects
+
+def edgeDistance(x, y, extended, shape):
+    ''' distance of objects to the edges of their tile that are inside the image (inf for a tile covering the image) '''
+
+    y0, y1, x0, x1 = extended
+    distance = np.full(len(x), np.inf)
+    for edge, inside in [(x - x0, x0 > 0), (x1 - 1 - x, x1 < shape[1]), (y - y0, y0 > 0), (y1 - 1 - y, y1 < shape[0])]:
+        if inside:
+            distance = np.minimum(distance, edge)
+
+    return distance
+
+def mergeDuplicates(x, y, quality, radius):
+    ''' find the objects to keep among copies closer than radius, the copy of highest quality is kept
+    input: object positions (arrays), quality of each object (array, eg. distance to the edge of its tile), merge radius [px]
+    output: indices of the objects kept (array) '''
+
+    cells = {}          #spatial hash of the kept objects, cells of radius pixels
+    keep = []
+
+    for i in np.argsort(-quality, kind = 'stable'):
+        cx, cy = int(np.floor(x[i]/radius)), int(np.floor(y[i]/radius))
+
+        duplicate = False
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in cells.get((cx + dx, cy + dy), []):
+                    if (x[i] - x[j])**2 + (y[i] - y[j])**2 < radius**2:
+                        duplicate = True
+
+        if not duplicate:
+            cells.setdefault((cx, cy), []).append(i)
+            keep.append(i)
+
+    return np.sort(np.array(keep, dtype = int))
+
+def extract(data, thresh, tile = 512, overlap = 32, merge_radius = 2., workers = 1):
+    ''' sep.extract over an image in overlapping tiles
+    input: background-subtracted image (2D array), detection threshold, size of the tiles and of their overlap [px], distance under which
+    objects found in two tiles are the same [px], number of processes (int, None for the number of cores, 1 to stay in this process)
+    output: sep.extract records of the objects, sorted by y '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    tiles = tileBounds(data.shape, tile, overlap)
+    arguments = [(data[y0:y1, x0:x1], thresh, (y0, x0)) for (y0, y1, x0, x1), square in tiles]
+
+    if workers > 1 and len(tiles) > 1:
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+            found = list(executor.map(extractTile, *zip(*arguments)))
+    else:
+        found = [extractTile(*args) for args in arguments]
+
+    '''objects kept by each tile: up to half the overlap past its square'''
+    kept, quality = [], []
+    for objects, (extended, (y0, y1, x0, x1)) in zip(found, tiles):
+        margin = overlap/2.
+        inside = (objects['x'] >= x0 - margin) & (objects['x'] < x1 + margin) & (objects['y'] >= y0 - margin) & (objects['y'] < y1 + margin)
+        kept.append(objects[inside])
+        quality.append(edgeDistance(objects['x'][inside], objects['y'][inside], extended, data.shape))
+
+    objects, quality = np.concatenate(kept), np.concatenate(quality)
+    objects = objects[mergeDuplicates(objects['x'], objects['y'], quality, merge_radius)]
+
+    return objects[np.argsort(objects['y'], kind = 'stable')]
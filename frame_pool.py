@@ -0,0 +1,30 @@
+''' Preallocated frame buffers reused from frame to frame by lightcurve_maker.streamFrames '''
+
+import numpy as np
+import queue
+
+
+class FramePool:
+    ''' Ring of frame buffers allocated once for a run.
+    Each buffer is a (raw, image) pair: raw is the uint16 array .rcd files are decoded into (None for fits files),
+    image is the calibrated frame. A reader borrows a buffer with acquire, fills it in place and the buffer
+    is handed back with release once the frame has been measured, so no frame sized array is allocated per frame. '''
+
+    def __init__(self, shape, size, dtype = np.float32, raw = False):
+        ''' input: shape of a frame ((rows, columns) or (2, rows, columns) for dual gain), number of buffers,
+        dtype of the calibrated frames, also allocate the uint16 decoding arrays (bool, .rcd files) '''
+
+        self.shape = tuple(shape)
+        self.size = size
+        self.free = queue.Queue()
+
+        for i in range(size):
+            self.free.put((np.empty(self.shape, dtype = np.uint16) if raw else None, np.empty(self.shape, dtype = dtype)))
+
+    def acquire(self):
+        ''' borrow a free buffer, waits for one to be released if they are all in use '''
+        return self.free.get()
+
+    def release(self, buffer):
+        ''' hand a buffer back to the pool, its frame must not be used afterwards '''
+        self.free.put(buffer)
@@ -0,0 +1,142 @@
+''' Index of the lightcurves of a directory (or lightcurve store) used to pick reference stars.
+
+The statistics of every star (median, std, SNR, maximum flux, error code) are computed once and
+cached in a sidecar file next to the lightcurves, a KD-tree over the star positions is built from it
+so that the stars around a target are found with a radius query. The sidecar is rebuilt when the
+lightcurves are newer than it. '''
+
+import numpy as np
+import pathlib
+import os
+from scipy.spatial import cKDTree
+import lightcurve_store
+
+indexName = 'lightcurve_index.npy'
+
+indexDtype = [('star', np.int64), ('x', np.float64), ('y', np.float64), ('median', np.float64), ('std', np.float64),
+              ('SNR', np.float64), ('max', np.float64), ('error', np.int64)]
+
+errorCodes = {message: code for code, message in lightcurve_store.errorMessages.items()}
+
+#indexes already loaded in this process, {directory: (sidecar modification time, table, tree)}
+loadedIndexes = {}
+
+
+def lightcurveFiles(directory):
+    ''' .txt lightcurve files of a directory, named 'star#_minute_telescope_xpos-ypos.txt' '''
+    return [f for f in directory.iterdir() if f.name.startswith('star') and f.suffix == '.txt']
+
+def sourceTime(directory):
+    ''' latest modification time of the lightcurves indexed '''
+
+    if lightcurve_store.isStore(directory):
+        files = [f for f in directory.glob('*_*.npy') if f.name != indexName] + [directory.joinpath('stars.npy')]
+    else:
+        files = lightcurveFiles(directory)
+
+    return max([os.path.getmtime(f) for f in files] + [0])
+
+def readTextLightcurve(file):
+    ''' flux and error code of a .txt lightcurve, the filename column may hold spaces so columns are counted from the end
+    input: lightcurve file (pathlib.Path object)
+    output: flux (array), error code (int) '''
+
+    flux = []
+    error = 0
+    with open(file, 'r') as filehandle:
+        for line in filehandle:
+            if line.startswith('#'):
+                if 'Error:' in line:
+                    error = errorCodes.get(line.split('Error:')[1].strip(), 0)
+                continue
+            flux.append(float(line.rsplit(None, 4)[2]))
+
+    return np.array(flux), error
+
+def buildIndex(directory):
+    ''' compute the statistics of every lightcurve of a directory or store and save them in the sidecar file
+    input: lightcurve directory or store (pathlib.Path object)
+    output: index table (structured array with indexDtype fields, sorted by star number) '''
+
+    if lightcurve_store.isStore(directory):
+        stars = lightcurve_store.getStars(directory)
+        flux = lightcurve_store.getColumn(directory, 'flux')
+
+        table = np.zeros(len(stars), dtype = indexDtype)
+        table['star'] = stars['star']
+        table['x'] = stars['x']
+        table['y'] = stars['y']
+        table['error'] = stars['error']
+
+        #vectorized over all stars, read a block of stars at a time to bound memory
+        for start in range(0, len(stars), 1000):
+            block = np.asarray(flux[:, start:start + 1000])
+            table['median'][start:start + 1000] = np.median(block, axis = 0)
+            table['std'][start:start + 1000] = np.std(block, axis = 0)
+            table['max'][start:start + 1000] = np.max(block, axis = 0)
+
+    else:
+        files = lightcurveFiles(directory)
+        table = np.zeros(len(files), dtype = indexDtype)
+
+        for i, file in enumerate(files):
+            #coordinates from the file name, as in 'star#_minute_telescope_xpos-ypos.txt'
+            coords = file.stem.split('_')[-1].split('-')
+            flux, error = readTextLightcurve(file)
+
+            table[i]['star'] = int(file.name.split('_')[0].split('star')[1])
+            table[i]['x'] = int(coords[0])
+            table[i]['y'] = int(coords[1])
+            table[i]['median'] = np.median(flux) if len(flux) else 0
+            table[i]['std'] = np.std(flux) if len(flux) else 0
+            table[i]['max'] = np.max(flux) if len(flux) else 0
+            table[i]['error'] = error
+
+        table.sort(order = 'star')
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        table['SNR'] = table['median']/table['std']
+
+    savefile = directory.joinpath(indexName)
+    tmpfile = directory.joinpath(indexName + '.tmp.npy')
+    np.save(tmpfile, table)
+    os.replace(tmpfile, savefile)
+
+    return table
+
+def getIndex(directory):
+    ''' load (or build) the index of a lightcurve directory or store and its KD-tree of star positions,
+    the index stays loaded for the next calls on the same directory
+    input: lightcurve directory or store (pathlib.Path object or str)
+    output: index table (structured array), KD-tree of (x, y) positions (scipy cKDTree) '''
+
+    directory = pathlib.Path(directory)
+    sidecar = directory.joinpath(indexName)
+
+    if not sidecar.exists() or os.path.getmtime(sidecar) < sourceTime(directory):
+        buildIndex(directory)
+
+    mtime = os.path.getmtime(sidecar)
+    key = str(directory.resolve())
+
+    if key not in loadedIndexes or loadedIndexes[key][0] != mtime:
+        table = np.load(sidecar)
+        tree = cKDTree(np.column_stack([table['x'], table['y']]))
+        loadedIndexes[key] = (mtime, table, tree)
+
+    return loadedIndexes[key][1], loadedIndexes[key][2]
+
+def starsInRadius(directory, star, radius):
+    ''' rows of the index within radius of a star (the star included)
+    input: lightcurve directory or store, star number (int), radius (pixels)
+    output: index table of the stars around the target, index row of the target '''
+
+    table, tree = getIndex(directory)
+
+    target = table[min(np.searchsorted(table['star'], star), len(table) - 1)]
+    if target['star'] != star:
+        raise KeyError('star %i is not in %s' % (star, directory))
+
+    rows = tree.query_ball_point([target['x'], target['y']], radius)
+
+    return table[np.sort(rows)], target
@@ -17,13 +17,34 @@ import pathlib
 import datetime
 import matplotlib.pyplot as plt
 import os
-from tqdm import trange
-
-
-def stackImages(folder, save_path, startIndex, numImages, bias, dark, flat, gain, isRCD):
+import lightcurve_store
+import tracking
+import stacking
+import frame_pool
+import cutouts
+import sep_shards
+import detection
+import run_timing
+import warnings
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+#dtype of the calibrated frames, calibration masters and stacks (the data is 12-bit), np.float64 for a full precision pipeline;
+#photometry, drifts and the sums of means are kept in float64
+imageDtype = np.float32
+
+#detectStars finds the stars on a stack of detectStack images starting at image detectStart (the 1st image is vignetted)
+detectStart = 2
+detectStack = 12
+
+def stackImages(folder, save_path, startIndex, numImages, bias, dark, flat, gain, isRCD, method = 'median', filenames = None):
     """make median combined image of first numImages in a directory
     input: current directory of images (path object), directory to save stacked image in (path object), starting index (int), 
-    number of images to combine (int), bias image (2d numpy array), gain level ('low' or 'high')
+    number of images to combine (int), bias image (2d numpy array), gain level ('low' or 'high'),
+    combination ('median', 'mean' or 'sigclip', see stacking.py), 
+    images of the directory to stack from (sorted list, eg. the ones completely written, all the images of the directory if None)
     return: median combined bias subtracted image for star detection"""
     #for .fits files:
     if not isRCD:
@@ -35,27 +56,19 @@ def stackImages(folder, save_path, startIndex, numImages, bias, dark, flat, gain
                 else:
                     os.system("python .\\RCDtoFTS.py " + str(folder))
         
-        fitsimageFileList = sorted(folder.glob('*.fits'))
-        fitsimages = []   #list to hold bias data
+        fitsimageFileList = sorted(folder.glob('*.fits')) if filenames is None else filenames
         
-        '''append data from each image to list of images'''
-        for i in range(startIndex, numImages):
-             fitsimages.append(fits.getdata(fitsimageFileList[i]))
-            
-        fitsimages = importFramesFITS(folder, fitsimageFileList, startIndex, numImages, bias, dark, flat)[0]
-        
-        '''take median of images and subtract bias'''
-        imageMed = np.median(fitsimages, axis=0)
+        '''combine bias subtracted images tile by tile and subtract bias'''
+        imageMed = stackFiles(fitsimageFileList[startIndex:startIndex + numImages], gain, isRCD, method, offset = bias)
         imageMed = imageMed - bias
         
     
     else:    #for rcd files:
 
         '''get list of images to combine'''
-        rcdimageFileList = sorted(folder.glob('*.rcd'))         #list of .rcd images
-        rcdimages = importFramesRCD(folder, rcdimageFileList, startIndex, numImages, bias, gain)[0]     #import images & subtract bias
+        rcdimageFileList = sorted(folder.glob('*.rcd')) if filenames is None else filenames         #list of .rcd images
 
-        imageMed = np.median(rcdimages, axis=0)          #get median value
+        imageMed = stackFiles(rcdimageFileList[startIndex:startIndex + numImages], gain, isRCD, method, offset = bias)
         
         
     '''save median combined bias subtracted image as .fits'''
@@ -65,9 +78,11 @@ def stackImages(folder, save_path, startIndex, numImages, bias, dark, flat, gain
 
     return imageMed
 
-def initialFindFITS(data, detect_thresh):
+def initialFindFITS(data, detect_thresh, tile = None, workers = 1):
     """ Locates the stars in the initial time slice 
-    input: flux data in 2D array for a fits image, star detection threshold (float)
+    input: flux data in 2D array for a fits image, star detection threshold (float), 
+    size of the tiles the stars are extracted in [px] (None for a single sep.extract over the image, see detection.py),
+    number of processes extracting the tiles (None for the number of cores)
     returns: [x, y, half light radius] of all stars in pixels"""
 
     ''' Background extraction for initial time slice'''
@@ -79,7 +94,10 @@ def initialFindFITS(data, detect_thresh):
     print(thresh)
 
     ''' Identify stars in initial time slice '''
-    objects = sep.extract(data_new, thresh)#, deblend_nthresh = 1)
+    if tile is None:
+        objects = sep.extract(data_new, thresh)#, deblend_nthresh = 1)
+    else:
+        objects = detection.extract(data_new, thresh, tile, workers = workers)
 
 
     ''' Characterize light profile of each star '''
@@ -93,61 +111,107 @@ def initialFindFITS(data, detect_thresh):
     return positions
 
 
-def refineCentroid(data, time, coords, sigma):
+def refineCentroid(data, time, coords, sigma, sep_pool = None):
     """ Refines the centroid for each star for an image based on previous coords, used for tracking
     input: flux data in 2D array for single fits image, header time of image, 
-    coord of stars in previous image, weighting (Gauss sigma)
-    returns: new [x, y] positions, header time of image """
+    coord of stars in previous image ((N, 2) array), weighting (Gauss sigma), optional sep_shards.SepPool
+    returns: new [x, y] positions ((N, 2) array), header time of image """
 
-    '''initial x, y positions'''
-    x_initial = [pos[0] for pos in coords]
-    y_initial = [pos[1] for pos in coords]
-    
     '''use an iterative 'windowed' method from sep to get new position'''
-    new_pos = np.array(sep.winpos(data, x_initial, y_initial, sigma, subpix=5))[0:2, :]
-    x = new_pos[:][0].tolist()
-    y = new_pos[:][1].tolist()
+    x, y, flag = (sep_pool or sep).winpos(data, coords[:, 0], coords[:, 1], sigma, subpix=5)
     
-    '''returns tuple x, y (python 3: zip(x, y) -> tuple(zip(x,y))) and time'''
-    return tuple(zip(x, y)), time
+    '''returns (N, 2) array of x, y and time'''
+    return np.column_stack([x, y]), time
 
-def timeEvolveFITS(data, t, coords, r, stars, x_length, y_length):
+def timeEvolveFITS(data, t, coords, r, stars, x_length, y_length, sep_pool = None):
     """ Adjusts aperture based on star drift and calculates flux in aperture 
-    input: image data (flux in 2d array), image header times, star coords, 
+    input: image data (flux in 2d array), image header times, star coords ((N, 2) array), 
     x per frame drift rate, y per frame drift rate, aperture length to sum flux in, 
-    number of stars, x image length, y image length
-    returns: new star coords [x,y], image flux, times as tuple"""
+    number of stars, x image length, y image length, optional sep_shards.SepPool splitting the stars across processes
+    returns: star coords [x,y], image flux, flux error, times as (stars, 5) array"""
 
     '''get proper frame times to apply drift'''
-    frame_time = Time(t, precision=9, format = 'jd').unix   #current frame time from file header (unix)
+    frame_time = Time(headerTimeJD(t), precision=9, format = 'jd').unix   #current frame time from file header (unix)
     drift_time = frame_time# - coords[1,3]    #time since previous frame [s]
 
-    '''add drift to each star's coordinates based on time since last frame'''
-    x = [coords[ind][0] for ind in range(stars)]
-    y = [coords[ind][1] for ind in range(stars)]
+    '''star coordinates, already drift corrected by the tracker'''
+    x = coords[:, 0]
+    y = coords[:, 1]
     
-    '''get list of indices near edge of frame'''
-    EdgeInds = clipCutStars(x, y, x_length, y_length)
-    EdgeInds = list(set(EdgeInds))
-    EdgeInds.sort()
+    '''stars near edge of frame'''
+    onFrame = np.ones(stars, dtype = bool)
+    onFrame[clipCutStars(x, y, x_length, y_length).astype(int)] = False
     
-    '''remove stars near edge of frame'''
-    xClip = np.delete(np.array(x), EdgeInds)
-    yClip = np.delete(np.array(y), EdgeInds)
+    '''add up all flux within aperture, fluxes at edge are set to 0'''
+    sepfluxes, sepsigma = np.zeros(stars), np.zeros(stars)
+    sepfluxes[onFrame], sepsigma[onFrame] = (sep_pool or sep).sum_circle(data, x[onFrame], y[onFrame], r, bkgann = (r + 6., r + 11.))[0:2]
+
+    '''returns x, y star positions, fluxes at those positions, times as (stars, 5) array'''
+    return np.column_stack([x, y, sepfluxes, sepsigma, np.full(stars, frame_time)])
+
+
+def headerTimeJD(t):
+    """ converts header times to julian dates, fits headers hold the JD and rcd headers an ISO timestamp
+    input: header time (float or string) or list of header times
+    returns: array of julian dates"""
+
+    t = np.atleast_1d(t)
+    if t.dtype.kind in 'US':
+        return Time([str(i).strip().rstrip('Z') for i in t.ravel()], format = 'isot', scale = 'utc', precision = 9).jd.reshape(t.shape)
     
-    '''add up all flux within aperture'''
-    photometry = sep.sum_circle(data, xClip, yClip, r, bkgann = (r + 6., r + 11.))
-    sepfluxes, sepsigma = (photometry[0]).tolist(), (photometry[1]).tolist()
+    return t.astype('float64')
+
+
+def trackingPlane(image, gain):
+    """ image used for star detection and tracking, the high gain plane in dual gain mode
+    input: image data (2D array, or [low, high] 3D array), gain level ('low', 'high' or 'dual')
+    returns: 2D image"""
+
+    if gain == 'dual':
+        return image[1]
+    
+    return image
+
+
+def apertureMax(data, x, y, r):
+    """ finds the brightest pixel in the box around each aperture, used to flag saturated stars
+    input: image data (2D array), x coords of stars, y coords of stars, aperture radius
+    returns: array of maximum pixel values"""
+
+    ri = int(np.ceil(r))
+    offsets = np.arange(-ri, ri + 1)
+
+    '''keep boxes inside the frame'''
+    xi = np.clip(np.rint(x).astype(int), ri, data.shape[1] - ri - 1)
+    yi = np.clip(np.rint(y).astype(int), ri, data.shape[0] - ri - 1)
+
+    boxes = data[yi[:, None, None] + offsets[None, :, None], xi[:, None, None] + offsets[None, None, :]]
     
+    return boxes.reshape(len(xi), -1).max(axis = 1)
+
+
+def mergeGains(highFlux, lowFlux, saturated):
+    """ combines high and low gain lightcurves, frames where the high gain aperture 
+    is saturated are replaced by the low gain flux scaled to the high gain
+    input: high gain fluxes, low gain fluxes, saturation flags (2D arrays: frames x stars)
+    returns: merged fluxes (2D array), low to high gain ratio of each star (array)"""
+
+    '''gain ratio measured on unsaturated frames with good flux in both gains'''
+    good = ~saturated & (highFlux > 0) & (lowFlux > 0)
+    ratios = np.full(highFlux.shape, np.nan)
+    np.divide(highFlux, lowFlux, out = ratios, where = good)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     #all-nan columns for fully saturated stars
+        starRatio = np.nanmedian(ratios, axis = 0)
     
-    '''set fluxes at edge to 0'''
-    for i in EdgeInds:
-        sepfluxes.insert(i,0)
-        sepsigma.insert(i,0)
-        
-    '''returns x, y star positions, fluxes at those positions, times'''
-    star_data = tuple(zip(x, y, sepfluxes, sepsigma, np.full(len(sepfluxes), frame_time)))
-    return star_data
+    #stars saturated in every frame use the ratio of the whole field
+    fieldRatio = np.nanmedian(starRatio) if np.isfinite(starRatio).any() else 1.
+    starRatio = np.where(np.isfinite(starRatio), starRatio, fieldRatio)
+
+    merged = np.where(saturated, lowFlux*starRatio, highFlux)
+
+    return merged, starRatio
 
 
 def clipCutStars(x, y, x_length, y_length):
@@ -225,10 +289,10 @@ def getSizeFITS(filenames):
     return width, height, frames
 
 
-def importFramesFITS(parentdir, filenames, start_frame, num_frames, bias, dark, flat):
+def importFramesFITS(parentdir, filenames, start_frame, num_frames, bias, dark, flat, timer = None):
     """ reads in frames from fits files starting at frame_num
     input: parent directory (minute), list of filenames to read in, starting frame number, how many frames to read in, 
-    bias image (2D array of fluxes)
+    bias image (2D array of fluxes), optional run_timing.RunTimer of the run
     returns: array of image data arrays, array of header times of these images"""
 
     imagesData = []    #array to hold image data
@@ -239,12 +303,17 @@ def importFramesFITS(parentdir, filenames, start_frame, num_frames, bias, dark,
 
     '''get data from each file in list of files to read, subtract bias frame'''
     for filename in files_to_read:
-        file = fits.open(filename)
-        
-        header = file[0].header
+        with run_timing.stage(timer, 'read'):
+            file = fits.open(filename)
+            
+            header = file[0].header
+            raw = file[0].data
+        if timer is not None:
+            timer.count('bytes_read', os.path.getsize(filename))
         
         ''' Calibration frame correction '''
-        data = (file[0].data) - bias #- dark)/flat 
+        with run_timing.stage(timer, 'calibrate'):
+            data = np.subtract(raw, bias, dtype = imageDtype) #- dark)/flat 
         headerTime = header['JD']
             
         file.close()
@@ -253,15 +322,22 @@ def importFramesFITS(parentdir, filenames, start_frame, num_frames, bias, dark,
         imagesTimes.append(headerTime)
          
     '''make into array'''
-    imagesData = np.array(imagesData, dtype='float64')
+    imagesData = np.array(imagesData, dtype = imageDtype)
     
-    '''reshape, make data type into floats'''
+    '''reshape'''
     if imagesData.shape[0] == 1:
         imagesData = imagesData[0]
-        imagesData = imagesData.astype('float64')
         
     return imagesData, imagesTimes
 
+def readRowsFITS(filename, first, last):
+    """ reads rows first to last of a fits image, only these rows are read from disk
+    input: filename of fits file, first row, last row (excluded)
+    returns: rows of the image (2D array)"""
+
+    with fits.open(filename, memmap = True) as file:
+        return np.array(file[0].section[first:last])
+
 ######################################
 # RCD reading section - MJM 20210827 #
 ######################################
@@ -284,8 +360,6 @@ def nb_read_data(data_chunk):
     assert np.mod(data_chunk.shape[0],3)==0
 
     out=np.empty(data_chunk.shape[0]//3*2,dtype=np.uint16)
-    image1 = np.empty((2048,2048),dtype=np.uint16)
-    image2 = np.empty((2048,2048),dtype=np.uint16)
 
     for i in nb.prange(data_chunk.shape[0]//3):
         fst_uint8=np.uint16(data_chunk[i*3])
@@ -297,6 +371,29 @@ def nb_read_data(data_chunk):
 
     return out
 
+# Function to read the 12-bit rows of a single gain straight into an output image
+@nb.njit(nb.void(nb.types.Array(nb.uint8, 1, 'C', readonly=True), nb.int64, nb.uint16[:, ::1]),fastmath=True,parallel=True)
+def nb_read_gain(data_chunk, offset, out):
+    """data_chunk is the contiguous 1D uint8 payload of an rcd file (may be a read-only memmap),
+    offset is 0 for the low gain rows and 1 for the high gain rows (interleaved row by row),
+    out is a C-contiguous (pix_v, pix_h) uint16 array that is filled in place"""
+
+    rows = out.shape[0]
+    cols = out.shape[1]
+    rowbytes = cols//2*3                #bytes per 12-bit packed row
+
+    assert data_chunk.shape[0] >= 2*rows*rowbytes
+
+    for r in nb.prange(rows):
+        start = (2*r + offset)*rowbytes
+        for i in range(cols//2):
+            fst_uint8=np.uint16(data_chunk[start+i*3])
+            mid_uint8=np.uint16(data_chunk[start+i*3+1])
+            lst_uint8=np.uint16(data_chunk[start+i*3+2])
+
+            out[r, i*2] =   (fst_uint8 << 4) + (mid_uint8 >> 4)
+            out[r, i*2+1] = ((mid_uint8 % 16) << 8) + lst_uint8
+
 def getSizeRCD(filenames):
     """ MJM - Get the size of the images and number of frames """
     filename_first = filenames[0]
@@ -343,11 +440,128 @@ def readRCD(filename):
 
     return table, hdict
 
-def importFramesRCD(parentdir, filenames, start_frame, num_frames, bias, gain = 'high'):
+# Function to read a single gain image from an RCD file through a memory map
+def readRCDGain(filename, gain, out = None, pix_h = 2048, pix_v = 2048, timer = None):
+    """ reads one gain image of an .rcd file, only the rows of the requested gain are decoded
+    input: filename of .rcd file, gain level ('low' or 'high'), 
+    optional (pix_v, pix_h) uint16 array to decode into, image dimensions, optional run_timing.RunTimer of the run
+    returns: image (2D uint16 array), header dictionary"""
+
+    if out is None:
+        out = np.empty((pix_v, pix_h), dtype=np.uint16)
+
+    hdict = {}
+    payload = 2*pix_v*pix_h*3//2        #bytes of both interleaved 12-bit images
+
+    with run_timing.stage(timer, 'read'):
+        mm = np.memmap(filename, dtype=np.uint8, mode='r', shape=(384 + payload,))
+
+        # Serial number of camera
+        hdict['serialnum'] = bytes(mm[63:72])
+
+        # Timestamp
+        hdict['timestamp'] = bytes(mm[152:181]).decode('utf-8')
+    run_timing.count(timer, 'bytes_read', 384 + payload)
+
+    # Decode the data portion of the file for the chosen gain
+    with run_timing.stage(timer, 'decode'):
+        nb_read_gain(mm[384:], 0 if gain == 'low' else 1, out)
+    del mm
+
+    return out, hdict
+
+# Function to read both gain images from an RCD file with a single pass over the file
+def readRCDDual(filename, out = None, pix_h = 2048, pix_v = 2048, timer = None):
+    """ reads both gain images of an .rcd file from one memory map of the file
+    input: filename of .rcd file, optional (2, pix_v, pix_h) uint16 array to decode into, image dimensions, 
+    optional run_timing.RunTimer of the run
+    returns: [low gain, high gain] images (3D uint16 array), header dictionary"""
+
+    if out is None:
+        out = np.empty((2, pix_v, pix_h), dtype=np.uint16)
+
+    hdict = {}
+    payload = 2*pix_v*pix_h*3//2        #bytes of both interleaved 12-bit images
+
+    with run_timing.stage(timer, 'read'):
+        mm = np.memmap(filename, dtype=np.uint8, mode='r', shape=(384 + payload,))
+
+        hdict['serialnum'] = bytes(mm[63:72])
+        hdict['timestamp'] = bytes(mm[152:181]).decode('utf-8')
+    run_timing.count(timer, 'bytes_read', 384 + payload)
+
+    with run_timing.stage(timer, 'decode'):
+        nb_read_gain(mm[384:], 0, out[0])
+        nb_read_gain(mm[384:], 1, out[1])
+    del mm
+
+    return out, hdict
+
+# Function to read a band of rows of one or both gain images from an RCD file
+def readRowsRCD(filename, first, last, gain = 'high', pix_h = 2048, pix_v = 2048):
+    """ reads rows first to last of an .rcd image, only the bytes of these rows are decoded
+    input: filename of .rcd file, first row, last row (excluded), gain level ('low', 'high' or 'dual'), image dimensions
+    returns: rows of the image (2D uint16 array, [low, high] 3D array for gain = 'dual')"""
+
+    rowbytes = pix_h*3//2               #bytes of one 12-bit row
+    payload = 2*pix_v*rowbytes          #bytes of both interleaved 12-bit images
+
+    mm = np.memmap(filename, dtype=np.uint8, mode='r', shape=(384 + payload,))
+    band = mm[384 + 2*first*rowbytes:]       #gain rows are interleaved, row r of each gain starts at byte 2*r*rowbytes
+
+    if gain == 'dual':
+        out = np.empty((2, last - first, pix_h), dtype=np.uint16)
+        nb_read_gain(band, 0, out[0])
+        nb_read_gain(band, 1, out[1])
+    else:
+        out = np.empty((last - first, pix_h), dtype=np.uint16)
+        nb_read_gain(band, 0 if gain == 'low' else 1, out)
+    del band, mm
+
+    return out
+
+def correctHeaderTime(headerTime, parentdir):
+    """ timestamp of an .rcd file with the hour taken from the minute directory name when the camera wrote a wrong one (29 hours)
+    input: header timestamp (string), parent directory (minute)
+    returns: timestamp (string)"""
+
+    #change time if time is wrong (29 hours)
+    hour = str(headerTime).split('T')[1].split(':')[0]
+    fileMinute = str(headerTime).split(':')[1]
+    
+    #check if hour is bad, if so take hour from directory name and change header
+    if int(hour) > 23:
+        dirMinute = str(parentdir).split('_')[1].split('.')[1]
+      #  dirMinute = '30'
+        
+        #directory name has local hour, header has UTC hour, need to convert (+4)
+        #for red: local time is UTC time (don't need +4)
+        newLocalHour = int(parentdir.name.split('_')[1].split('.')[0])
+    
+        if int(fileMinute) < int(dirMinute):
+            newUTCHour = newLocalHour + 4 + 1     #add 1 if hour changed over during minute
+           # newUTCHour = newLocalHour + 1         #FOR RED
+        else:
+            newUTCHour = newLocalHour + 4
+           # newUTCHour = newLocalHour              #FOR RED
+    
+        #replace bad hour in timestamp string with correct hour
+        newUTCHour = str(newUTCHour)
+        newUTCHour = newUTCHour.zfill(2)
+    
+        replaced = str(headerTime).replace('T' + hour, 'T' + newUTCHour).strip('b').strip(' \' ')
+    
+        #encode into bytes
+        headerTime = replaced
+
+    return headerTime
+
+def importFramesRCD(parentdir, filenames, start_frame, num_frames, bias, gain = 'high', timer = None):
     """ reads in frames from .rcd files starting at frame_num
     input: parent directory (minute), list of filenames to read in, starting frame number, how many frames to read in, 
-    bias image (2D array of fluxes)
-    returns: array of image data arrays, array of header times of these images"""
+    bias image (2D array of fluxes, or [low, high] 3D array for gain = 'dual'), gain level ('low', 'high' or 'dual'),
+    optional run_timing.RunTimer of the run
+    returns: array of image data arrays (each one [low, high] for gain = 'dual'), array of header times of these images"""
     
     imagesData = []    #array to hold image data
     imagesTimes = []   #array to hold image times
@@ -363,53 +577,26 @@ def importFramesRCD(parentdir, filenames, start_frame, num_frames, bias, gain =
     for filename in files_to_read:
 
 
-        data, header = readRCD(filename)
+        if imgain == 'dual':
+            image, header = readRCDDual(filename, pix_h = hnumpix, pix_v = vnumpix, timer = timer)
+        else:
+            image, header = readRCDGain(filename, imgain, pix_h = hnumpix, pix_v = vnumpix, timer = timer)
         headerTime = header['timestamp']
 
-        images = nb_read_data(data)
-        image = split_images(images, hnumpix, vnumpix, imgain)
-        image = np.subtract(image,bias)
-
-        #change time if time is wrong (29 hours)
-        hour = str(headerTime).split('T')[1].split(':')[0]
-        fileMinute = str(headerTime).split(':')[1]
-        dirMinute = str(parentdir).split('_')[1].split('.')[1]
-      #  dirMinute = '30'
-        
-        #check if hour is bad, if so take hour from directory name and change header
-        if int(hour) > 23:
-            
-            #directory name has local hour, header has UTC hour, need to convert (+4)
-            #for red: local time is UTC time (don't need +4)
-            newLocalHour = int(parentdir.name.split('_')[1].split('.')[0])
-        
-            if int(fileMinute) < int(dirMinute):
-                newUTCHour = newLocalHour + 4 + 1     #add 1 if hour changed over during minute
-               # newUTCHour = newLocalHour + 1         #FOR RED
-            else:
-                newUTCHour = newLocalHour + 4
-               # newUTCHour = newLocalHour              #FOR RED
-        
-            #replace bad hour in timestamp string with correct hour
-            newUTCHour = str(newUTCHour)
-            newUTCHour = newUTCHour.zfill(2)
-        
-            replaced = str(headerTime).replace('T' + hour, 'T' + newUTCHour).strip('b').strip(' \' ')
-        
-            #encode into bytes
-            headerTime = replaced
+        with run_timing.stage(timer, 'calibrate'):
+            image = np.subtract(image, bias, dtype = imageDtype)
 
+        headerTime = correctHeaderTime(headerTime, parentdir)
 
         imagesData.append(image)
         imagesTimes.append(headerTime)
 
     '''make into array'''
-    imagesData = np.array(imagesData, dtype='float64')
+    imagesData = np.array(imagesData, dtype = imageDtype)
     
-    '''reshape, make data type into floats'''
+    '''reshape'''
     if imagesData.shape[0] == 1:
         imagesData = imagesData[0]
-        imagesData = imagesData.astype('float64')
         
     return imagesData, imagesTimes
 
@@ -417,100 +604,272 @@ def importFramesRCD(parentdir, filenames, start_frame, num_frames, bias, gain =
 # End RCD section #
 ###################
 
-def getBias(filepath, numOfBiases, gain, isRCD):
+def readFrame(parentdir, filename, bias, dark, flat, gain, RCDfiles, timer = None):
+    """ reads in and calibrates a single frame, used by the prefetching reader
+    input: parent directory (minute), filename of frame, bias, dark and flat images (2D arrays), 
+    gain level ('low' or 'high'), RCD or fits files (bool), optional run_timing.RunTimer of the run
+    returns: image data array, list containing the header time of the image"""
+
+    if RCDfiles:
+        return importFramesRCD(parentdir, [filename], 0, 1, bias, gain, timer)
+    else:
+        return importFramesFITS(parentdir, [filename], 0, 1, bias, dark, flat, timer)
+
+def readFrameInto(parentdir, filename, bias, gain, RCDfiles, buffer, timer = None):
+    """ reads in and calibrates a single frame into a buffer of a frame_pool.FramePool, without allocating a frame
+    input: parent directory (minute), filename of frame, bias image, gain level ('low', 'high' or 'dual'), RCD or fits files (bool),
+    (raw, image) buffer borrowed from the pool, optional run_timing.RunTimer of the run
+    returns: image data array (the image of the buffer), list containing the header time of the image"""
+
+    raw, image = buffer
+
+    if RCDfiles:
+        if gain == 'dual':
+            header = readRCDDual(filename, out = raw, pix_h = image.shape[-1], pix_v = image.shape[-2], timer = timer)[1]
+        else:
+            header = readRCDGain(filename, gain, out = raw, pix_h = image.shape[-1], pix_v = image.shape[-2], timer = timer)[1]
+        with run_timing.stage(timer, 'calibrate'):
+            np.subtract(raw, bias, out = image, dtype = image.dtype)
+        return image, [correctHeaderTime(header['timestamp'], parentdir)]
+
+    with run_timing.stage(timer, 'read'):
+        file = fits.open(filename, memmap = True)
+    if timer is not None:
+        timer.count('bytes_read', os.path.getsize(filename))
+
+    #the pixels of the memory mapped file are read while they are calibrated
+    with file:
+        with run_timing.stage(timer, 'calibrate'):
+            np.subtract(file[0].data, bias, out = image, dtype = image.dtype)
+        return image, [file[0].header['JD']]
+
+def releaseFrame(pool, buffer):
+    """ hand the buffer of a frame back to its pool (nothing to do for frames that aren't pooled), returns None """
+
+    if buffer is not None:
+        pool.release(buffer)
+
+def streamFrames(parentdir, filenames, start_frame, num_frames, bias, dark, flat, gain, RCDfiles, depth = 8, workers = 1, pool = None, timer = None):
+    """ generator over frames starting at start_frame, the next frames are read and decoded on 
+    worker threads while the current one is being processed
+    input: parent directory (minute), list of filenames, starting frame number, how many frames to read in,
+    bias, dark and flat images (2D arrays), gain level ('low' or 'high'), RCD or fits files (bool),
+    maximum number of frames read ahead (int), number of reader threads (int),
+    optional frame_pool.FramePool the frames are read into: each frame is then only valid until the next one is requested,
+    optional run_timing.RunTimer timing the reads on the reader threads
+    returns: iterator of (image data array, list containing header time) for each frame, in order"""
+
+    files_to_read = filenames[start_frame:start_frame + num_frames]
+    depth = max(1, depth if pool is None else min(depth, pool.size))        #frames read ahead hold a buffer each
+
+    '''bounded queue of frames being read in the background'''
+    pending = deque()
+    held = None             #buffer of the frame being processed by the consumer, released when the next frame is requested
+    executor = ThreadPoolExecutor(max_workers = max(1, workers))
+    try:
+        for filename in files_to_read:
+            if pool is None:
+                pending.append((None, executor.submit(readFrame, parentdir, filename, bias, dark, flat, gain, RCDfiles, timer)))
+            else:
+                buffer = pool.acquire()
+                pending.append((buffer, executor.submit(readFrameInto, parentdir, filename, bias, gain, RCDfiles, buffer, timer)))
+            
+            #wait for the oldest frame once the queue is full
+            if len(pending) >= depth:
+                held, future = pending.popleft()
+                yield future.result()
+                held = releaseFrame(pool, held)
+
+        while pending:
+            held, future = pending.popleft()
+            yield future.result()
+            held = releaseFrame(pool, held)
+
+    finally:
+        '''stop reading ahead if the consumer stops early'''
+        for buffer, future in pending:
+            future.cancel()
+        executor.shutdown(wait = True)
+
+        '''hand the buffers back, the reads that were cancelled or finished don't use them anymore'''
+        if pool is not None:
+            for buffer, future in pending:
+                pool.release(buffer)
+            releaseFrame(pool, held)
+
+def binMiddles(num_images, bin_frames):
+    """ index of the middle image of each bin of bin_frames consecutive images, the last bin may be shorter """
+
+    starts = np.arange(0, num_images, bin_frames)
+    return starts + (np.minimum(starts + bin_frames, num_images) - starts)//2
+
+def shiftSlices(shift, length):
+    """ destination and source slices of a whole pixel shift along one axis: destination[i] = source[i + shift] """
+
+    if shift >= 0:
+        return slice(0, max(length - shift, 0)), slice(min(shift, length), length)
+    return slice(min(-shift, length), length), slice(0, max(length + shift, 0))
+
+def driftRate(frames, positions, sigma, gain, x_length, y_length):
+    """ mean drift per frame over a few frames, tracked frame to frame from the star positions
+    input: list of (image data, header time) frames, star positions (2D array), winpos gaussian sigma, gain level, image dimensions
+    returns: (dx, dy) drift per frame (array)"""
+
+    if len(frames) < 2:
+        return np.zeros(2)
+
+    tracker = tracking.Tracker(positions, sigma, x_length, y_length)
+    found = []
+    for frame in frames:
+        positions, drift = tracker.track(trackingPlane(frame[0], gain))
+        found.append(positions - drift)         #tracked positions are moved on by the drift for the next frame
+
+    return np.median(found[-1] - found[0], axis = 0)/(len(frames) - 1)
+
+def binRate(x_drifts, y_drifts, bin_frames):
+    """ drift per image from the drifts tracked between the last bins, the tracker starts each frame from positions 
+    already moved on by the previous drift so the motion between two frames is the sum of their drifts """
+    return np.array([sum(x_drifts[-2:]), sum(y_drifts[-2:])])/bin_frames
+
+def binFrames(frames, bin_frames, rate, measureRate = None):
+    """ generator averaging bin_frames consecutive frames, each frame is shifted by whole pixels onto the middle frame
+    of its bin so that the stars don't smear
+    input: iterator of (image data, header time) frames (from streamFrames), number of frames per bin (int),
+    (dx, dy) drift per frame (array, read at the start of each bin so the caller can update it as it tracks the binned frames),
+    function measuring the drift per frame on the list of frames of a bin, used while rate is unknown (NaN)
+    returns: iterator of (mean image, header time of the middle frame), the last bin may hold fewer frames"""
+
+    frames = iter(frames)
+    while True:
+        images = []
+        for frame in frames:
+            images.append(frame)
+            if len(images) == bin_frames:
+                break
+        if not images:
+            return
+
+        if measureRate is not None and not np.isfinite(rate).all():
+            rate[:] = measureRate(images)
+
+        middle = len(images)//2
+        total = np.zeros(np.shape(images[0][0]), dtype = np.float64)         #sums are kept in float64
+        count = np.zeros(total.shape[-2:], dtype = np.float64)
+
+        for k, (image, headerTime) in enumerate(images):
+            '''a star at p on the middle frame is at p + rate*(k - middle) on frame k'''
+            shift = np.nan_to_num(np.rint(rate*(k - middle))).astype(int)
+            x_to, x_from = shiftSlices(shift[0], total.shape[-1])
+            y_to, y_from = shiftSlices(shift[1], total.shape[-2])
+
+            total[..., y_to, x_to] += image[..., y_from, x_from]
+            count[y_to, x_to] += 1
+
+        #the middle frame isn't shifted, every pixel has at least one frame
+        yield np.divide(total, count, dtype = imageDtype), images[middle][1]
+
+def imageShape(filename, gain, isRCD):
+    """ shape of the images of a file: (rows, columns), or (2, rows, columns) for dual gain RCD files """
+
+    if isRCD:
+        return (2, 2048, 2048) if gain == 'dual' else (2048, 2048)
+
+    header = fits.getheader(filename)
+    return (header['NAXIS2'], header['NAXIS1'])
+
+def stackFiles(filenames, gain, isRCD, method = 'median', offset = None, scales = None, memory = 2**30, workers = None):
+    """ combine a list of images tile by tile with bounded memory (see stacking.py)
+    input: list of filenames (path objects), gain level ('low', 'high' or 'dual'), RCD or fits files (bool),
+    'median', 'mean' or 'sigclip', image subtracted from each frame, divisor of each frame, memory for the tiles (bytes), number of threads
+    return: combined image (imageDtype array) """
+
+    readRows = functools.partial(readRowsRCD, gain = gain) if isRCD else readRowsFITS
+    shape = imageShape(filenames[0], gain, isRCD)
+
+    return stacking.stack(filenames, readRows, shape, method, offset, scales, memory = memory, workers = workers, dtype = imageDtype)
+
+def combineBiases(biasFileList, gain, isRCD, method = 'median'):
+    """ median combine a list of bias images
+    input: list of bias filenames (path objects), gain level ('low', 'high' or 'dual'), RCD or fits files (bool),
+    combination ('median', 'mean' or 'sigclip')
+    return: median bias image """
+
+    return stackFiles(biasFileList, gain, isRCD, method)
+
+def combineDarks(darkFilelist, gain, isRCD, method = 'median'):
+    """ median combine a list of dark images
+    input: list of dark filenames (path objects), gain level ('low', 'high' or 'dual'), RCD or fits files (bool),
+    combination ('median', 'mean' or 'sigclip')
+    return: median dark image """
+
+    return stackFiles(darkFilelist, gain, isRCD, method)
+
+def combineFlats(flatFilelist, masterDark, gain, isRCD, method = 'median'):
+    """ make a normalised master flat from a list of flat images
+    input: list of flat filenames (path objects), master dark image, gain level ('low', 'high' or 'dual'), RCD or fits files (bool),
+    combination ('median', 'mean' or 'sigclip')
+    return: median normalised flat image """
+
+    shape = imageShape(flatFilelist[0], gain, isRCD)
+
+    '''median of each dark subtracted flat, each gain normalised separately'''
+    scales = []
+    for filename in flatFilelist:
+        flat = readRowsRCD(filename, 0, shape[-2], gain) if isRCD else readRowsFITS(filename, 0, shape[-2])
+        scales.append(np.median(flat - masterDark, axis=(-2,-1)))
+
+    '''create master flat'''
+    masterFlat = stackFiles(flatFilelist, gain, isRCD, method, offset = masterDark, scales = np.array(scales))
+
+    return masterFlat
+
+def getBias(filepath, numOfBiases, gain, isRCD, method = 'median'):
     print('Bias')
     filepath = filepath.joinpath('Bias')
     """ get median bias image from a set of biases (length =  numOfBiases) from filepath
-    input: bias image directory (path object), number of bias images to take median from (int), gain level ('low' or 'high')
+    input: bias image directory (path object), number of bias images to take median from (int), gain level ('low', 'high' or 'dual')
     return: median bias image """
 
-    if not isRCD:     #for .fits files
-        '''get list of bias images to combine'''
-        biasFileList = sorted(filepath.glob('*.fits'))
-        biases = []   #list to hold bias data
-        
-        '''append data from each bias image to list of biases'''
-        for i in biasFileList:
-             biases.append(fits.getdata(i))
-     
-        
-    else: #for rcd files:
-        '''get list of images to combine'''
-        biasFileList = sorted(filepath.glob('*.rcd'))
-        
-        #import images, using array of zeroes as bias
-        biases = importFramesRCD(filepath, biasFileList, 0, numOfBiases, np.zeros((2048,2048)), gain)[0]
+    '''get list of bias images to combine'''
+    biasFileList = sorted(filepath.glob('*.rcd' if isRCD else '*.fits'))[:numOfBiases]
     
-    '''take median of bias images'''
-    biasMed = np.median(biases, axis=0)
-    
-    return biasMed
+    return combineBiases(biasFileList, gain, isRCD, method)
 
-def getDark(filepath, numOfDarks, isRCD):
+def getDark(filepath, numOfDarks, isRCD, gain = 'high', method = 'median'):
     print('Dark')
     filepath = filepath.joinpath('Dark')
-    if not isRCD:
-        darkFilelist = sorted(filepath.glob('*.fits'))
-        darks = []
-        for i in range(numOfDarks):
-            darks.append(fits.getdata(darkFilelist[i]))
+    darkFilelist = sorted(filepath.glob('*.rcd' if isRCD else '*.fits'))[:numOfDarks]
 
-    else:
-        darkFilelist = sorted(filepath.glob('*.rcd'))
-
-        #import images, using array of zeroes as bias
-        darks = importFramesRCD(filepath, darkFilelist, 0, numOfDarks, np.zeros((2048,2048)))[0]
+    return combineDarks(darkFilelist, gain, isRCD, method)
 
-    '''take median of dark images'''
-    darkMed = np.median(darks, axis=0)
-    
-    return darkMed
-
-def getFlat(filepath, numOfFlats, masterDark, isRCD):
+def getFlat(filepath, numOfFlats, masterDark, isRCD, gain = 'high', method = 'median'):
     print('Flat')
     filepath = filepath.joinpath('Flat')
-    if not isRCD:
-        flatFilelist = sorted(filepath.glob('*.fits'))
-        flats = []
-        for i in range(numOfFlats):
-            flats.append(fits.getdata(flatFilelist[i]))
+    flatFilelist = sorted(filepath.glob('*.rcd' if isRCD else '*.fits'))[:numOfFlats]
 
-    else:
-        flatFilelist = sorted(filepath.glob('*.rcd'))
-
-        #import images, using array of zeroes as flat
-        flats = importFramesRCD(filepath, flatFilelist, 0, numOfFlats, np.zeros((2048,2048)))[0]
-
-    '''create master flat'''
-    flats = np.array([flat-masterDark for flat in flats])
-    flats = np.array([np.array(i)/np.median(i) for i in flats])
-    masterFlat = np.median(flats, axis=0)
-
-    return masterFlat
+    return combineFlats(flatFilelist, masterDark, gain, isRCD, method)
 
 
 
 def getDateTime(folder):
     """function to get date and time of folder, then make into python datetime object
-    input: filepath 
+    input: filepath (folder named 'YYYYMMDD_HH.MM.SS.mmm')
     returns: datetime object"""
     
     #time is in format ['hour', 'minute', 'second', 'msec']
-    #folderDate = str(folder.name).split('_')[0]                 #get date folder was created from its name
-    folderDate = '20220607'
-    #folderTime = str(folder.name).split('_')[1].split('.')
-    folderTime = '19.30.00.000'
-    folderTime = folderTime.split('.')
+    folderDate = str(folder.name).split('_')[0]                 #get date folder was created from its name
+    folderTime = str(folder.name).split('_')[1].split('.')
     folderDate = datetime.date(int(folderDate[:4]), int(folderDate[4:6]), int(folderDate[-2:]))  #convert to date object
     folderTime = datetime.time(int(folderTime[0]), int(folderTime[1]), int(folderTime[2]))       #convert to time object
     folderDatetime = datetime.datetime.combine(folderDate, folderTime)                     #combine into datetime object
     
     return folderDatetime
 
-def makeBiasSet(filepath, numOfBiases, savefolder, gain):
+def makeBiasSet(filepath, numOfBiases, savefolder, gain, isRCD = False):
     """ get set of median-combined biases for entire night that are sorted and indexed by time,
     these are saved to disk and loaded in when needed
-    input: filepath (string) to bias image directories, number of biases images to combine for master
+    input: filepath (string) to bias image directories, number of biases images to combine for master,
+    folder to save master biases in, gain level, RCD or fits files (bool)
     return: array with bias image times and filepaths to saved biases on disk"""
     
     biasFolderList = [f for f in filepath.iterdir() if f.is_dir()]   #list of bias folders
@@ -525,14 +884,13 @@ def makeBiasSet(filepath, numOfBiases, savefolder, gain):
     
     #loop through each folder of biases
     for folder in biasFolderList:
-        masterBiasImage = getBias(folder, numOfBiases, gain)      #get median combined image from this folder
-        
-        #save as .fits file if doesn't already exist
-        hdu = fits.PrimaryHDU(masterBiasImage)
         biasFilepath = bias_savepath.joinpath(folder.name + '_' + gain + '_medbias.fits')
-
         
+        #save as .fits file if doesn't already exist
         if not os.path.exists(biasFilepath):
+            biasFileList = sorted(folder.glob('*.rcd' if isRCD else '*.fits'))[:numOfBiases]
+            masterBiasImage = combineBiases(biasFileList, gain, isRCD)      #get median combined image from this folder
+            hdu = fits.PrimaryHDU(masterBiasImage)
             hdu.writeto(biasFilepath)
         
         folderDatetime = getDateTime(folder)
@@ -540,9 +898,8 @@ def makeBiasSet(filepath, numOfBiases, savefolder, gain):
         biasList.append((folderDatetime, biasFilepath))
     
     #package times and filepaths into array, sort by time
-    biasList = np.array(biasList)
-    ind = np.argsort(biasList, axis=0)
-    #biasList = biasList[ind[:,0]]
+    biasList.sort(key = lambda bias: bias[0])
+    biasList = np.array(biasList, dtype = object)
     
     return biasList
 
@@ -555,7 +912,7 @@ def chooseBias(obs_folder, MasterBiasList):
     current_dt = getDateTime(obs_folder)
     
     '''make array of time differences between current and biases'''
-    bias_diffs = np.array(abs(MasterBiasList[:,0] - current_dt))
+    bias_diffs = np.array([abs(bias_dt - current_dt) for bias_dt in MasterBiasList[:,0]])
     bias_i = np.argmin(bias_diffs)    #index of best match
     
     '''select best master bias using above index'''
@@ -566,86 +923,68 @@ def chooseBias(obs_folder, MasterBiasList):
     return bias
 
  
-def getLightcurves(folder, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles = False):
-    """ formerly 'main'
-    Detect possible occultation events in selected file and archive results 
-    
-    input: name of current folder (path object), folder to save results in (path object),
-    aperture nadius [px], gain (low or high), telescope name (string), 
-    star detection threshold (float)
-    
-    output: printout of processing tasks, .npy file with star positions (if doesn't exist), 
-    .txt file for each occultation event with names of images to be saved, the time 
-    of that image, flux of occulted star in image
-    """
-    
-    minutefolder = folder.name
-    
-    print (datetime.datetime.now(), "Opening:", folder)
-        
-        
+def getCalibration(folder, gain, RCDfiles, flat_path = None):
+    """ builds the master calibration images used by getLightcurves
+    input: folder holding the Bias, Dark and (optionally) Flat directories (path object), gain level ('low', 'high' or 'dual'), 
+    RCD or fits files (bool), optional already made master flat (.fits path object)
+    returns: bias, dark and flat images (2D arrays), see calibration.py for masters cached on disk"""
+
     '''make bias set and load in appropriate master bias image'''
     NumBiasImages = 10              #number of bias images to combine in median bias image
 
     #get 2d np array with bias datetimes and master bias filepaths
     #MasterBiasList = makeBiasSet(folder.joinpath('Bias'), NumBiasImages, savefolder, gain)
     #bias = chooseBias(folder, MasterBiasList)
-    bias = getBias(folder, 10, 'high', RCDfiles)
-    dark = getDark(folder, 10, RCDfiles)
-    #flat = getFlat(folder, 60, dark, RCDfiles)
-    flat = fits.getdata(pathlib.Path('/Volumes/1TB HD/Colibri_Obs/Red, 12 Jun 2022/flat_1.5sigmarejection.fits')) #use if masterflat has already been made
-    #bias = np.zeros((2048,2048)) #use if no bias frames have been made
+    bias = getBias(folder, NumBiasImages, gain, RCDfiles)
+    dark = getDark(folder, 10, RCDfiles, gain)
 
-    ''' get list of image names to process'''
-    if RCDfiles == True: # Option for RCD or fits import - MJM 20210901
-        filenames = sorted(folder.glob('*.rcd'))
+    if flat_path is not None:
+        flat = fits.getdata(flat_path) #use if masterflat has already been made
+    elif folder.joinpath('Flat').is_dir():
+        flat = getFlat(folder, 60, dark, RCDfiles, gain)
     else:
-        filenames = sorted(folder.glob('*.fits'))
+        flat = np.ones_like(bias)
+    #bias = np.zeros((2048,2048)) #use if no bias frames have been made
+
+    return bias, dark, flat
 
 
-    for filename in filenames:
+def getImageFiles(folder, RCDfiles):
+    """ list the images of a minute folder, '._' resource files left by macOS are removed
+    input: minute directory (path object), RCD or fits files (bool)
+    returns: sorted list of image files"""
+
+    extension = '*.rcd' if RCDfiles else '*.fits'
+
+    for filename in folder.glob(extension):
         if filename.name.split('_')[0] == '.':
             os.remove(filename)
 
-    if RCDfiles == True: # Option for RCD or fits import - MJM 20210901
-        filenames = sorted(folder.glob('*.rcd'))
-    else:
-        filenames = sorted(folder.glob('*.fits'))
-    
-    field_name = str(filenames[0].name).split('_')[0]               #which of 11 fields are observed
-#    pier_side = str(filenames[0].name).split('-')[1].split('_')[0]  #which side of the pier was scope on
-    
-    ''' get 2d shape of images, number of image in directory'''
-    if RCDfiles == True:
-        x_length, y_length, num_images = getSizeRCD(filenames) 
-    else:
-        x_length, y_length, num_images = getSizeFITS(filenames)
+    return sorted(folder.glob(extension))
 
-    print (datetime.datetime.now(), "Imported", num_images, "frames")
-    print(len(filenames), 'len filenames')
 
-    ''' load/create star positional data'''
+def detectStars(folder, savefolder, filenames, num_images, ap_r, gain, detect_thresh, RCDfiles, bias, dark, flat, x_length, y_length,
+                tile = None, workers = 1):
+    """ find the stars on a median stack of the first images of a minute, moving on to the next 
+    images while too few stars are found
+    input: minute directory (path object), folder to save the stacked image in (path object), image files, number of images to use,
+    aperture radius [px], gain level, star detection threshold (float), RCD or fits files (bool), calibration images, image dimensions,
+    size of the detection tiles and number of processes extracting them (see initialFindFITS)
+    returns: first frame (image data, header time), star positions (2D array), star radii (array), or None if there are no good images"""
+
     if RCDfiles == True: # Choose to open rcd or fits - MJM
         first_frame = importFramesRCD(folder, filenames, 0, 1, bias, gain)
-        headerTimes = [first_frame[1]] #list of image header times
-        last_frame = importFramesRCD(folder, filenames, len(filenames)-1, 1, bias, gain)
     else:
         first_frame = importFramesFITS(folder, filenames, 0, 1, bias, dark, flat)      #data and time from 1st image
-        headerTimes = [first_frame[1]] #list of image header times
-        last_frame = importFramesFITS(folder, filenames, len(filenames)-1, 1, bias, dark, flat) #data and time from last image
-
-    headerTimes = [first_frame[1]]                             #list of image header times
         
-    #stack first few images to do star finding
-    numtoStack = 10
-    startIndex = 2          #don't include 1st image (vignetting)
-    print('stacking images %i to %i\n' %(startIndex, numtoStack))
-    stacked = stackImages(folder, savefolder, startIndex, startIndex + numtoStack, bias, dark, flat, gain, RCDfiles)
+    #stack first few images to do star finding, only from the images given (a live folder may hold images still being written)
+    print('stacking images %i to %i\n' %(detectStart, detectStart + detectStack - 1))
+    stacked = stackImages(folder, savefolder, detectStart, detectStack, bias, dark, flat, gain, RCDfiles, filenames = filenames)
     
     
     #find stars in first image
  #   star_find_results = tuple(initialFindFITS(first_frame[0]))
-    star_find_results = tuple(initialFindFITS(stacked, detect_thresh))
+    star_find_results = tuple(initialFindFITS(trackingPlane(stacked, gain), detect_thresh, tile, workers))
 
         
     #remove stars where centre is too close to edge of frame
@@ -665,12 +1004,10 @@ def getLightcurves(folder, savefolder, ap_r, gain, telescope, detect_thresh, RCD
 
         if RCDfiles == True:
             first_frame = importFramesRCD(folder, filenames, 1+i, 1, bias, gain)
-            headerTimes = [first_frame[1]]
-            star_find_results = tuple(initialFindFITS(first_frame[0], detect_thresh))
+            star_find_results = tuple(initialFindFITS(trackingPlane(first_frame[0], gain), detect_thresh, tile, workers))
         else:
             first_frame = importFramesFITS(folder, filenames, 1+i, 1, bias, dark, flat)
-            headerTimes = [first_frame[1]]
-            star_find_results = tuple(initialFindFITS(first_frame[0], detect_thresh))
+            star_find_results = tuple(initialFindFITS(trackingPlane(first_frame[0], gain), detect_thresh, tile, workers))
 
             # star_find_results = tuple(x for x in star_find_results if x[0] > 250)
         
@@ -680,10 +1017,7 @@ def getLightcurves(folder, savefolder, ap_r, gain, telescope, detect_thresh, RCD
         i += 1
              #check if out of bounds
         if (1+i) >= num_images:
-            print('no good images in minute: ', folder)
-            print (datetime.datetime.now(), "Closing:", folder)
-            print ("\n")
-            return -1
+            return None
 
     #print('star finding file index: ', i)
         
@@ -699,123 +1033,544 @@ def getLightcurves(folder, savefolder, ap_r, gain, telescope, detect_thresh, RCD
     initial_positions = initial_positions[(x_length >= initial_positions[:, 0])]
     initial_positions = initial_positions[(y_length >= initial_positions[:, 1])]
 
-    #save file with updated positions each minute
-    posfile = savefolder.joinpath(field_name + '_' + minutefolder + '_' + gain + '_' + str(detect_thresh) + 'sig_pos.npy')
-    np.save(posfile, initial_positions)
+    return first_frame, initial_positions, radii
+
+
+def apertureAnnulus(apertures):
+    """ background annulus shared by all the apertures of a multi-aperture run and all its frames, as timeEvolveFITS for the largest aperture """
+    return (max(apertures) + 6., max(apertures) + 11.)
+
+def apertureFluxes(image, x, y, apertures, sep_pool = None):
+    """ fluxes of the stars in several apertures with the same background annulus, measured by a single sep call over the frame
+    input: image data (2D array), star x and y positions (arrays), aperture radii [px] (list), optional sep_shards.SepPool
+    returns: (stars, apertures) fluxes, (stars, apertures) flux errors, stars near the edge of the frame are set to 0"""
+
+    radii = np.asarray(apertures, dtype = np.float64)
+    fluxes, sigmas = np.zeros((len(x), len(radii))), np.zeros((len(x), len(radii)))
+
+    onFrame = np.ones(len(x), dtype = bool)
+    onFrame[clipCutStars(x, y, image.shape[1], image.shape[0]).astype(int)] = False
+
+    '''one list of (star, aperture) pairs, sep only broadcasts 1D positions with a background annulus'''
+    stars = np.count_nonzero(onFrame)
+    photometry = (sep_pool or sep).sum_circle(image, np.repeat(x[onFrame], len(radii)), np.repeat(y[onFrame], len(radii)), np.tile(radii, stars), 
+                                bkgann = apertureAnnulus(apertures))
+    fluxes[onFrame], sigmas[onFrame] = photometry[0].reshape(stars, len(radii)), photometry[1].reshape(stars, len(radii))
+
+    return fluxes, sigmas
+
+def addApertures(row, image, apertures, sep_pool = None):
+    """ append the multi-aperture fluxes and errors to the (stars, 5) photometry of a frame, 
+    the row becomes x, y, flux, flux error, unix time, one flux per aperture, one flux error per aperture """
+
+    if not apertures:
+        return row
+
+    return np.column_stack([row, *apertureFluxes(image, row[:, 0], row[:, 1], apertures, sep_pool)])
+
+def apertureColumns(data, num_apertures):
+    """ multi-aperture columns of a store from frames x stars photometry arrays: frames x stars x apertures fluxes and errors """
+    return {'flux_ap': data[:, :, 5:5 + num_apertures], 'sigma_ap': data[:, :, 5 + num_apertures:5 + 2*num_apertures]}
+
+def firstFramePhotometry(first_frame, positions, ap_r, gain, saturation = None, apertures = None, sep_pool = None):
+    """ photometry of the first frame at the detected star positions, the background annulus is closer than in the following frames
+    input: first frame (image data, header time), star positions (2D array), aperture radius [px], gain level, 
+    saturation level of the high gain (dual gain only), optional list of aperture radii also measured (see apertureFluxes),
+    optional sep_shards.SepPool splitting the stars across processes
+    returns: (stars, 5) array of x, y, flux, flux error, unix time on the tracking plane (followed by the fluxes and errors of the apertures), 
+    same for the low gain and saturation flags of the high gain apertures in dual gain mode (else None)"""
+
+    image = trackingPlane(first_frame[0], gain)
+    unix = Time(headerTimeJD(first_frame[1]), precision=9, format = 'jd').unix
+
+    photometry = (sep_pool or sep).sum_circle(image, positions[:,0], positions[:,1], ap_r, bkgann = (ap_r+2., ap_r + 4.))
+    row = np.column_stack([positions[:,0], positions[:,1], photometry[0], photometry[1], np.full(len(positions), unix)])
+
+    if gain != 'dual':
+        return addApertures(row, image, apertures, sep_pool), None, None
+
+    photometry = (sep_pool or sep).sum_circle(first_frame[0][0], positions[:,0], positions[:,1], ap_r, bkgann = (ap_r+2., ap_r + 4.))
+    row_low = np.column_stack([positions[:,0], positions[:,1], photometry[0], photometry[1], row[:, 4]])
+
+    return (addApertures(row, image, apertures, sep_pool), addApertures(row_low, first_frame[0][0], apertures, sep_pool),
+            apertureMax(image, positions[:,0], positions[:,1], ap_r) >= saturation)
+
+
+def framePhotometry(frame, positions, ap_r, gain, x_length, y_length, saturation = None, apertures = None, sep_pool = None):
+    """ photometry of a frame at the tracked star positions
+    input: frame (image data, header time), star positions (2D array), aperture radius [px], gain level, image dimensions, 
+    saturation level of the high gain (dual gain only), optional list of aperture radii also measured (see apertureFluxes),
+    optional sep_shards.SepPool splitting the stars across processes
+    returns: (stars, 5) array of x, y, flux, flux error, unix time on the tracking plane (followed by the fluxes and errors of the apertures), 
+    same for the low gain and saturation flags of the high gain apertures in dual gain mode (else None)"""
+
+    image = trackingPlane(frame[0], gain)
+    row = timeEvolveFITS(image, frame[1], positions, ap_r, len(positions), x_length, y_length, sep_pool)
+
+    if gain != 'dual':
+        return addApertures(row, image, apertures, sep_pool), None, None
+
+    row_low = timeEvolveFITS(frame[0][0], frame[1], positions, ap_r, len(positions), x_length, y_length, sep_pool)
+
+    return (addApertures(row, image, apertures, sep_pool), addApertures(row_low, frame[0][0], apertures, sep_pool),
+            apertureMax(image, row[:, 0], row[:, 1], ap_r) >= saturation)
+
+
+def storeFrame(t, photometry, data, data_low = None, saturated = None):
+    """ copy the photometry of frame t (from framePhotometry) into the frames x stars arrays """
+
+    data[t] = photometry[0]
+    if data_low is not None:
+        data_low[t] = photometry[1]
+        saturated[t] = photometry[2]
+
+
+def lightcurveSets(data, data_low, saturated, gain):
+    """ lightcurves saved for a run, a single set or the high gain, low gain and merged (hdr) sets in dual gain mode
+    input: frames x stars photometry arrays (data_low and saturated are None unless in dual gain mode), gain level
+    returns: list of (set name, frames x stars fluxes, frames x stars flux errors)"""
+
+    if gain != 'dual':
+        return [(gain, data[:, :, 2], data[:, :, 3])]
+
+    #merged lightcurve falls back on the low gain when the high gain aperture saturates
+    hdr_flux, gainRatio = mergeGains(data[:, :, 2], data_low[:, :, 2], saturated)
+    hdr_sigma = np.where(saturated, data_low[:, :, 3]*gainRatio, data[:, :, 3])
+
+    return [('high', data[:, :, 2], data[:, :, 3]), ('low', data_low[:, :, 2], data_low[:, :, 3]), ('hdr', hdr_flux, hdr_sigma)]
+
+
+def starTable(positions, fluxes):
+    """ star table of a store: star number, initial position and fluxCheck error code of each star
+    input: initial star positions (2D array), frames x stars fluxes (2D array)
+    returns: structured array (lightcurve_store.starDtype)"""
+
+    stars = np.zeros(len(positions), dtype = lightcurve_store.starDtype)
+    stars['star'] = np.arange(len(positions))
+    stars['x'] = positions[:, 0]
+    stars['y'] = positions[:, 1]
+    stars['error'] = [fluxCheck(fluxes[:, star], star)[0] for star in range(len(positions))]
+
+    return stars
+
+
+def apertureScatter(fluxes):
+    """ relative point to point scatter of lightcurves, median absolute difference between consecutive frames over the median flux,
+    slow variability of the star doesn't count
+    input: frames x ... fluxes (array)
+    returns: scatter of each lightcurve (array of the remaining dimensions), inf where the median flux isn't positive"""
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        median = np.median(fluxes, axis = 0)
+        scatter = np.median(np.abs(np.diff(fluxes, axis = 0)), axis = 0)/median
+
+    return np.where(median > 0, scatter, np.inf)
+
+def selectApertures(store):
+    """ pick the aperture with the lowest point to point scatter for each star of a multi-aperture store, 
+    its fluxes and errors replace the flux and sigma columns (all apertures stay in flux_ap and sigma_ap) and the error codes are updated
+    input: store directory (path object)
+    returns: selected radius of each star (array), also saved in the store as best_aperture.npy"""
+
+    apertures = np.array(lightcurve_store.getMeta(store)['apertures'])
+    fluxes = lightcurve_store.getColumn(store, 'flux_ap')
+    best = np.argmin(apertureScatter(fluxes), axis = 1)
+
+    '''rewrite the flux and sigma chunks with the best aperture of each star'''
+    for chunk in range(lightcurve_store.numChunks(store)):
+        for column in ['flux', 'sigma']:
+            part = np.load(store.joinpath(column + '_ap_%05i.npy' % chunk))
+            lightcurve_store.saveArray(store.joinpath(column + '_%05i.npy' % chunk), np.take_along_axis(part, best[None, :, None], axis = 2)[:, :, 0])
+
+    selected = np.take_along_axis(fluxes, best[None, :, None], axis = 2)[:, :, 0]
+    lightcurve_store.updateErrors(store, [fluxCheck(selected[:, star], star)[0] for star in range(selected.shape[1])])
+    lightcurve_store.saveArray(store.joinpath('best_aperture.npy'), apertures[best])
+
+    return apertures[best]
+
+
+def storePath(savefolder, setname, detect_thresh, minutefolder):
+    """ lightcurve store of a minute folder: savefolder/<set>_<thresh>sig_store/<minute> """
+    return savefolder.joinpath(setname + '_' + str(detect_thresh) + 'sig_store', str(minutefolder))
+
+
+def cutoutPath(savefolder, setname, detect_thresh, minutefolder):
+    """ stamp cache of a minute folder: savefolder/<set>_<thresh>sig_cutouts/<minute> """
+    return savefolder.joinpath(setname + '_' + str(detect_thresh) + 'sig_cutouts', str(minutefolder))
+
+
+def cutoutWriters(savefolder, gain, detect_thresh, minutefolder, size, num_stars, meta, start):
+    """ stamp caches of a run, one per gain plane (see cutouts.py)
+    input: folder to save results in, gain level, star detection threshold, minute folder name, stamp size [px] (None for no cache), 
+    number of stars, run information (dict), first frame written (frames from start on are dropped from an existing cache)
+    returns: list of (plane index or None, cutouts.CutoutWriter)"""
+
+    if not size:
+        return []
+
+    planes = [('low', 0), ('high', 1)] if gain == 'dual' else [(gain, None)]
+    return [(plane, cutouts.CutoutWriter(cutoutPath(savefolder, setname, detect_thresh, minutefolder), size, num_stars, 
+                                         dict(meta, gain = setname), start, dtype = imageDtype)) for setname, plane in planes]
+
+
+def addCutouts(writers, image, positions):
+    """ cut the stamps of a frame into each cache, at the photometered positions (frames x 2 array) """
+
+    for plane, writer in writers:
+        writer.add(image if plane is None else image[plane], positions)
+
+
+def checkpointPath(savefolder, gain, detect_thresh, minutefolder):
+    """ checkpoint directory of a getLightcurves run: savefolder/<gain>_<thresh>sig_checkpoint_<minute> """
+    return savefolder.joinpath(gain + '_' + str(detect_thresh) + 'sig_checkpoint_' + str(minutefolder))
+
+
+def timingPath(savefolder, gain, detect_thresh, minutefolder):
+    """ run report of a timed getLightcurves run: savefolder/<gain>_<thresh>sig_timing_<minute>.json """
+    return savefolder.joinpath(gain + '_' + str(detect_thresh) + 'sig_timing_' + str(minutefolder) + '.json')
+
+
+def saveCheckpoint(checkpoint, t, start, filenames, ap_r, initial_positions, radii, tracker, headerTimes, x_drifts, y_drifts,
+                   data, data_low = None, saturated = None, apertures = None):
+    """ save the state of a getLightcurves run after frame t, the photometry of the frames since the last checkpoint 
+    is written as a new part and the state file is replaced last, so an interrupted write leaves the previous checkpoint usable
+    input: checkpoint directory (path object), last frame done (int), first frame not in a previous part (int), image files, aperture radius,
+    star positions and radii from detectStars, Tracker, header times, x and y drifts, frames x stars photometry arrays, multi-aperture radii
+    returns: None"""
+
+    checkpoint.mkdir(parents = True, exist_ok = True)
+
+    part = checkpoint.joinpath('part_%06i.npz' % start)
+    rows = {'data': data[start:t + 1]}
+    if data_low is not None:
+        rows['data_low'] = data_low[start:t + 1]
+        rows['saturated'] = saturated[start:t + 1]
+    with open(part, 'wb') as filehandle:
+        np.savez(filehandle, **rows)
+
+    state = checkpoint.joinpath('state.npz')
+    tmpfile = checkpoint.joinpath('state.tmp.npz')
+    with open(tmpfile, 'wb') as filehandle:
+        np.savez(filehandle, t = t, filenames = np.array([str(f.name) for f in filenames]), ap_r = ap_r, apertures = np.array(apertures or [], dtype = np.float64),
+                 initial_positions = initial_positions, radii = radii,
+                 positions = tracker.positions, previous = tracker.previous, headerTimes = np.array(headerTimes), 
+                 x_drifts = np.array(x_drifts), y_drifts = np.array(y_drifts))
+    os.replace(tmpfile, state)
+
+
+def loadCheckpoint(checkpoint, filenames, ap_r, apertures = None):
+    """ load the checkpoint of a run, ignored if the images of the folder or the apertures changed since
+    input: checkpoint directory (path object), image files of the run, aperture radius, multi-aperture radii
+    returns: dict with the saved state and the photometry of frames 0 to t, None if there is no usable checkpoint"""
+
+    state = checkpoint.joinpath('state.npz')
+    if not state.exists():
+        return None
+
+    with np.load(state) as saved:
+        resumed = {key: saved[key] for key in saved.files}
+    resumed['t'] = int(resumed['t'])
+
+    if (list(resumed['filenames']) != [str(f.name) for f in filenames] or float(resumed['ap_r']) != ap_r
+            or list(resumed.get('apertures', [])) != [float(r) for r in apertures or []]):
+        print('images or aperture changed since checkpoint, starting over')
+        return None
+
+    '''parts up to the saved state, a part written after it by an interrupted checkpoint is left out'''
+    parts = sorted(checkpoint.glob('part_*.npz'), key = lambda part: int(part.stem.split('_')[1]))
+    rows = {}
+    for part in parts:
+        if int(part.stem.split('_')[1]) > resumed['t']:
+            continue
+        with np.load(part) as saved:
+            for key in saved.files:
+                rows.setdefault(key, []).append(saved[key])
+
+    resumed.update({key: np.concatenate(value) for key, value in rows.items()})
+
+    if len(resumed.get('data', [])) != resumed['t'] + 1:
+        print('incomplete checkpoint, starting over')
+        return None
+
+    return resumed
+
+
+def removeCheckpoint(checkpoint):
+    """ delete the checkpoint of a finished run """
+
+    if checkpoint.is_dir():
+        for f in checkpoint.iterdir():
+            os.remove(f)
+        checkpoint.rmdir()
+
+
+def getLightcurves(folder, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles = False, prefetch = 8, calibration = None, text_output = False,
+                   checkpoint_every = 500, bin_frames = 1, apertures = None, cutout_size = None, sep_workers = 1, detect_tile = None,
+                   timing = False, timing_live = None):
+    """ formerly 'main'
+    Detect possible occultation events in selected file and archive results 
+    
+    input: name of current folder (path object), folder to save results in (path object),
+    aperture nadius [px], gain (low, high, or dual for both gains from a single pass over .rcd files), telescope name (string), 
+    star detection threshold (float), number of frames to read ahead in the background (int),
+    optional (bias, dark, flat) images already built with getCalibration (tuple), 
+    also save the lightcurves as one .txt file per star (bool), 
+    number of frames between checkpoints of the run (int, None to disable), a run that was stopped resumes from its last checkpoint,
+    number of consecutive images averaged into each photometered frame (int, 1 for every image), the images of a bin are
+    shifted onto its middle image with the drift tracked between the previous bins (measured on its images for the first bin),
+    and the frame takes the name and time of the middle image,
+    optional list of aperture radii [px] measured in the same pass over each frame with one background annulus (see apertureFluxes), 
+    saved as the flux_ap and sigma_ap columns of the high and low gain stores (see selectApertures),
+    size of the stamps cut around every star in every frame (int, None for no stamps), saved in a cache per gain plane 
+    that photometry can be redone from (see cutouts.py),
+    number of processes the stars are split across for the sep centroiding and photometry of each frame (int, None for the number of cores, 
+    see sep_shards.py), worth it on dense fields of thousands of stars, 
+    size of the tiles the stars are detected in on the stack [px] (None for a single sep.extract, see detection.py), extracted by sep_workers processes,
+    save a run report with the wall and CPU time of each stage of the run, the frames, stars and bytes read and the number of stars
+    with each fluxCheck error code (bool, see run_timing.py and timingPath), 
+    seconds between the frames/sec lines printed during a timed run (None for no live line)
+    
+    output: printout of processing tasks, .npy file with star positions (if doesn't exist), 
+    lightcurve store (see lightcurve_store.py) with the flux, position and error code of every star 
+    in every image, the image names and times, optionally exported as a .txt file per star
+    returns: number of stars, -1 if there are no good images in the folder
+    in dual gain mode, lightcurves are saved for the high gain, the low gain and the merged (hdr) fluxes
+    """
+    
+    minutefolder = folder.name
+    dualGain = (gain == 'dual')
+
+    if dualGain and not RCDfiles:
+        raise ValueError('dual gain mode needs .rcd files, fits files hold a single gain')
+    
+    print (datetime.datetime.now(), "Opening:", folder)
+
+    #wall and CPU time of each stage of the run, None when the run isn't timed
+    timer = run_timing.RunTimer(timing_live) if timing else None
+    runInfo = {'minute': str(minutefolder), 'gain': gain, 'telescope': telescope, 'RCDfiles': bool(RCDfiles), 'prefetch': prefetch,
+               'bin_frames': bin_frames, 'sep_workers': sep_workers, 'detect_tile': detect_tile, 'cutout_size': cutout_size}
+        
+        
+    '''load master calibration images, built from the minute folder unless given'''
+    if calibration is None:
+        with run_timing.stage(timer, 'calibration'):
+            calibration = getCalibration(folder, gain, RCDfiles)
+    bias, dark, flat = calibration
+
+    ''' get list of image names to process'''
+    with run_timing.stage(timer, 'listing'):
+        filenames = getImageFiles(folder, RCDfiles)
+    
+        field_name = str(filenames[0].name).split('_')[0]               #which of 11 fields are observed
+#        pier_side = str(filenames[0].name).split('-')[1].split('_')[0]  #which side of the pier was scope on
+    
+        ''' get 2d shape of images, number of image in directory'''
+        if RCDfiles == True:
+            x_length, y_length, num_images = getSizeRCD(filenames) 
+        else:
+            x_length, y_length, num_images = getSizeFITS(filenames)
+    run_timing.count(timer, 'images', num_images)
+
+    print (datetime.datetime.now(), "Imported", num_images, "frames")
+    print(len(filenames), 'len filenames')
+
+    '''images photometered, the middle image of each bin in binned mode'''
+    frameFiles = filenames if bin_frames == 1 else [filenames[i] for i in binMiddles(num_images, bin_frames)]
+    num_frames = len(frameFiles)
+
+    checkpoint = checkpointPath(savefolder, gain, detect_thresh, minutefolder)
+    resumed = loadCheckpoint(checkpoint, frameFiles, ap_r, apertures) if checkpoint_every else None
+
+    if resumed is not None:
+        initial_positions, radii = resumed['initial_positions'], resumed['radii']
+        print(datetime.datetime.now(), 'resuming from checkpoint at frame', resumed['t'])
+    else:
+        ''' load/create star positional data'''
+        with run_timing.stage(timer, 'detect'):
+            found = detectStars(folder, savefolder, filenames, num_images, ap_r, gain, detect_thresh, RCDfiles, bias, dark, flat, x_length, y_length,
+                                detect_tile, sep_workers)
+        if found is None:
+            print('no good images in minute: ', folder)
+            print (datetime.datetime.now(), "Closing:", folder)
+            print ("\n")
+            if timer is not None:
+                timer.save(timingPath(savefolder, gain, detect_thresh, minutefolder), **runInfo)
+            return -1
+
+        first_frame, initial_positions, radii = found
+
+        #save file with updated positions each minute
+        posfile = savefolder.joinpath(field_name + '_' + minutefolder + '_' + gain + '_' + str(detect_thresh) + 'sig_pos.npy')
+        np.save(posfile, initial_positions)
     
     num_stars = len(initial_positions)      #number of stars in image
     print(datetime.datetime.now(), 'number of stars found: ', num_stars) 
+    run_timing.count(timer, 'stars', num_stars)
     
     
 
     ''' flux and time calculations with optional time evolution '''
       
-    #image data (2d array with dimensions: # of images x # of stars)
-    data = np.empty([num_images, num_stars], dtype=(np.float64, 5))
-    
-    #get first image data from initial star positions
-    data[0] = tuple(zip(initial_positions[:,0], 
-                        initial_positions[:,1], 
-                        #sum_flux(first_frame[0], initial_positions[:,0], initial_positions[:,1], ap_r),
-                        (sep.sum_circle(first_frame[0], initial_positions[:,0], initial_positions[:,1], ap_r, bkgann = (ap_r+2., ap_r + 4.))[0]).tolist(), 
-                        (sep.sum_circle(first_frame[0], initial_positions[:,0], initial_positions[:,1], ap_r, bkgann = (ap_r+2., ap_r + 4.))[1]).tolist(),
-                        np.ones(np.shape(np.array(initial_positions))[0]) * (Time(first_frame[1], precision=9, format = 'jd').unix)))
+    #image data (2d array with dimensions: # of images x # of stars), followed by the flux and error of each aperture in multi-aperture mode
+    width = 5 + 2*len(apertures or [])
+    data = np.empty([num_frames, num_stars], dtype=(np.float64, width))
+
+    #low gain photometry at the same positions and saturation flags of the high gain apertures in dual gain mode
+    saturation = 0.9*4095 - np.median(bias[1]) if dualGain else None        #12-bit full well, bias subtracted
+    data_low = np.empty([num_frames, num_stars], dtype=(np.float64, width)) if dualGain else None
+    saturated = np.zeros([num_frames, num_stars], dtype = bool) if dualGain else None
 
     GaussSigma = np.mean(radii * 2. / 2.35)
-    first_drift = refineCentroid(*first_frame, initial_positions, GaussSigma)
-    drift_pos = []  #array to hold frame positions
-    drift_pos.append(first_drift[0])
 
-    x_drifts, y_drifts = [],[]
-    for t in trange(1, num_images):
-        #import image
-        if RCDfiles == True:
-            imageFile = importFramesRCD(folder, filenames, t, 1, bias, gain)
-            headerTimes.append(imageFile[1])  #add header time to list
-        else:
-            imageFile = importFramesFITS(folder, filenames, t, 1, bias, dark, flat)
-            headerTimes.append(imageFile[1])  #add header time to list
+    '''sep calls on each frame are split across processes, single calls in this process with one worker'''
+    sepPool = sep_shards.SepPool((y_length, x_length), sep_workers) if sep_workers != 1 else None
+
+    '''images are read in the background from the first one not photometered yet, 
+    in binned mode the first frame is the first bin instead of the first image'''
+    start = resumed['t'] + 1 if resumed is not None else 1
+    rate = np.full(2, np.nan)          #drift per image used to align the images of a bin, measured on the first bin
+    if bin_frames == 1:
+        #frames are decoded and calibrated into buffers reused from frame to frame
+        pool = frame_pool.FramePool(imageShape(filenames[0], gain, RCDfiles), max(1, prefetch), imageDtype, raw = RCDfiles)
+        frames = streamFrames(folder, filenames, start, num_images - start, bias, dark, flat, gain, RCDfiles, depth = prefetch, pool = pool, timer = timer)
+    else:
+        first_image = start*bin_frames if resumed is not None else 0
+        measureRate = functools.partial(driftRate, positions = initial_positions, sigma = GaussSigma, gain = gain, 
+                                        x_length = x_length, y_length = y_length)
+        frames = binFrames(streamFrames(folder, filenames, first_image, num_images - first_image, bias, dark, flat, gain, RCDfiles, depth = prefetch, 
+                                        timer = timer), bin_frames, rate, measureRate)
+    #time the photometry loop spends waiting for the next frame
+    frames = run_timing.timed(frames, timer, 'wait')
+
+    '''stamps of the stars cut from each photometered frame, a resumed cache restarts after the checkpoint'''
+    stamps = cutoutWriters(savefolder, gain, detect_thresh, minutefolder, cutout_size, num_stars, 
+                           {'telescope': telescope, 'field': field_name, 'minute': str(minutefolder), 'ap_r': ap_r, 'bin_frames': bin_frames}, 
+                           start if resumed is not None else 0)
+
+    if resumed is not None:
+        '''frames up to the checkpoint and the tracking state at that frame'''
+        data[:start] = resumed['data']
+        if dualGain:
+            data_low[:start] = resumed['data_low']
+            saturated[:start] = resumed['saturated']
+
+        tracker = tracking.Tracker(resumed['positions'], GaussSigma, x_length, y_length, sep_pool = sepPool)
+        tracker.spare[:] = resumed['previous']
+        headerTimes = resumed['headerTimes'].tolist()
+        x_drifts, y_drifts = list(resumed['x_drifts']), list(resumed['y_drifts'])
+        if x_drifts:
+            rate[:] = binRate(x_drifts, y_drifts, bin_frames)
+        checkpointed = start
+    else:
+        if bin_frames > 1:
+            first_frame = next(frames)
+        headerTimes = [first_frame[1]]                             #list of image header times
+
+        with run_timing.stage(timer, 'centroid'):
+            refined = refineCentroid(trackingPlane(first_frame[0], gain), first_frame[1], initial_positions, GaussSigma, sepPool)[0]
+
+        #get first image data from initial star positions (from the positions on the first bin in binned mode, the detection stack isn't centred on it)
+        with run_timing.stage(timer, 'photometry'):
+            storeFrame(0, firstFramePhotometry(first_frame, initial_positions if bin_frames == 1 else refined, ap_r, gain, saturation, apertures, sepPool), data, data_low, saturated)
+        with run_timing.stage(timer, 'cutouts'):
+            addCutouts(stamps, first_frame[0], data[0, :, :2])
+        if timer is not None:
+            timer.frame()
+
+        tracker = tracking.Tracker(refined, GaussSigma, x_length, y_length, sep_pool = sepPool)
+
+        x_drifts, y_drifts = [],[]
+        checkpointed = 0
+    
+    #frames are read and decoded in the background while the current one is tracked
+    for t, imageFile in enumerate(tqdm(frames, total = num_frames - 1, initial = start - 1), start = start):
+        headerTimes.append(imageFile[1])  #add header time to list
         
         '''drift computation, changed to calculate drift in each frame'''
-        current_drift = refineCentroid(*imageFile, drift_pos[-1], GaussSigma)
+        with run_timing.stage(timer, 'centroid'):
+            positions, drift = tracker.track(trackingPlane(imageFile[0], gain))
+        x_drifts.append(drift[0])
+        y_drifts.append(drift[1])
         
-        x_drift , y_drift = np.mean([current_drift[0][i][0]-drift_pos[-1][i][0] for i in range(len(drift_pos))]),np.mean([current_drift[0][i][1]-drift_pos[-1][i][1] for i in range(len(drift_pos))])
-        x_drifts.append(x_drift)
-        y_drifts.append(y_drift)
-
-        drift_pos.append([(i[0]+x_drift, i[1]+y_drift) for i in current_drift[0]])
+        if bin_frames > 1:
+            '''the tracked positions are moved on by the drift for the next frame, which is bin_frames times larger 
+            between bins: bins are measured where the stars were found'''
+            positions = positions - drift
+            rate[:] = binRate(x_drifts, y_drifts, bin_frames)
         
         """end drift computation"""
 
-        data[t] = timeEvolveFITS(*imageFile, drift_pos[-1], ap_r, num_stars, x_length, y_length)
+        with run_timing.stage(timer, 'photometry'):
+            storeFrame(t, framePhotometry(imageFile, positions, ap_r, gain, x_length, y_length, saturation, apertures, sepPool), data, data_low, saturated)
+        with run_timing.stage(timer, 'cutouts'):
+            addCutouts(stamps, imageFile[0], data[t, :, :2])
+        if timer is not None:
+            timer.frame()
+
+        if checkpoint_every and t % checkpoint_every == 0 and t < num_frames - 1:
+            #stamps are saved first, a cache ahead of the checkpoint is cut back when resuming
+            with run_timing.stage(timer, 'checkpoint'):
+                for plane, writer in stamps:
+                    writer.flush()
+                saveCheckpoint(checkpoint, t, checkpointed, frameFiles, ap_r, initial_positions, radii, tracker, headerTimes, x_drifts, y_drifts,
+                               data, data_low, saturated, apertures)
+            checkpointed = t + 1
                     
 
+    with run_timing.stage(timer, 'cutouts'):
+        for plane, writer in stamps:
+            writer.flush()
+    if sepPool is not None:
+        sepPool.close()
+
     # data is an array of shape: [frames, star_num, {0:star x, 1:star y, 2:star flux, 3: unix_time}]  
 
     
-    results = []
-    for star in range(0, num_stars):
-        results.append(fluxCheck(data[:, star, 2], star)+(x_drifts, y_drifts))
-        
-    results = np.array(results, dtype = object)
-
-
     ''' data archival '''
-    
-    #make directory to save lightcurves in
-    lightcurve_savepath = savefolder.joinpath(gain + '_' + str(detect_thresh) +  'sig_lightcurves')
-    if not lightcurve_savepath.exists():
-        lightcurve_savepath.mkdir()      #make folder to hold master bias images in
-    
-    for row in results:  # loop through each detected event
-        star_coords = initial_positions[row[2]]     #coords of occulted star
-        #if error, what message to save to file
-        error_code = row[0]
-        
-        if error_code == -1:
-            error = 'empty profile'
-        elif error_code == -2:
-            error = 'light curve too short'
-        elif error_code == -3:
-            error = 'tracking failure'
-        elif error_code == -4:
-            error = 'SNR too low'
-        else:
-            error = 'None'
-            
-        #text file to save results in
-        #saved file format: 'star-#_date_time_telescope_xpos-ypos.txt'
-        #columns: fits filename and path | header time (seconds) |  star flux
-        savefile = lightcurve_savepath.joinpath('star' + str(row[2]) + "_" + str(minutefolder) + '_' + telescope + "_"+  str(int(star_coords[0])) + "-" + str(int(star_coords[1])) + ".txt")
-        
-        #open file to save results
-        with open(savefile, 'w') as filehandle:
-            
-            #file header
-            filehandle.write('#\n#\n#\n#\n')
-            filehandle.write('#    First Image File: %s\n' %(filenames[0]))
-            filehandle.write('#    Star Coords: %f %f\n' %(star_coords[0], star_coords[1]))
-            filehandle.write('#    DATE-OBS (JD): %s\n' %(headerTimes[0]))
-            filehandle.write('#    Telescope: %s\n' %(telescope))
-            filehandle.write('#    Field: %s\n' %(field_name))
-            filehandle.write('#    Error: %s\n' %(error))
-            filehandle.write('#\n#\n#\n')
-            filehandle.write('#filename     time      flux      x_drift     y_drift\n')
-          
-            data = row[1]
-            x_drifts = [0]+row[3]
-            y_drifts = [0]+row[4]
-        
-            files_to_save = filenames
-            star_save_flux = data             #part of light curve to save
-      
-            #loop through each frame to be saved
-            for i in range(0, len(files_to_save)):  
-                filehandle.write('%s %f  %f  %f  %f\n' % (files_to_save[i], float(headerTimes[i][0]-headerTimes[0][0])*24*60, float(star_save_flux[i]), float(x_drifts[i]), float(y_drifts[i])))
 
+    '''image names, times and drifts shared by all stars'''
+    frames = lightcurve_store.makeFrameTable(frameFiles, data[:, 0, 4], headerTimeJD(headerTimes)[:, 0], [0] + x_drifts, [0] + y_drifts)
+    meta = {'telescope': telescope, 'field': field_name, 'minute': str(minutefolder), 
+            'first_image': str(filenames[0]), 'date_obs': str(headerTimes[0])}
+    if bin_frames > 1:
+        meta['bin_frames'] = bin_frames
+
+    '''multi-aperture columns of the high and low gain sets, the hdr set only has the main aperture'''
+    extra = {}
+    if apertures:
+        extra = {'low': apertureColumns(data_low, len(apertures)), 'high': apertureColumns(data, len(apertures))} if dualGain else {gain: apertureColumns(data, len(apertures))}
+
+    for setname, fluxes, sigmas in lightcurveSets(data, data_low, saturated, gain):
+        #check each star's lightcurve
+        with run_timing.stage(timer, 'quality'):
+            stars = starTable(initial_positions, fluxes)
+        if timer is not None:
+            timer.rejections(setname, stars['error'])
+
+        store = storePath(savefolder, setname, detect_thresh, minutefolder)
+        columns = {'flux': fluxes, 'sigma': sigmas, 'x': data[:, :, 0], 'y': data[:, :, 1]}
+        setmeta = dict(meta, gain = setname)
+        if setname in extra:
+            columns.update(extra[setname])
+            setmeta['apertures'] = [float(r) for r in apertures]
+        with run_timing.stage(timer, 'write'):
+            lightcurve_store.saveStore(store, stars, setmeta, frames, columns)
+
+            if text_output:
+                lightcurve_store.exportText(store, savefolder.joinpath(setname + '_' + str(detect_thresh) + 'sig_lightcurves'))
+
+    '''run is saved, the checkpoint isn't needed anymore'''
+    removeCheckpoint(checkpoint)
+
+    if timer is not None:
+        report = timer.save(timingPath(savefolder, gain, detect_thresh, minutefolder), **dict(runInfo, field = field_name))
+        print(datetime.datetime.now(), 'run report:', '%.1f frames/s,' %report['frames_per_second'],
+              ', '.join('%s %.1f s' %(name, values['wall']) for name, values in report['stages'].items()))
 
     print ("\n")
 
+    return num_stars
+
 
 
 
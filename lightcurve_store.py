@@ -0,0 +1,221 @@
+''' Columnar binary store for the lightcurves of one run (minute folder) of getLightcurves.
+
+A store is a directory holding:
+    meta.json               run information (telescope, field, minute folder, first image, date)
+    stars.npy               one record per star: star number, initial x/y position, fluxCheck error code
+    <column>_<chunk>.npy    frames x stars arrays (flux, sigma, x, y), split in chunks of frames
+                            (and frames x stars x apertures flux_ap, sigma_ap in multi-aperture runs, radii in meta.json)
+    frames_<chunk>.npy      table shared by all stars: filename, unix time, JD, x/y drift of each frame
+    catalog_ids.npy         catalog id of each star once the run is registered in its field catalog (see star_catalog.py)
+
+Chunks are memory-mapped when read, so a single star or a few frames can be read without loading the run.
+exportText writes the legacy one .txt file per star format. '''
+
+import numpy as np
+import pandas as pd
+import pathlib
+import json
+import os
+
+columns = ['flux', 'sigma', 'x', 'y']
+apertureColumns = ['flux_ap', 'sigma_ap']       #only in the stores of multi-aperture runs
+
+starDtype = [('star', np.int64), ('x', np.float64), ('y', np.float64), ('error', np.int64)]
+
+errorMessages = {-1: 'empty profile', -2: 'light curve too short', -3: 'tracking failure', -4: 'SNR too low'}
+
+
+def isStore(path):
+    ''' check if a path is a lightcurve store '''
+    return pathlib.Path(path).joinpath('meta.json').is_file()
+
+def saveArray(savefile, array):
+    ''' write an array in one step, readers never see a partial file '''
+    tmpfile = savefile.with_name(savefile.stem + '.tmp.npy')
+    np.save(tmpfile, array)
+    os.replace(tmpfile, savefile)
+
+def createStore(store, stars, meta):
+    ''' create an empty store
+    input: store directory (pathlib.Path object), star table (structured array with starDtype fields),
+    run information (dict: telescope, field, minute, first_image, date_obs)
+    output: None '''
+
+    store.mkdir(parents = True, exist_ok = True)
+
+    '''remove chunks of a previous run'''
+    for old in store.glob('*_*.npy'):
+        os.remove(old)
+
+    saveArray(store.joinpath('stars.npy'), np.asarray(stars, dtype = starDtype))
+
+    with open(store.joinpath('meta.json'), 'w') as filehandle:
+        json.dump(meta, filehandle, indent = 1)
+
+def makeFrameTable(filenames, unix, jd, x_drift, y_drift):
+    ''' per frame table shared by all the stars
+    input: image filenames, unix times, julian dates, x drifts, y drifts (one value per frame)
+    output: structured array '''
+
+    filenames = [str(f) for f in filenames]
+    width = max([len(f) for f in filenames] + [1])
+
+    table = np.empty(len(filenames), dtype = [('filename', 'U%i' % width), ('time', np.float64), ('jd', np.float64),
+                                              ('x_drift', np.float64), ('y_drift', np.float64)])
+    table['filename'] = filenames
+    table['time'] = unix
+    table['jd'] = jd
+    table['x_drift'] = x_drift
+    table['y_drift'] = y_drift
+
+    return table
+
+def frameChunks(store):
+    ''' frame tables of the chunks of a store, in order (the .tmp.npy file of a save cut short by a crash isn't a chunk) '''
+
+    chunks = pathlib.Path(store).glob('frames_*.npy')
+    return sorted(chunk for chunk in chunks if chunk.stem.split('_', 1)[1].isdigit())
+
+def numChunks(store):
+    ''' number of frame chunks in a store '''
+    return len(frameChunks(store))
+
+def appendFrames(store, frames, data):
+    ''' add a chunk of frames to a store
+    input: store directory (pathlib.Path object), frame table of the chunk (from makeFrameTable),
+    frames x stars arrays of the chunk (dict with the columns as keys, the aperture columns are optional)
+    output: None '''
+
+    chunk = '%05i' % numChunks(store)
+
+    for column in columns + [column for column in apertureColumns if column in data]:
+        saveArray(store.joinpath(column + '_' + chunk + '.npy'), np.ascontiguousarray(data[column]))
+
+    #frame table written last, a chunk only counts once it exists
+    saveArray(store.joinpath('frames_' + chunk + '.npy'), frames)
+
+def saveStore(store, stars, meta, frames, data, chunk_frames = 600):
+    ''' write a whole run to a store, in chunks of chunk_frames frames
+    input: store directory (pathlib.Path object), star table, run information (dict), frame table,
+    frames x stars arrays (dict with the columns as keys), number of frames per chunk (int)
+    output: None '''
+
+    createStore(store, stars, meta)
+
+    for start in range(0, len(frames), chunk_frames):
+        appendFrames(store, frames[start:start + chunk_frames], {column: data[column][start:start + chunk_frames] for column in data})
+
+def updateErrors(store, errors):
+    ''' replace the error codes of the stars (after more frames have been added) '''
+
+    stars = getStars(store)
+    stars['error'] = errors
+    saveArray(store.joinpath('stars.npy'), stars)
+
+###############
+# Readers API #
+###############
+
+def getMeta(store):
+    ''' run information of a store (dict) '''
+
+    with open(pathlib.Path(store).joinpath('meta.json'), 'r') as filehandle:
+        return json.load(filehandle)
+
+def getStars(store):
+    ''' star table of a store: star number, initial x/y position, error code (structured array) '''
+    return np.load(pathlib.Path(store).joinpath('stars.npy'))
+
+def getFrames(store):
+    ''' frame table of a store: filename, unix time, JD, x/y drift of every frame (structured array) '''
+
+    return np.concatenate([np.load(chunk) for chunk in frameChunks(store)])
+
+def getColumn(store, column, stars = None):
+    ''' read one column for some or all stars
+    input: store directory, 'flux', 'sigma', 'x' or 'y' (or 'flux_ap', 'sigma_ap'), star numbers (int or list of int, all stars if None)
+    output: frames x stars array (1D array if a single star number is given, frames x stars x apertures for the aperture columns) '''
+
+    store = pathlib.Path(store)
+    chunks = range(numChunks(store))
+
+    if stars is not None:
+        stars = np.searchsorted(getStars(store)['star'], stars)
+
+    parts = []
+    for chunk in chunks:
+        part = np.load(store.joinpath(column + '_' + '%05i' % chunk + '.npy'), mmap_mode = 'r')
+        parts.append(part if stars is None else part[:, stars])
+
+    return np.concatenate(parts)
+
+def getMinutes(store):
+    ''' time of each frame in minutes since the first frame, as in the .txt lightcurves '''
+
+    jd = getFrames(store)['jd']
+    return (jd - jd[0])*24*60
+
+def getCoords(store, star):
+    ''' initial [x, y] position of a star '''
+
+    stars = getStars(store)
+    row = stars[np.searchsorted(stars['star'], star)]
+
+    return [row['x'], row['y']]
+
+def getLightcurveFrame(store, star):
+    ''' lightcurve of one star in the format of the .txt files
+    input: store directory, star number (int)
+    output: pandas DataFrame with columns filename, time (minutes), flux, x_drift, y_drift, sigma '''
+
+    frames = getFrames(store)
+    jd = frames['jd']
+
+    return pd.DataFrame({'filename': frames['filename'],
+                         'time': (jd - jd[0])*24*60,
+                         'flux': getColumn(store, 'flux', star),
+                         'x_drift': frames['x_drift'],
+                         'y_drift': frames['y_drift'],
+                         'sigma': getColumn(store, 'sigma', star)})
+
+##################
+# Legacy export  #
+##################
+
+def exportText(store, lightcurve_savepath):
+    ''' write the lightcurves of a store in the legacy format, one .txt file per star
+    saved file format: 'star#_minutefolder_telescope_xpos-ypos.txt'
+    input: store directory, folder to save .txt files in (pathlib.Path object)
+    output: None '''
+
+    if not lightcurve_savepath.exists():
+        lightcurve_savepath.mkdir()
+
+    meta = getMeta(store)
+    stars = getStars(store)
+    frames = getFrames(store)
+    flux = getColumn(store, 'flux')
+
+    frameMinutes = (frames['jd'] - frames['jd'][0])*24*60
+
+    for i, star in enumerate(stars):
+        error = errorMessages.get(int(star['error']), 'None')
+
+        savefile = lightcurve_savepath.joinpath('star' + str(star['star']) + "_" + str(meta['minute']) + '_' + meta['telescope'] + "_" + str(int(star['x'])) + "-" + str(int(star['y'])) + ".txt")
+
+        lines = ['#\n#\n#\n#\n',
+                 '#    First Image File: %s\n' %(meta['first_image']),
+                 '#    Star Coords: %f %f\n' %(star['x'], star['y']),
+                 '#    DATE-OBS (JD): %s\n' %(meta['date_obs']),
+                 '#    Telescope: %s\n' %(meta['telescope']),
+                 '#    Field: %s\n' %(meta['field']),
+                 '#    Error: %s\n' %(error),
+                 '#\n#\n#\n',
+                 '#filename     time      flux      x_drift     y_drift\n']
+
+        starFlux = flux[:, i]
+        for t in range(len(frames)):
+            lines.append('%s %f  %f  %f  %f\n' % (frames['filename'][t], frameMinutes[t], starFlux[t], frames['x_drift'][t], frames['y_drift'][t]))
+
+        with open(savefile, 'w') as filehandle:
+            filehandle.writelines(lines)
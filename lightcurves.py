@@ -0,0 +1,125 @@
+''' Lightcurve of one star shared by lightcurve_looker.py, relative_photometry.py and systematics.py.
+
+Columns are NumPy arrays, the derived quantities (cumulative position, unwrapped time, median, std, SNR,
+clipping mask) are computed the first time they are used and kept, so plotting a lightcurve several
+times costs a single pass over it. '''
+
+import numpy as np
+import linecache
+import lightcurve_store
+
+
+def readText(file):
+    ''' columns of a .txt lightcurve, the filename column may hold spaces so columns are counted from the end
+    input: lightcurve file (pathlib.Path object)
+    output: filenames, time, flux, x_drift, y_drift (arrays) '''
+
+    filenames, values = [], []
+    with open(file, 'r') as filehandle:
+        for line in filehandle:
+            if line.startswith('#') or not line.strip():
+                continue
+            columns = line.rsplit(None, 4)
+            filenames.append(columns[0])
+            values.append(columns[1:])
+
+    values = np.array(values, dtype = np.float64).reshape(-1, 4)
+    return np.array(filenames), values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+
+
+class Lightcurve:
+    ''' flux of one star with the time and drift of each frame '''
+
+    __slots__ = ('star', 'coords', 'filename', 'time', 'flux', 'sigma', 'x_drift', 'y_drift', 'cache')
+
+    def __init__(self, time, flux, x_drift, y_drift, coords, filename = None, sigma = None, star = None):
+        ''' input: time of each frame (minutes since the first frame, or seconds of the minute in old files),
+        flux, x and y drift of each frame (per frame shift, as saved by getLightcurves), initial [x, y] position of the star,
+        image filenames, flux errors, star number '''
+
+        self.time = np.asarray(time, dtype = np.float64)
+        self.flux = np.asarray(flux, dtype = np.float64)
+        self.x_drift = np.asarray(x_drift, dtype = np.float64)
+        self.y_drift = np.asarray(y_drift, dtype = np.float64)
+        self.coords = [float(coords[0]), float(coords[1])]
+        self.filename = filename
+        self.sigma = sigma
+        self.star = star
+        self.cache = {}
+
+    @classmethod
+    def fromText(cls, file):
+        ''' lightcurve from a .txt file named 'star#_minute_telescope_xpos-ypos.txt' '''
+
+        filenames, time, flux, x_drift, y_drift = readText(file)
+        coords = linecache.getline(str(file), 6).split(': ')[1].split()
+        star = file.name.split('star')[1].split('_')[0]
+
+        return cls(time, flux, x_drift, y_drift, coords, filenames, star = star)
+
+    @classmethod
+    def fromStore(cls, store, star):
+        ''' lightcurve of a star from a lightcurve store directory '''
+
+        frames = lightcurve_store.getFrames(store)
+
+        return cls((frames['jd'] - frames['jd'][0])*24*60, lightcurve_store.getColumn(store, 'flux', star),
+                   frames['x_drift'], frames['y_drift'], lightcurve_store.getCoords(store, star),
+                   frames['filename'], lightcurve_store.getColumn(store, 'sigma', star), str(star))
+
+    def __len__(self):
+        return len(self.flux)
+
+    def corrected(self, medianLightcurve):
+        ''' new lightcurve with the flux divided by the median lightcurve of the reference stars '''
+
+        sigma = None if self.sigma is None else self.sigma/medianLightcurve
+        return Lightcurve(self.time, self.flux/medianLightcurve, self.x_drift, self.y_drift, self.coords,
+                          self.filename, sigma, self.star)
+
+    def cached(self, name, compute):
+        ''' value of a derived quantity, computed on first use '''
+
+        if name not in self.cache:
+            self.cache[name] = compute()
+        return self.cache[name]
+
+    @property
+    def x_position(self):
+        ''' cumulative x drift since the first frame (px) '''
+        return self.cached('x_position', lambda: np.cumsum(self.x_drift))
+
+    @property
+    def y_position(self):
+        ''' cumulative y drift since the first frame (px) '''
+        return self.cached('y_position', lambda: np.cumsum(self.y_drift))
+
+    @property
+    def hours(self):
+        ''' time since the first frame with minute rollovers unwrapped (time/60, hours for times in minutes) '''
+
+        def unwrap():
+            #each time the clock goes back one minute is added to the rest of the lightcurve
+            rollovers = np.concatenate([[0], np.cumsum(np.diff(self.time) < 0)])
+            return (self.time + 60.*rollovers - self.time[0])/60
+
+        return self.cached('hours', unwrap)
+
+    @property
+    def median(self):
+        return self.cached('median', lambda: np.median(self.flux))
+
+    @property
+    def std(self):
+        return self.cached('std', lambda: np.std(self.flux))
+
+    @property
+    def SNR(self):
+        return self.cached('SNR', lambda: self.median/self.std)
+
+    @property
+    def clipped(self):
+        ''' mask of the frames whose flux is within 5 standard deviations of the median '''
+
+        threshold = 5
+        return self.cached('clipped', lambda: np.abs(self.flux - self.median) <= threshold*self.std)
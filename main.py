@@ -17,48 +17,50 @@ data_path = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/2022-06-18'
 save_path = pathlib.Path('/Users/benji/Documents/UGA/M1 PHY/StageUWO/Lightcurve_Pipeline/Test')
 
 ###Create the lightcurves from the data
-gain = 'high'
+gain = 'high' #'low', 'high' or 'dual' (both gains and a merged hdr lightcurve from one pass over .rcd files)
 telescope = 'Red'
 aperture_radius = 4 #pixels
 detection_threshold = 3 #number of sigmas above background level
 RCDfiles = False
 
 #comment the next line if the lightcurves have already been computed
-maker.getLightcurves(data_path, save_path, aperture_radius, gain, telescope, detection_threshold, RCDfiles)  #saved file format: 'star#_date_telescope_xpos-ypos.txt'
+maker.getLightcurves(data_path, save_path, aperture_radius, gain, telescope, detection_threshold, RCDfiles)  #add text_output = True for the .txt file per star format: 'star#_date_telescope_xpos-ypos.txt'
+#add bin_frames = N to photometer means of N consecutive images (aligned on the tracked drift) instead of every image
+#add apertures = [2, 3, 4, 5, 6] to also measure these radii in the same pass, then maker.selectApertures(store) keeps the best radius of each star
+#add cutout_size = 32 to save a stamp of every star in every frame, cutouts.photometry(cache, r, bkgann) then redoes the photometry without the images
+#add sep_workers = None to split the centroiding and photometry of dense fields (thousands of stars) across all the cores
+#add detect_tile = 512 to detect the stars of crowded stacks in tiles (extracted by sep_workers processes)
+#add timing = True to save a report of the time spent in each stage of the run (timing_live = 10 also prints the frames/sec every 10 s)
+#worker processes are spawned: with sep_workers other than 1, run this script's calls under if __name__ == '__main__':
 
 
-lightcurve_directory = save_path.joinpath('{}_{}sig_lightcurves'.format(gain, detection_threshold))
+lightcurve_store = save_path.joinpath('{}_{}sig_store'.format(gain, detection_threshold), data_path.name)
 
 ###Specify the target star for relative photometry. 
-# Needs to be identified by user by finding the coordinates in the image and finding the corresponding lightcurve file
+# Needs to be identified by user by finding the coordinates in the image (star positions are in the store's stars.npy)
+# Once registered in the field catalog (star_catalog.addRun(catalog, store), or reduceNight(..., catalog_folder = ...)) a star keeps its catalog id
+# in every minute and night: star_catalog.getIds(store) gives the id of each star number, star_catalog.stitch(stores, id) joins its lightcurves
 star_number = int(input('Index of target star: '))
 
-refStars = photo.findReferenceStars(star_number, str(lightcurve_directory), findradius = 200) #finds reference stars
-
-refStarfiles = []
-for lightcurve in os.listdir(lightcurve_directory): #fetches the corresponding lightcurve files
-    for i in refStars:
-        if 'star{}'.format(i) in lightcurve:
-            refStarfiles.append((i,lightcurve))
+refStars = photo.findReferenceStars(star_number, str(lightcurve_store), findradius = 200) #finds reference stars
 
 #Save lightcurves of all reference stars
 reflightcurves = save_path.joinpath('refLightcurves')
 if not reflightcurves.exists():
         reflightcurves.mkdir() 
 
-for i in refStarfiles:
-    star, file = i
-    lightcurve = looker.get_Lightcurve(lightcurve_directory.joinpath(file))
+for star in refStars:
+    lightcurve = looker.get_Lightcurve(lightcurve_store, star)
     looker.lookLightcurve('{}'.format(star), lightcurve, reflightcurves, '0')
 
 ###Create median lightcurve
-medLightcurve = photo.get_medianLightcurve(lightcurve_directory, refStars)
-
-star_analysed = [ name for name in os.listdir(lightcurve_directory) if str(star_number) in name ][0]
+medLightcurve = photo.get_medianLightcurve(lightcurve_store, refStars)
 
 ###Correct target lightcurve
-correctedLC = photo.correctLightcurve(lightcurve_directory.joinpath(star_analysed), medLightcurve)
+correctedLC = photo.correctLightcurve(lightcurve_store, medLightcurve, star_number)
 
-###Save post correction lightcurve
-looker.lookLightcurve(star_number+'_corrected', correctedLC, save_path)
+#all the stars of the field at once, each with the reference stars within findradius (frames x stars array)
+#stars, correctedFlux, numRefs = photo.correctAllStars(lightcurve_store, findradius = 200, savefile = save_path.joinpath('corrected_flux.npy'))
 
+###Save post correction lightcurve
+looker.lookLightcurve(str(star_number)+'_corrected', correctedLC, save_path)
@@ -0,0 +1,220 @@
+''' Runs getLightcurves over every minute folder of a night, spread across a pool of processes '''
+
+import lightcurve_maker as maker
+import calibration
+import lightcurve_store
+import star_catalog
+import run_timing
+import numba as nb
+import pathlib
+import datetime
+import os
+import json
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+calibrationFolders = ['Bias', 'Dark', 'Flat']
+
+#master calibration images of the current worker process, built once by initWorker
+workerCalibration = None
+
+
+def getMinuteFolders(night_folder, RCDfiles = False):
+    ''' list the minute folders of a night that hold images
+    input: night directory (pathlib.Path object), RCD or fits files (bool)
+    output: sorted list of minute folders (pathlib.Path list) '''
+
+    extension = '*.rcd' if RCDfiles else '*.fits'
+
+    minutes = [f for f in night_folder.iterdir() if f.is_dir() and f.name not in calibrationFolders]
+    minutes = [f for f in minutes if next(f.glob(extension), None) is not None]
+
+    return sorted(minutes)
+
+def initWorker(calibration_folder, gain, RCDfiles, threads):
+    ''' build the master calibration images once for this worker process
+    input: folder holding the Bias and Dark directories (pathlib.Path object), gain level ('low', 'high' or 'dual'),
+    RCD or fits files (bool), numba threads per worker (int)
+    output: None '''
+
+    global workerCalibration
+
+    #one process per core already, don't let numba oversubscribe the box
+    nb.set_num_threads(threads)
+
+    if calibration_folder is not None:
+        try:
+            workerCalibration = maker.getCalibration(calibration_folder, gain, RCDfiles)
+        except Exception:
+            #fall back on building the masters from each minute folder
+            print('could not build calibration images from', calibration_folder)
+            print(traceback.format_exc())
+            workerCalibration = None
+
+def processMinute(minute, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles, prefetch, library_folder = None, timing = False):
+    ''' get the lightcurves of one minute folder, errors are caught and reported instead of raised
+    input: minute folder (pathlib.Path object), folder to save results in (pathlib.Path object), getLightcurves parameters,
+    master calibration library to take the masters closest in time from (pathlib.Path object), save the run report of the minute (bool)
+    output: (minute folder name, status ('ok', 'no good images' or 'failed'), number of stars or error message) '''
+
+    minute_savefolder = savefolder.joinpath(minute.name)
+    if not minute_savefolder.exists():
+        minute_savefolder.mkdir()
+
+    try:
+        if library_folder is not None:
+            masters = calibration.getMasters(library_folder, minute, gain, RCDfiles)
+        else:
+            masters = workerCalibration
+
+        result = maker.getLightcurves(minute, minute_savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles,
+                                      prefetch = prefetch, calibration = masters, timing = timing)
+    except Exception:
+        return minute.name, 'failed', traceback.format_exc()
+
+    if result == -1:
+        return minute.name, 'no good images', None
+
+    return minute.name, 'ok', result
+
+def runMinutes(function, minutes, args, workers, initializer = None, initargs = (), attempts = 2):
+    ''' run function(minute, *args) on every minute in a pool of processes, a worker dying (killed for memory, crash in numba
+    or sep) doesn't stop the night: the pool is replaced and the minutes that were running in it are tried again
+    input: function returning (minute folder name, status, info), minute folders (list), other arguments of function (tuple),
+    number of worker processes, pool initializer and its arguments, number of pools a minute may be running in when they break
+    output: list of (minute folder name, status, number of stars or error message), in the order the minutes finished '''
+
+    results = []
+    queue = list(minutes)
+    tries = {minute: 0 for minute in minutes}
+
+    while queue:
+        #spawn rather than fork, the parent may already hold numba and reader threads
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn'), initializer = initializer,
+                                 initargs = initargs) as executor:
+
+            #no more minutes submitted than there are workers: the minutes lost with a broken pool are the ones that were running
+            running = {}                #future: minute folder
+            broken = False
+            while running or (queue and not broken):
+                while queue and not broken and len(running) < workers:
+                    minute = queue.pop(0)
+                    running[executor.submit(function, minute, *args)] = minute
+
+                done = wait(running, return_when = FIRST_COMPLETED)[0]
+                for future in done:
+                    minute = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        tries[minute] += 1
+                        if tries[minute] < attempts:
+                            print(datetime.datetime.now(), minute.name, 'lost with its worker, trying again')
+                            queue.insert(0, minute)
+                            continue
+                        result = (minute.name, 'failed', traceback.format_exc())
+                    except Exception:
+                        result = (minute.name, 'failed', traceback.format_exc())
+
+                    print(datetime.datetime.now(), result[0], result[1])
+                    results.append(result)
+
+    return results
+
+def catalogMinutes(results, savefolder, gain, detect_thresh, catalog_folder):
+    ''' register the stores of the minutes reduced in the catalogs of their fields (see star_catalog.py), in minute order
+    input: results of reduceNight, folder the results were saved in, gain level, star detection threshold, 
+    folder holding the field catalogs (pathlib.Path object)
+    output: None '''
+
+    sets = ['high', 'low', 'hdr'] if gain == 'dual' else [gain]
+
+    for minute, status, info in results:
+        if status != 'ok':
+            continue
+
+        stores = [maker.storePath(savefolder.joinpath(minute), setname, detect_thresh, minute) for setname in sets]
+        field = lightcurve_store.getMeta(stores[0])['field']
+        star_catalog.addRun(star_catalog.catalogPath(catalog_folder, field), stores[0], others = stores[1:])
+
+def timingMinutes(results, savefolder, gain, detect_thresh):
+    ''' add up the run reports of the minutes of a night (see run_timing.combineReports) into savefolder/<gain>_<thresh>sig_timing.json
+    input: results of reduceNight, folder the results were saved in, gain level, star detection threshold
+    output: night report (dict) '''
+
+    reports = []
+    for minute, status, info in results:
+        report = maker.timingPath(savefolder.joinpath(minute), gain, detect_thresh, minute)
+        if report.exists():
+            reports.append(run_timing.loadReport(report))
+
+    night = run_timing.combineReports(reports)
+    with open(savefolder.joinpath(gain + '_' + str(detect_thresh) + 'sig_timing.json'), 'w') as f:
+        json.dump(night, f, indent = 1)
+
+    print(datetime.datetime.now(), 'night report: %.1f frames/s per worker,' %(night['frames_per_second'] or 0),
+          ', '.join('%s %.0f%%' %(name, 100*values['fraction']) for name, values in night['stages'].items()))
+
+    return night
+
+def reduceNight(night_folder, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles = False,
+                workers = None, calibration_folder = None, prefetch = 8, library_folder = None, catalog_folder = None, timing = False):
+    ''' make lightcurves of all the minute folders of a night in parallel, results of each minute are saved
+    in their own folder inside savefolder
+    input: night directory (pathlib.Path object), folder to save results in (pathlib.Path object),
+    aperture radius [px], gain ('low', 'high' or 'dual'), telescope name (string), star detection threshold (float),
+    RCD or fits files (bool), number of worker processes (int, defaults to the number of cores),
+    folder holding the Bias and Dark directories (pathlib.Path object, defaults to the night directory),
+    number of frames to read ahead in each worker (int), 
+    master calibration library folder (pathlib.Path object), when given the masters of every calibration set are built
+    (or reused) there first and each minute uses the masters closest in time,
+    folder of the field star catalogs (pathlib.Path object), when given the minutes reduced are registered in the catalogs
+    once the night is done so every star gets the same catalog id in every minute and night,
+    save a run report of each minute and their totals for the night (bool, see run_timing.py and timingMinutes)
+    output: list of (minute folder name, status, number of stars or error message), sorted by minute '''
+
+    if calibration_folder is None:
+        calibration_folder = night_folder
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if library_folder is not None:
+        calibration.buildLibrary(calibration_folder, library_folder, gain, RCDfiles, workers)
+        calibration_folder = None       #workers don't need their own masters
+
+    minutes = getMinuteFolders(night_folder, RCDfiles)
+    print(datetime.datetime.now(), 'Reducing', len(minutes), 'minutes with', workers, 'workers')
+
+    results = runMinutes(processMinute, minutes, (savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles, prefetch, library_folder, timing),
+                         workers, initWorker, (calibration_folder, gain, RCDfiles, max(1, os.cpu_count()//workers)))
+    results.sort()
+
+    if catalog_folder is not None:
+        catalogMinutes(results, savefolder, gain, detect_thresh, catalog_folder)
+
+    if timing:
+        timingMinutes(results, savefolder, gain, detect_thresh)
+
+    ''' summary of the night '''
+    failed = [r for r in results if r[1] != 'ok']
+    print(datetime.datetime.now(), len(results) - len(failed), 'of', len(results), 'minutes reduced')
+    for minute, status, info in failed:
+        print(minute, status)
+        if info is not None:
+            print(info)
+
+    return results
+
+
+if __name__ == '__main__':
+    night_folder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/2022-06-18')
+    savefolder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/lightcurves_2022-06-18')
+
+    if not savefolder.exists():
+        savefolder.mkdir()
+
+    reduceNight(night_folder, savefolder, 4, 'high', 'Red', 3, RCDfiles = False)
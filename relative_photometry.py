@@ -7,11 +7,21 @@ import pathlib
 import linecache
 from astropy.io import fits
 import lightcurve_looker as looker
+import lightcurve_store
+import lightcurve_index
+from scipy import sparse
 
 def get_medianLightcurve(directory, stars):
     ''' Get median lightcurve of reference stars for relative photometry
-    input: location of lightcurves (pathlib.Path object), reference stars (int list)
+    input: location of lightcurves (pathlib.Path object, .txt directory or lightcurve store), reference stars (int list)
     output: median lightcurve (dict) '''
+
+    if lightcurve_store.isStore(directory):
+        #frames x stars flux of the reference stars, weighted by their median
+        flux = lightcurve_store.getColumn(directory, 'flux', sorted(stars))
+        med = np.median(flux, axis = 0)
+        medLightcurve = flux @ med/np.sum(med)
+        return medLightcurve/np.median(medLightcurve)
     
     lightcurves = []    
     coordinates = []
@@ -24,17 +34,14 @@ def get_medianLightcurve(directory, stars):
     #loop through each star
     for filename in files:
         if filename.suffix == ".txt" and filename.name.split('_')[0]!='.' and int(filename.name.split('star')[1].split('_')[0]) in stars : 
-            #make dataframe containing image name, time, and star flux value for the star
-            flux = pd.read_csv(directory.joinpath(filename), delim_whitespace = True, names = ['filename', 'time', 'flux','x_drift', 'y_drift'], comment = '#')
+            #lightcurve of the star
+            lightcurve = looker.get_Lightcurve(directory.joinpath(filename))
 
             #star X, Y coordinates
-                 #star number
-            starnum = int(filename.name.split('star')[1].split('_')[0])
-            coords = linecache.getline(str(directory.joinpath(filename)),6).split(': ')[1].split(' ')
-            coordinates.append((starnum, coords))
+            coordinates.append((int(lightcurve.star), lightcurve.coords))
 
-            med = np.median(flux['flux'])  
-            flux = flux['flux']                                 #median flux
+            med = lightcurve.median                             #median flux
+            flux = lightcurve.flux
 
             #add star 
             lightcurves.append((flux, med))
@@ -45,65 +52,41 @@ def get_medianLightcurve(directory, stars):
     medLightcurve = medLightcurve/np.median(medLightcurve)
     return medLightcurve
 
-def correctLightcurve(star, medianLightcurve):
+def correctLightcurve(star, medianLightcurve, starnum = None):
     ''' Correct the target lightcurve with a median lightcurve of reference stars
-    input: target star number (int), median lightcurve (np.array)
-    output: corrected lightcurve (python dict)'''
-
-    flux = pd.read_csv(star, delim_whitespace = True, names = ['filename', 'time', 'flux','x_drift', 'y_drift'], comment = '#')
-    x_drift = flux['x_drift']
-    y_drift = flux['y_drift']
-    #Field correctinon
-    flux['flux'] = flux['flux']/medianLightcurve
-    coords = linecache.getline(str(star),6).split(': ')[1].split(' ')
-    starnum = star.name.split('star')[1].split('_')
-    med = np.median(flux['flux'])                           #median flux
-    
-    std = np.std(flux['flux'])                              #standard deviation of flux
-    SNR = med/std                   
+    input: target lightcurve file (pathlib.Path object) or lightcurve store directory with the target star number (int), 
+    median lightcurve (np.array)
+    output: corrected lightcurve (Lightcurve object)'''
 
-    return {'flux': flux, 'coords': coords, 'median': med, 'std': std, 'SNR': SNR, 'x_drift': x_drift, 'y_drift': y_drift}
+    #Field correction
+    return looker.get_Lightcurve(star, starnum).corrected(medianLightcurve)
 
 def lookLightcurve(star, lightcurve, drift = '0'):
     ''' used to plot lightcurve against time or x/y position 
-    input: star name (string), star lightcurve (dict), 
+    input: star name (string), star lightcurve (Lightcurve object), 
     variable for abscissa axis ('0' for time , 'x' for x position, 'y' for y position) 
     output: None'''
 
     #get star info
-    med = lightcurve['median']
-    std = lightcurve['std']
-    flux = lightcurve['flux']
-    coords = lightcurve['coords']
-    SNR = lightcurve['SNR']
-    x_drift = [sum(flux['x_drift'][:i]) for i in range(len(flux['x_drift']))]
+    med = lightcurve.median
+    std = lightcurve.std
+    flux = lightcurve.flux
+    coords = lightcurve.coords
+    SNR = lightcurve.SNR
+    x_drift = lightcurve.x_position
     #x_drift_mod = [i%(7.5) for i in x_drift]
 
-    y_drift = [sum(flux['y_drift'][:i]) for i in range(len(flux['y_drift']))]
-    #fix time to account for minute rollover
-    seconds = []    #list of times since first frame
-    t0 = flux['time'][0]    #time of first frame
-    passed0 = False
+    y_drift = lightcurve.y_position
 
     ''' Time correction (in .txt files, time is between 0 and 59)'''
-    for t in flux['time']:
-
-        if t < t0:          #check if time has gone back to 0
-            t = t + 60.
-        
-        if passed0:         #check if minute has rolled over
-            while t - t0 < seconds[-1]:
-                t = t + 60.
-        
-        passed0 = True
-        
-        seconds.append((t - t0)/60)
+    seconds = lightcurve.hours
+    clipped = lightcurve.clipped
         
 #make plot
 
     fig, ax1 = plt.subplots()
     if drift == '0': #vs time
-        seconds, new_flux = clipper(seconds, np.array(flux['flux']))
+        seconds, new_flux = seconds[clipped], flux[clipped]
         ax1.scatter(seconds, new_flux)#/med -1)
         ax1.hlines(med, min(seconds), max(seconds), color = 'black', label = 'median: %i' % med)
         ax1.hlines(med + std, min(seconds), max(seconds), linestyle = '--', color = 'black', label = 'stddev: %.3f' % std)
@@ -118,7 +101,7 @@ def lookLightcurve(star, lightcurve, drift = '0'):
         plt.close()
 
     elif drift == 'x': #vs x position
-        x_drift, new_flux = clipper(x_drift, flux['flux'])
+        x_drift, new_flux = x_drift[clipped], flux[clipped]
 
         ax1.scatter(x_drift, new_flux)
 
@@ -137,7 +120,7 @@ def lookLightcurve(star, lightcurve, drift = '0'):
         plt.close()
 
     elif drift == 'y': #vs y position
-        y_drift, new_flux = clipper(y_drift, flux['flux'])
+        y_drift, new_flux = y_drift[clipped], flux[clipped]
         ax1.scatter(y_drift, new_flux)
 
         # ax1.hlines(med, min(seconds), max(seconds), color = 'black', label = 'median: %i' % med)
@@ -169,13 +152,10 @@ def clipper(x, y):
     return np.array(xClipped), np.array(yClipped)
 
 def saveLightcurve(savefile, lightcurve):
-    ''' export corrected lightcurve to .txt '''
+    ''' export corrected lightcurve (Lightcurve object) to .txt '''
 
-    
-    flux = lightcurve['flux']
-    x_drift = lightcurve['x_drift']
-    y_drift = lightcurve['y_drift']
-    coords = lightcurve['coords']
+    coords = lightcurve.coords
+    filenames = lightcurve.filename if lightcurve.filename is not None else [savefile.name]*len(lightcurve)
 
     with open(savefile, 'w') as filehandle:
             
@@ -188,45 +168,87 @@ def saveLightcurve(savefile, lightcurve):
         
       
             #loop through each frame to be saved
-            for i in range(0, len(flux['flux'])):  
-                filehandle.write('%s %f  %f  %f  %f\n' % (savefile.name(), float(flux['time'][i]), float(flux['flux'][i]), float(x_drift[i]), float(y_drift[i])))
+            for i in range(0, len(lightcurve)):  
+                filehandle.write('%s %f  %f  %f  %f\n' % (filenames[i], lightcurve.time[i], lightcurve.flux[i], lightcurve.x_drift[i], lightcurve.y_drift[i]))
 
 
-def findReferenceStars(star, directory, findradius):
+def findReferenceStars(star, directory, findradius, maxFlux = 50000, minSNR = 20):
     ''' Automatically finds the reference stars in a radius around the target
-    input: star number (int), lightcurve directory (str), radius (int)
+    input: star number (int), lightcurve directory or lightcurve store (str), radius (int), 
+    maximum flux of a reference star, minimum SNR of a reference star
     output: list of reference stars (list) '''
 
-    ''' Create a dictionary of all stars in the frame'''
-    allstars = {}
+    ''' Stars around the target from the index of the directory (built once and cached, see lightcurve_index.py) '''
+    nearby, target = lightcurve_index.starsInRadius(directory, star, findradius)
 
-    for filename in os.listdir(directory):
-        if ('star' in filename.split('_')[0] and filename.split('.')[1] == "txt"):
-            starnum = filename.split('_')[0].split('star')[1]
-            allstars['{}'.format(starnum)] = filename
+    ''' Filter stars based on maximum brightness and SNR '''
+    keep = (nearby['star'] != star) & (nearby['max'] < maxFlux) & (nearby['SNR'] > minSNR)
 
-    starfile = allstars['%i'%star]
+    return [int(i) for i in nearby['star'][keep]]
 
-    starcoords = (int(starfile.split('_')[3].split('.')[0].split('-')[0]), int(starfile.split('_')[3].split('.')[0].split('-')[1]))
 
-    refStars = []
+def getFluxMatrix(directory):
+    ''' flux of every star of a lightcurve store or .txt directory, in the order of the index table (lightcurve_index.py)
+    input: lightcurve directory or store (pathlib.Path object)
+    output: frames x stars flux (array) '''
 
-    ''' Filter stars based on distance to target star, maximum brightness and SNR '''
-    for key, filename in allstars.items():
-        coords = (int(filename.split('_')[3].split('.')[0].split('-')[0]), int(filename.split('_')[3].split('.')[0].split('-')[1])) 
+    if lightcurve_store.isStore(directory):
+        return np.asarray(lightcurve_store.getColumn(directory, 'flux'))
 
-        if coords != starcoords and (coords[0]-starcoords[0])**2+(coords[1]-starcoords[1])**2 <= findradius**2:
-            starPath = pathlib.Path(directory+'/'+filename)
-            flux = pd.read_csv(starPath, delim_whitespace = True, names = ['filename', 'time', 'flux','x_drift', 'y_drift'], comment = '#')['flux']
-            std = np.std(flux)
-            med = np.median(flux)
-            SNR = med/std
-            
-            if max(flux) < 50000 and SNR>20:
-                refStars.append(int(key))
+    lightcurves = [looker.get_Lightcurve(file) for file in lightcurve_index.lightcurveFiles(directory)]
+    lightcurves.sort(key = lambda lightcurve: int(lightcurve.star))
+
+    return np.column_stack([lightcurve.flux for lightcurve in lightcurves])
+
+def referenceWeights(directory, findradius, maxFlux = 50000, minSNR = 20):
+    ''' weights of the reference stars of every star, reference stars are the stars within findradius 
+    (the star itself excluded) below maxFlux and above minSNR, weighted by their median flux as in get_medianLightcurve
+    input: lightcurve directory or store (pathlib.Path object), radius (int), maximum flux of a reference star, minimum SNR of a reference star
+    output: stars x stars sparse matrix (column j holds the normalised weights of the reference stars of star j), 
+    number of reference stars of each star (array) '''
+
+    table, tree = lightcurve_index.getIndex(directory)
+    good = (table['max'] < maxFlux) & (table['SNR'] > minSNR)
+
+    #every pair of stars closer than findradius, each star is a reference of the other
+    pairs = tree.query_pairs(findradius, output_type = 'ndarray')
+    refs = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    targets = np.concatenate([pairs[:, 1], pairs[:, 0]])
+
+    keep = good[refs]
+    refs, targets = refs[keep], targets[keep]
+
+    weights = sparse.csc_matrix((table['median'][refs], (refs, targets)), shape = (len(table), len(table)))
+    total = np.asarray(weights.sum(axis = 0)).ravel()
+    weights = weights @ sparse.diags(np.divide(1., total, out = np.zeros(len(total)), where = total != 0))
+
+    return weights, np.bincount(targets, minlength = len(table))
+
+def correctAllStars(directory, findradius, maxFlux = 50000, minSNR = 20, savefile = None):
+    ''' Correct the lightcurves of every star at once with the median lightcurve of their own reference stars,
+    the median lightcurves of all the stars are one sparse matrix product
+    input: lightcurve directory or store (pathlib.Path object), radius (int), maximum flux of a reference star, minimum SNR of a reference star,
+    .npy file to save the corrected lightcurves in (pathlib.Path object, not saved if None)
+    output: star numbers (array), frames x stars corrected flux (array, NaN for stars without reference stars), 
+    number of reference stars of each star (array) '''
+
+    directory = pathlib.Path(directory)
+
+    table = lightcurve_index.getIndex(directory)[0]
+    weights, numRefs = referenceWeights(directory, findradius, maxFlux, minSNR)
+    flux = getFluxMatrix(directory)
+
+    #weighted sum of the reference lightcurves of each star, normalised to its median
+    medLightcurves = (weights.T @ flux.T).T
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        medLightcurves /= np.median(medLightcurves, axis = 0)
+        corrected = np.where(numRefs > 0, flux/medLightcurves, np.nan)
 
+    if savefile is not None:
+        np.save(savefile, corrected)
 
-    return refStars
+    return table['star'], corrected, numRefs
 
 
 if __name__ == '__main__':
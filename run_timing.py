@@ -0,0 +1,173 @@
+''' Per-stage timing of a getLightcurves run, used by getLightcurves(..., timing = True).
+
+A RunTimer adds up the wall time and the CPU time spent in each stage of a run (calibration, file listing, detection,
+read, decode, calibrate, wait, centroid, photometry, cutouts, checkpoint, quality, write), counts the frames, stars and
+bytes read and the fluxCheck error code of every star, and saves it all as a JSON run report.
+The CPU time of a stage is that of the thread running it: stages done by the reader threads are measured on those
+threads, work handed to other threads or processes (numba's parallel decoding, the calibration stacking and sep worker
+processes) isn't included. A stage with a wall
+time well above its CPU time is waiting on the disk (read, decode of memory mapped files) or on another thread (wait:
+time the photometry loop spent waiting for the readers, high when the run is I/O bound).
+
+The functions at the bottom take the timer of a run or None, so code paths without a timer only pay for a None check. '''
+
+import time
+import datetime
+import json
+import threading
+import contextlib
+import numpy as np
+from tqdm import tqdm
+
+
+class RunTimer:
+    ''' Wall and CPU time per stage and counters of a run, stages can be timed from several threads '''
+
+    def __init__(self, live = None):
+        ''' input: seconds between the frames/sec lines printed while frames are photometered (None for no live line) '''
+
+        self.live = live
+        self.stages = {}            #stage name: [wall time, cpu time, calls]
+        self.counts = {}            #counter name: count
+        self.errors = {}            #set name: {fluxCheck error code: number of stars}
+        self.lock = threading.Lock()
+
+        self.started = datetime.datetime.now()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.first = None                   #time and frame count of the first frame, the live rates start there
+        self.last = None                    #time and frame count of the last live line
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' time the code inside a with block as a stage, stages of the same name are added up '''
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                totals = self.stages.setdefault(name, [0., 0., 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+
+    def count(self, name, n = 1):
+        ''' add n to a counter (eg. frames, stars, bytes_read) '''
+
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def rejections(self, setname, codes):
+        ''' number of stars of a lightcurve set with each fluxCheck error code (0 for good stars)
+        input: set name, error code of every star (array) '''
+
+        values, numbers = np.unique(codes, return_counts = True)
+        self.errors[setname] = {str(int(value)): int(number) for value, number in zip(values, numbers)}
+
+    def frame(self):
+        ''' count a photometered frame, prints the live frames/sec line when it is due '''
+
+        self.count('frames')
+        if self.live is None:
+            return
+
+        now, frames = time.perf_counter(), self.counts['frames']
+        if self.first is None:
+            self.first = self.last = (now, frames)
+        elif now - self.last[0] >= self.live:
+            wait = self.stages.get('wait', [0.])[0]
+            tqdm.write('%s %.1f frames/s (%.1f since the first frame), %.0f%% of the time waiting on reads'
+                       %(datetime.datetime.now(), (frames - self.last[1])/(now - self.last[0]), 
+                         (frames - self.first[1])/(now - self.first[0]), 100.*wait/(now - self.first[0])))
+            self.last = (now, frames)
+
+    def report(self, **info):
+        ''' run report (dict): start date, wall and process CPU time of the run, frames/sec, counters, error codes of the stars
+        of each set and {wall, cpu, calls, fraction of the run wall time} of each stage, with any other information given '''
+
+        wall, cpu = time.perf_counter() - self.wall, time.process_time() - self.cpu
+        frames = self.counts.get('frames', 0)
+
+        report = dict(info)
+        report.update({'started': self.started.isoformat(), 'wall': wall, 'cpu': cpu,
+                       'frames_per_second': frames/wall if wall > 0 else None,
+                       'counts': dict(self.counts), 'errors': dict(self.errors),
+                       'stages': {name: {'wall': w, 'cpu': c, 'calls': n, 'fraction': w/wall if wall > 0 else None}
+                                  for name, (w, c, n) in self.stages.items()}})
+        return report
+
+    def save(self, filename, **info):
+        ''' write the run report (see report) as a JSON file, returns the report '''
+
+        report = self.report(**info)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent = 1)
+
+        return report
+
+
+off = contextlib.nullcontext()          #reusable do-nothing stage of runs without a timer
+end = object()                          #end of a timed iterator
+
+def stage(timer, name):
+    ''' timer.stage(name), or a do-nothing context without a timer (None) '''
+    return off if timer is None else timer.stage(name)
+
+def count(timer, name, n = 1):
+    ''' timer.count(name, n), nothing without a timer (None) '''
+    if timer is not None:
+        timer.count(name, n)
+
+def timed(iterable, timer, name):
+    ''' iterate with the time spent waiting for each item timed as a stage, the iterable itself without a timer (None) '''
+
+    if timer is None:
+        return iterable
+
+    return timedItems(iter(iterable), timer, name)
+
+def timedItems(iterator, timer, name):
+    ''' generator behind timed '''
+
+    while True:
+        with timer.stage(name):
+            item = next(iterator, end)
+        if item is end:
+            return
+        yield item
+
+def loadReport(filename):
+    ''' run report saved by RunTimer.save (dict) '''
+
+    with open(filename) as f:
+        return json.load(f)
+
+def combineReports(reports):
+    ''' totals of several run reports (eg. the minutes of a night): wall, cpu, counters, error codes and stages added up,
+    the stage fractions are of the summed run wall times
+    input: run reports (list of dicts)
+    output: report (dict) with the number of runs added '''
+
+    total = {'runs': len(reports), 'wall': 0., 'cpu': 0., 'counts': {}, 'errors': {}, 'stages': {}}
+
+    for report in reports:
+        total['wall'] += report['wall']
+        total['cpu'] += report['cpu']
+        for name, n in report['counts'].items():
+            total['counts'][name] = total['counts'].get(name, 0) + n
+        for setname, codes in report['errors'].items():
+            setcodes = total['errors'].setdefault(setname, {})
+            for code, n in codes.items():
+                setcodes[code] = setcodes.get(code, 0) + n
+        for name, values in report['stages'].items():
+            totals = total['stages'].setdefault(name, {'wall': 0., 'cpu': 0., 'calls': 0})
+            for key in totals:
+                totals[key] += values[key]
+
+    for totals in total['stages'].values():
+        totals['fraction'] = totals['wall']/total['wall'] if total['wall'] > 0 else None
+    total['frames_per_second'] = total['counts'].get('frames', 0)/total['wall'] if total['wall'] > 0 else None
+
+    return total
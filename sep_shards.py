@@ -0,0 +1,112 @@
+''' sep photometry and centroiding with the stars split across worker processes, used by getLightcurves(..., sep_workers = N)
+
+sep holds the GIL during winpos and sum_circle, so the star list is cut into contiguous shards measured in parallel
+processes instead of threads. The frame is copied once per call into a shared buffer the workers read from, the shards
+are measured on the same pixels and their results are concatenated in star order, identical to a single sep call.
+SepPool.winpos and SepPool.sum_circle take the same arguments as the sep functions, so either can be passed where
+sep is used (tracking.Tracker, timeEvolveFITS, apertureFluxes...). '''
+
+import numpy as np
+import sep
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#shared frame buffer of a worker process (bytes)
+shared = None
+
+
+def initWorker(buffer):
+    ''' keep the shared frame buffer of the pool in the worker process '''
+    global shared
+    shared = np.frombuffer(buffer, dtype = np.uint8)
+
+def sharedFrame(frame):
+    ''' view of the shared buffer as the frame of a call, frame is (dtype string, shape) '''
+    dtype, shape = frame
+    return shared[:int(np.prod(shape))*np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+
+def winposShard(frame, x, y, sigma, subpix):
+    ''' sep.winpos of a shard of stars in a worker '''
+    return sep.winpos(sharedFrame(frame), x, y, sigma, subpix = subpix)
+
+def sumCircleShard(frame, x, y, r, bkgann):
+    ''' sep.sum_circle of a shard of stars in a worker '''
+    return sep.sum_circle(sharedFrame(frame), x, y, r, bkgann = bkgann)
+
+
+class SepPool:
+    ''' Worker processes measuring shards of the star list on a frame held in shared memory.
+    Calls with fewer than 2*min_stars stars, or a single worker, go straight to sep in the calling process. '''
+
+    def __init__(self, shape, workers = None, min_stars = 500):
+        ''' input: largest frame measured ((rows, columns)), number of worker processes (defaults to the number of cores),
+        smallest number of stars worth a shard (int) '''
+
+        self.workers = os.cpu_count() if workers is None else workers
+        self.min_stars = min_stars
+        self.executor = None
+
+        if self.workers > 1:
+            context = multiprocessing.get_context('spawn')
+            buffer = context.RawArray('b', int(np.prod(shape))*8)          #room for float64 frames
+            self.frame = np.frombuffer(buffer, dtype = np.uint8)
+            self.executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = context, initializer = initWorker, initargs = (buffer,))
+
+    def shards(self, count):
+        ''' bounds of the shards of count stars, a single shard if it isn't worth splitting '''
+
+        num = 1 if self.executor is None else int(min(self.workers, count//self.min_stars))
+        if num <= 1:
+            return None
+
+        bounds = np.linspace(0, count, num + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def load(self, image):
+        ''' copy a frame into the shared buffer, returns its (dtype, shape) for the workers '''
+
+        image = np.asarray(image)
+        if image.nbytes > self.frame.nbytes:
+            raise ValueError('frame of ' + str(image.nbytes) + ' bytes larger than the shared buffer of ' + str(self.frame.nbytes) + ' bytes')
+
+        self.frame[:image.nbytes].view(image.dtype).reshape(image.shape)[...] = image
+        return (image.dtype.str, image.shape)
+
+    def run(self, function, image, columns, *args):
+        ''' measure the shards in the workers and concatenate each output array in star order
+        input: shard function, frame, per star arrays split into the shards (x, y and optionally r), other arguments of function '''
+
+        frame = self.load(image)
+        shards = self.shards(len(columns[0]))
+        futures = [self.executor.submit(function, frame, *[column[first:last] for column in columns], *args) for first, last in shards]
+
+        results = [future.result() for future in futures]
+        return tuple(np.concatenate(parts) for parts in zip(*results))
+
+    def winpos(self, data, x, y, sig, subpix = 11):
+        ''' sep.winpos over the shards of the stars '''
+
+        if self.shards(len(x)) is None:
+            return sep.winpos(data, x, y, sig, subpix = subpix)
+
+        return self.run(winposShard, data, (np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64)), sig, subpix)
+
+    def sum_circle(self, data, x, y, r, bkgann = None):
+        ''' sep.sum_circle over the shards of the stars, r is a radius or one radius per star '''
+
+        if self.shards(len(x)) is None:
+            return sep.sum_circle(data, x, y, r, bkgann = bkgann)
+
+        x, y = np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64)
+        if np.ndim(r) == 0:
+            return self.run(sumCircleShard, data, (x, y), r, bkgann)
+
+        return self.run(sumCircleShard, data, (x, y, np.broadcast_to(np.asarray(r, dtype = np.float64), x.shape)), bkgann)
+
+    def close(self):
+        ''' stop the worker processes '''
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
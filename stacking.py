@@ -0,0 +1,103 @@
+''' Out-of-core combination of image stacks.
+
+Frames are read a tile of rows at a time, the cube of one tile (frames x rows x columns) is combined and
+written into the output image, so memory is bounded by the tile size instead of the number of frames.
+Tiles are combined in parallel threads. Every tile opens every file, so tiles are kept at least min_rows tall:
+when the memory can't hold a tile that tall for each thread, fewer threads are used rather than thinner tiles. The rows are read by a function given by the caller
+(lightcurve_maker.readRowsFITS and readRowsRCD), only the rows of the tile are read from disk. '''
+
+import numpy as np
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+methods = ['median', 'mean', 'sigclip']
+
+
+def sigmaClippedMean(cube, nsigma = 3., iterations = 5):
+    ''' mean along the first axis after iteratively rejecting values further than nsigma standard deviations from the median
+    input: stack (array, combined along axis 0, modified in place), clipping level, maximum number of clipping passes
+    output: combined image (array) '''
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        for i in range(iterations):
+            med = np.nanmedian(cube, axis = 0)
+            std = np.nanstd(cube, axis = 0, dtype = np.float64)
+
+            with np.errstate(invalid = 'ignore'):
+                clipped = np.abs(cube - med) > nsigma*std
+            if not clipped.any():
+                break
+            cube[clipped] = np.nan
+
+        return np.nanmean(cube, axis = 0, dtype = np.float64)
+
+def combine(cube, method = 'median', nsigma = 3., iterations = 5):
+    ''' combine a stack along its first axis with 'median', 'mean' or 'sigclip' (sigma-clipped mean),
+    means are summed in float64 whatever the dtype of the stack '''
+
+    if method == 'median':
+        return np.median(cube, axis = 0)
+    if method == 'mean':
+        return np.mean(cube, axis = 0, dtype = np.float64)
+    if method == 'sigclip':
+        return sigmaClippedMean(cube, nsigma, iterations)
+
+    raise ValueError('unknown stacking method ' + str(method) + ', use one of ' + str(methods))
+
+def tileRows(num_frames, shape, memory, workers, dtype = np.float64, min_rows = 64):
+    ''' number of rows per tile and number of threads so that the cubes of all the threads fit in memory (bytes),
+    threads are dropped before tiles get thinner than min_rows (each tile reads every file)
+    output: rows per tile (int), threads (int) '''
+
+    rowbytes = num_frames*int(np.prod(shape[:-2]))*shape[-1]*np.dtype(dtype).itemsize
+    min_rows = min(min_rows, shape[-2])
+    workers = int(max(1, min(workers, memory//(min_rows*rowbytes))))
+
+    return int(max(1, min(shape[-2], memory//(workers*rowbytes)))), workers
+
+def stack(filenames, readRows, shape, method = 'median', offset = None, scales = None, nsigma = 3., iterations = 5,
+          memory = 2**30, workers = None, dtype = np.float64, min_rows = 64):
+    ''' combine images tile by tile
+    input: image files (list), function reading rows first to last of a file (readRows(filename, first, last) -> array with the
+    rows on axis -2), shape of an image ((rows, columns) or (planes, rows, columns)), 'median', 'mean' or 'sigclip',
+    image subtracted from every frame (eg. bias, array of shape), divisor of each frame (array of num_frames values,
+    or (num_frames, planes, 1, 1) for one per plane), sigma clipping level and passes, memory for the tile cubes (bytes),
+    number of threads (int, defaults to the number of cores), dtype of the tile cubes and of the result,
+    smallest tile height the threads are cut down for (int, see tileRows)
+    output: combined image (array of shape) '''
+
+    if method not in methods:
+        raise ValueError('unknown stacking method ' + str(method) + ', use one of ' + str(methods))
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    num_frames = len(filenames)
+    rows, workers = tileRows(num_frames, shape, memory, workers, dtype, min_rows)
+    result = np.empty(shape, dtype = dtype)
+
+    if scales is not None:
+        scales = np.asarray(scales, dtype = np.float64).reshape((num_frames,) + (-1,)*(len(shape) > 2) + (1, 1))
+
+    def combineTile(first):
+        ''' read and combine rows first to first + rows of every frame '''
+        last = min(first + rows, shape[-2])
+        cube = np.empty((num_frames,) + tuple(shape[:-2]) + (last - first, shape[-1]), dtype = dtype)
+
+        for i, filename in enumerate(filenames):
+            cube[i] = readRows(filename, first, last)
+            if offset is not None:
+                cube[i] -= offset[..., first:last, :]
+            if scales is not None:
+                cube[i] /= scales[i]
+
+        result[..., first:last, :] = combine(cube, method, nsigma, iterations)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        #list() to raise the errors of the tiles
+        list(executor.map(combineTile, range(0, shape[-2], rows)))
+
+    return result
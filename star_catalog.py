@@ -0,0 +1,173 @@
+''' Master catalog of the stars of a field, giving each star the same number in every run.
+
+Star numbers of a store are the order sep.extract found the stars in for that minute. A field catalog holds one
+record per star seen in the field (catalog id, x/y position in the frame of the first run registered, median flux,
+number of runs it was matched in). Registering a run (addRun) solves the pointing offset between the run and the
+catalog, cross-matches the stars with a KD-tree and saves the catalog id of every star of the run in its store
+(catalog_ids.npy); stars not in the catalog yet get new ids. Lightcurves of a star over many minutes and nights
+are then joined by catalog id (stitch). '''
+
+import numpy as np
+import pandas as pd
+import pathlib
+from scipy.spatial import cKDTree
+import lightcurve_store
+import lightcurve_index
+
+catalogDtype = [('id', np.int64), ('x', np.float64), ('y', np.float64), ('flux', np.float64), ('runs', np.int64)]
+
+idsName = 'catalog_ids.npy'
+
+
+def catalogPath(folder, field):
+    ''' catalog file of a field: folder/<field>_catalog.npy '''
+    return pathlib.Path(folder).joinpath(str(field) + '_catalog.npy')
+
+def loadCatalog(catalog):
+    ''' catalog table of a field (structured array with catalogDtype fields, empty if the catalog doesn't exist yet) '''
+
+    catalog = pathlib.Path(catalog)
+    if not catalog.exists():
+        return np.zeros(0, dtype = catalogDtype)
+
+    return np.load(catalog)
+
+def getIds(store):
+    ''' catalog id of each star of a registered store (array in the order of the store's star table) '''
+    return np.load(pathlib.Path(store).joinpath(idsName))
+
+def solveOffset(reference, positions, brightest = 100, bin_size = 2., radius = 3., iterations = 3, min_votes = 3):
+    ''' shift between the stars of a run and the catalog: the shifts between all pairs of bright stars vote for the
+    offset (mode of the shifts binned to bin_size), which is then refined with the median shift of the stars matched within radius
+    input: catalog positions and run positions ((N, 2) arrays, brightest first), number of bright stars voting,
+    vote bin size [px], match radius [px], number of refinement passes, fewest votes for an offset (unrelated star lists give no offset)
+    output: (dx, dy) offset to add to the run positions (array) '''
+
+    if len(reference) == 0 or len(positions) == 0:
+        return np.zeros(2)
+
+    '''vote: every pair of bright stars gives a candidate shift, the true shift is given by all the stars in common'''
+    shifts = (reference[:brightest, None, :] - positions[None, :brightest, :]).reshape(-1, 2)
+    cells, counts = np.unique(np.floor(shifts/bin_size).astype(np.int64), axis = 0, return_counts = True)
+    if counts.max() < min_votes:
+        return np.zeros(2)
+    best = cells[np.argmax(counts)]
+    inCell = np.all(np.floor(shifts/bin_size).astype(np.int64) == best, axis = 1)
+    offset = np.median(shifts[inCell], axis = 0)
+
+    '''refine on the stars matched with that offset'''
+    tree = cKDTree(reference)
+    for i in range(iterations):
+        distance, nearest = tree.query(positions + offset, distance_upper_bound = radius)
+        matched = np.isfinite(distance)
+        if not matched.any():
+            break
+        offset = offset + np.median(reference[nearest[matched]] - (positions[matched] + offset), axis = 0)
+
+    return offset
+
+def crossMatch(reference, positions, radius):
+    ''' one to one match of positions to the catalog, each catalog star goes to the closest run star within radius
+    input: catalog positions, run positions (already shifted onto the catalog) ((N, 2) arrays), match radius [px]
+    output: index of the catalog star of each run star (array, -1 if unmatched) '''
+
+    matches = np.full(len(positions), -1, dtype = np.int64)
+    if len(reference) == 0 or len(positions) == 0:
+        return matches
+
+    distance, nearest = cKDTree(reference).query(positions, distance_upper_bound = radius)
+
+    taken = np.zeros(len(reference), dtype = bool)
+    for i in np.argsort(distance, kind = 'stable'):
+        if not np.isfinite(distance[i]):
+            break
+        if not taken[nearest[i]]:
+            taken[nearest[i]] = True
+            matches[i] = nearest[i]
+
+    return matches
+
+def addRun(catalog, store, radius = 3., others = ()):
+    ''' register a run in the catalog of its field, the catalog is created by the first run
+    input: catalog file (see catalogPath), store of the run (pathlib.Path object), match radius [px],
+    other stores of the same run sharing its star table (eg. the low gain and hdr sets of a dual gain run) that also get the ids
+    output: catalog id of each star of the run (array), a store already registered keeps its ids '''
+
+    store = pathlib.Path(store)
+    if store.joinpath(idsName).exists():
+        return getIds(store)
+
+    table = loadCatalog(catalog)
+    index = lightcurve_index.getIndex(store)[0]           #sorted by star number, as the star table
+    positions = np.column_stack([index['x'], index['y']])
+    flux = np.nan_to_num(index['median'])
+
+    '''solve the pointing offset with the brightest stars, then match all the stars'''
+    reference = np.column_stack([table['x'], table['y']])
+    runOrder, catalogOrder = np.argsort(-flux, kind = 'stable'), np.argsort(-table['flux'], kind = 'stable')
+    offset = solveOffset(reference[catalogOrder], positions[runOrder], radius = radius)
+    shifted = positions + offset
+    matches = crossMatch(reference, shifted, radius)
+
+    '''matched stars update their mean position and flux, the others are new catalog stars'''
+    ids = np.empty(len(positions), dtype = np.int64)
+    matched = matches >= 0
+    rows = matches[matched]
+    runs = table['runs'][rows]
+    table['x'][rows] = (table['x'][rows]*runs + shifted[matched, 0])/(runs + 1)
+    table['y'][rows] = (table['y'][rows]*runs + shifted[matched, 1])/(runs + 1)
+    table['flux'][rows] = (table['flux'][rows]*runs + flux[matched])/(runs + 1)
+    table['runs'][rows] += 1
+    ids[matched] = table['id'][rows]
+
+    new = np.zeros(np.count_nonzero(~matched), dtype = catalogDtype)
+    new['id'] = (table['id'].max() + 1 if len(table) else 0) + np.arange(len(new))
+    new['x'], new['y'] = shifted[~matched, 0], shifted[~matched, 1]
+    new['flux'] = flux[~matched]
+    new['runs'] = 1
+    ids[~matched] = new['id']
+
+    pathlib.Path(catalog).parent.mkdir(parents = True, exist_ok = True)
+    lightcurve_store.saveArray(pathlib.Path(catalog), np.concatenate([table, new]))
+    for registered in [store, *others]:
+        lightcurve_store.saveArray(pathlib.Path(registered).joinpath(idsName), ids)
+
+    print(store, 'offset', offset, len(rows), 'stars matched,', len(new), 'new stars')
+
+    return ids
+
+def findStores(folder, setname, detect_thresh):
+    ''' stores of one set under a folder (eg. the save folder of a night or of all the nights), sorted by minute '''
+
+    stores = pathlib.Path(folder).rglob(setname + '_' + str(detect_thresh) + 'sig_store/*')
+    return sorted([store for store in stores if lightcurve_store.isStore(store)], key = lambda store: store.name)
+
+def stitch(stores, star_id, columns = ('flux', 'sigma')):
+    ''' lightcurve of one catalog star over every registered store it was found in
+    input: stores (list), catalog id (int), store columns to read
+    output: pandas DataFrame with columns minute, filename, time (unix), jd, star (star number in that minute's store)
+    and the columns read, sorted by time '''
+
+    parts = []
+    for store in stores:
+        store = pathlib.Path(store)
+        if not store.joinpath(idsName).exists():
+            continue
+
+        rows = np.nonzero(getIds(store) == star_id)[0]
+        if len(rows) == 0:
+            continue
+
+        star = int(lightcurve_store.getStars(store)['star'][rows[0]])
+        frames = lightcurve_store.getFrames(store)
+
+        part = pd.DataFrame({'minute': lightcurve_store.getMeta(store)['minute'], 'filename': frames['filename'],
+                             'time': frames['time'], 'jd': frames['jd'], 'star': star})
+        for column in columns:
+            part[column] = lightcurve_store.getColumn(store, column, star)
+        parts.append(part)
+
+    if not parts:
+        return pd.DataFrame(columns = ['minute', 'filename', 'time', 'jd', 'star', *columns])
+
+    return pd.concat(parts, ignore_index = True).sort_values('jd', kind = 'stable', ignore_index = True)
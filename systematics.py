@@ -1,5 +1,8 @@
 from copy import deepcopy
 import relative_photometry as photometry
+import lightcurve_store
+import lightcurve_index
+from lightcurves import Lightcurve
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.signal import lombscargle
@@ -13,21 +16,18 @@ import random
 import time
 import matplotlib
 from scipy.optimize import leastsq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-def getLightcurve(star):
-    ''' import lightcurve '''
+def getLightcurve(star, starnum = None):
+    ''' import lightcurve, from a .txt file or from a lightcurve store directory and star number
+    returns: lightcurve (Lightcurve object), star number (str) '''
 
-    flux = pd.read_csv(star, delim_whitespace = True, names = ['filename', 'time', 'flux','x_drift', 'y_drift'], comment = '#')
-    x_drift = flux['x_drift']
-    y_drift = flux['y_drift']
-    flux['flux'] = flux['flux']
-    coords = linecache.getline(str(star),6).split(': ')[1].split(' ')
-    starnum = star.name.split('star')[1].split('_')[0]
-    med = np.median(flux['flux'])                           #median flux
-    std = np.std(flux['flux'])                              #standard deviation of flux
-    SNR = med/std                   
-
-    return {'flux': flux, 'coords': coords, 'median': med, 'std': std, 'SNR': SNR, 'x_drift': x_drift, 'y_drift': y_drift}, starnum
+    if starnum is not None:
+        lightcurve = Lightcurve.fromStore(star, starnum)
+    else:
+        lightcurve = Lightcurve.fromText(star)
+    return lightcurve, lightcurve.star
 
 def window(data,prec):
    
@@ -48,82 +48,124 @@ def window(data,prec):
         Standard deviation of the period distribution.
    
     """
-    x = deepcopy(data)
-    #x.sort()
-   
-    x_w = np.linspace(min(x)-10,max(x)+10,prec)
-    x_window = []
-    y_window = []
+    x = np.sort(np.asarray(data, dtype = np.float64))      #samples merged in increasing order
    
-    length = len(x)
-    i = 0
-    j = 0
-    while i < prec:
-        if(j >= length or x_w[i] < x[j]):
-            x_window.append(x_w[i])
-            y_window.append(0)
-            i += 1
-        elif(x_w[i] > x[j]):
-            x_window.append(x[j])
-            y_window.append(1)
-            j += 1
-        else:
-            x_window.append(x[j])
-            y_window.append(1)
-            j += 1
-            i += 1
+    x_w = np.linspace(x[0]-10,x[-1]+10,prec)
+
+    #grid points that fall on a sample are replaced by the sample
+    x_w = x_w[~np.isin(x_w, x)]
+
+    x_window = np.concatenate([x_w, x])
+    y_window = np.concatenate([np.zeros(len(x_w)), np.ones(len(x))])
+    order = np.argsort(x_window, kind = 'stable')
     
-    return x_window, y_window
+    return x_window[order], y_window[order]
 
 
-def periodogram(lightcurve, savedir, save = True):
-    ''' Compute periodogram of lightcurve '''
+def shufflePowers(x, y, freqs, seed, count):
+    ''' Lomb-Scargle power of random permutations of the abscissa, runs in a worker process
+    input: abscissa (array), data (array), frequencies (array), seed of the random generator (np.random.SeedSequence), 
+    number of permutations (int)
+    returns: power of each permutation (count x frequencies array) '''
 
-    starnum = lightcurve[1]
-    lightcurve = lightcurve[0]
-    med = lightcurve['median']
-    std = lightcurve['std']
-    flux = lightcurve['flux']
-    coords = lightcurve['coords']
-    SNR = lightcurve['SNR']
-    x_drift = np.array([sum(lightcurve['x_drift'][:i+1]) for i in range(len(lightcurve['x_drift']))])
-    y_drift = np.array([sum(lightcurve['y_drift'][:i+1]) for i in range(len(lightcurve['y_drift']))])
-    data = flux['flux']
+    rng = np.random.default_rng(seed)
+    powers = np.empty((count, len(freqs)))
+    for i in range(count):
+        powers[i] = LombScargle(rng.permutation(x), y).power(freqs, method = 'fast', normalization = 'psd')
+
+    return powers
+
+def significance(x, y, freqs, shuffles = 1000, fap = 0.01, workers = None, batch = 50, tol = 0.01, seed = 0, check_every = 2):
+    ''' Confidence level of a periodogram from permutations of the abscissa, in a pool of processes.
+    Permutations are run in batches of batch, each with its own seed, and taken in seed order: the fap level of the highest peak is
+    checked every check_every batches and the batches left are cancelled once it changes by less than tol (relative) between two checks,
+    so the permutations used and the result are the same whatever the number of workers
+    input: abscissa (array), data (array), frequencies (array), maximum number of permutations (int), false alarm probability (float),
+    number of worker processes (int, defaults to the number of cores), permutations per batch (int), convergence tolerance (float), seed (int),
+    number of batches between convergence checks (int)
+    returns: envelope (maximum power of the permutations at each frequency), 1-fap quantile of the permutation power at each frequency,
+    peak power of each permutation (array) '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    seeds = np.random.SeedSequence(seed).spawn(-(-shuffles//batch))
+    counts = [min(batch, shuffles - i*batch) for i in range(len(seeds))]
+    minShuffles = int(np.ceil(1/fap))        #the quantile isn't defined with fewer permutations
+
+    executor, futures = None, []
+    if workers == 1:
+        batches = (shufflePowers(x, y, freqs, seeds[i], counts[i]) for i in range(len(seeds)))
+    else:
+        executor = ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn'))
+        futures = [executor.submit(shufflePowers, x, y, freqs, seeds[i], counts[i]) for i in range(len(seeds))]
+        batches = (future.result() for future in futures)
 
-    y_drift, data = clipper(x_drift, data)
+    powers = []
+    level = None
+    try:
+        for done, result in enumerate(batches, start = 1):
+            powers.append(result)
+            if done % check_every and done < len(seeds):
+                continue
 
-    data =  np.array(flux['flux'])/med - 1
+            #fap level of the highest peak, the periodogram is significant above it
+            peaks = np.concatenate(powers).max(axis = 1)
+            newLevel = np.quantile(peaks, 1 - fap)
+            converged = level is not None and len(peaks) >= minShuffles and abs(newLevel - level) < tol*newLevel
+            level = newLevel
+            if converged:
+                break
+    finally:
+        #batches past the stopping point are dropped
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait = True)
 
-    y_drift, data = clipper(y_drift, data)
+    powers = np.concatenate(powers)
 
-    yShuffle = deepcopy(y_drift)
+    return powers.max(axis = 0), np.quantile(powers, 1 - fap, axis = 0), powers.max(axis = 1)
+
+def periodogram(lightcurve, savedir, save = True, shuffles = 1000, fap = 0.01, workers = None):
+    ''' Compute periodogram of lightcurve against the y position, with the confidence level from shuffled positions
+    input: (lightcurve (Lightcurve object), star number), save directory, save (bool), 
+    maximum number of permutations, false alarm probability of the confidence level, number of worker processes
+    returns: frequencies, power, confidence level, false alarm probability of the highest peak '''
+
+    starnum = lightcurve[1]
+    lightcurve = lightcurve[0]
+    med = lightcurve.median
+
+    #normalised flux against the cumulative y position, outliers clipped
+    clipped = lightcurve.clipped
+    y_drift = lightcurve.y_position[clipped]
+    data = lightcurve.flux[clipped]/med - 1
 
     n = 50
-    duration = y_drift.ptp()
+    duration = np.ptp(y_drift)
 
     freqs = np.linspace(1/duration, n/duration, 100*n)
 
     #Data shuffling for confidence level
-    sigarray = [0 for i in data]
-    for i in range(1000):
-        #print(i)
-        random.shuffle(yShuffle)
-        periodShuffle = LombScargle(yShuffle, data).power(freqs, method = 'fast', normalization = 'psd')
-        sigarray = [max(sigarray[i], periodShuffle[i]) for i in range(len(sigarray))]
-
+    envelope, level, shufflePeaks = significance(y_drift, data, freqs, shuffles, fap, workers)
 
     x_window, y_window = window(y_drift, 10000)
     periodWindow = LombScargle(x_window, y_window).power(freqs, method = 'fast', normalization = 'psd')
     periods = LombScargle(y_drift, data).power(freqs, method = 'fast', normalization = 'psd')
+
+    #fraction of the permutations with a higher peak than the data
+    peakFAP = np.mean(shufflePeaks >= periods.max())
     
 
-    perds = [1/i for i in freqs]
+    perds = 1/freqs
     plt.plot(perds , periods, label = 'Periodogram')
-    plt.plot(perds, periodShuffle, label = 'Confidence level ')
+    plt.plot(perds, envelope, label = 'Shuffle envelope ({} permutations)'.format(len(shufflePeaks)))
+    plt.plot(perds, level, label = 'Confidence level (FAP {})'.format(fap))
     plt.plot(perds, periodWindow, label = 'Window function')
     plt.xlabel('Period (px)')
     plt.ylabel('Power (A.U.)')
-    plt.title('Periodogram of star #{}'.format(starnum))
+    plt.title('Periodogram of star #{}, peak FAP {:.3f}'.format(starnum, peakFAP))
     plt.legend()
     
     plt.yscale('log')
@@ -132,6 +174,8 @@ def periodogram(lightcurve, savedir, save = True):
     #plt.savefig('periodogram_star{}.png'.format(starnum))
     #plt.close()
 
+    return freqs, periods, level, peakFAP
+
 def clipper(x, y):
     ''' clip outlying data '''
 
@@ -159,6 +203,96 @@ def sinefit(t,y, guess_f):
     amp, freq, phase, gradient, mean = leastsq(to_minimize, guesses)[0]
     return amp, freq, phase, gradient, mean, guesses
 
+surveyDtype = [('star', np.int64), ('x', np.float64), ('y', np.float64), ('period', np.float64), ('power', np.float64), ('FAP', np.float64)]
+
+def surveyAbscissa(lightcurve, against):
+    ''' abscissa of a survey periodogram: 'time' (hours), 'x' or 'y' (cumulative position, px) '''
+    return {'time': lightcurve.hours, 'x': lightcurve.x_position, 'y': lightcurve.y_position}[against]
+
+def surveyLightcurves(directory, stars):
+    ''' lightcurves of some stars of a lightcurve store (star numbers) or .txt directory (files) '''
+
+    if lightcurve_store.isStore(directory):
+        frames = lightcurve_store.getFrames(directory)
+        coords = lightcurve_store.getStars(directory)
+        coords = coords[np.searchsorted(coords['star'], stars)]
+        flux = lightcurve_store.getColumn(directory, 'flux', stars)
+        time = (frames['jd'] - frames['jd'][0])*24*60
+
+        #columns shared by all the stars, only the flux is read per star
+        return [Lightcurve(time, flux[:, i], frames['x_drift'], frames['y_drift'], [coords['x'][i], coords['y'][i]], star = str(star))
+                for i, star in enumerate(stars)]
+
+    return [Lightcurve.fromText(file) for file in stars]
+
+def surveyBlock(directory, stars, against, freqs):
+    ''' peak of the Lomb-Scargle periodogram of a block of stars, runs in a worker process
+    input: lightcurve store or .txt directory, star numbers or files of the block, abscissa ('time', 'x' or 'y'), frequencies (array)
+    returns: survey table of the block (structured array with surveyDtype fields) '''
+
+    lightcurves = surveyLightcurves(directory, stars)
+    table = np.zeros(len(lightcurves), dtype = surveyDtype)
+    for field in ['period', 'power', 'FAP']:
+        table[field] = np.nan
+
+    for i, lightcurve in enumerate(lightcurves):
+        table[i]['star'] = int(lightcurve.star)
+        table[i]['x'], table[i]['y'] = lightcurve.coords
+
+        #stars lost or off the frame have no lightcurve
+        if lightcurve.std == 0 or not np.isfinite(lightcurve.std):
+            continue
+
+        clipped = lightcurve.clipped
+        model = LombScargle(surveyAbscissa(lightcurve, against)[clipped], lightcurve.flux[clipped]/lightcurve.median - 1)
+        power = model.power(freqs, method = 'fast')
+        peak = np.argmax(power)
+
+        table[i]['period'] = 1/freqs[peak]
+        table[i]['power'] = power[peak]
+        table[i]['FAP'] = model.false_alarm_probability(power[peak], method = 'baluev', minimum_frequency = freqs[0], maximum_frequency = freqs[-1])
+
+    return table
+
+def survey(directory, savefile = None, against = 'time', n = 50, workers = None, block = 200):
+    ''' periodogram of every star of a lightcurve store or .txt directory, on a frequency grid shared by all the stars
+    (n periods over the span of the abscissa, as in periodogram). Blocks of stars are spread across a pool of processes,
+    nothing is plotted
+    input: lightcurve store or .txt directory (pathlib.Path object), .npy file to save the table in (pathlib.Path object, not saved if None),
+    abscissa ('time' in hours, 'x' or 'y' cumulative position in px), number of frequencies per period span (int),
+    number of worker processes (int, defaults to the number of cores), stars per block (int)
+    returns: survey table, star number, initial position, peak period, peak power (standard normalisation) and its 
+    false alarm probability (structured array with surveyDtype fields, sorted by star number) '''
+
+    directory = pathlib.Path(directory)
+    if workers is None:
+        workers = os.cpu_count()
+
+    if lightcurve_store.isStore(directory):
+        stars = [int(star) for star in lightcurve_store.getStars(directory)['star']]
+    else:
+        stars = sorted(lightcurve_index.lightcurveFiles(directory))
+
+    #time and drifts are the same for all the stars of a run, the grid is set by the first one
+    duration = np.ptp(surveyAbscissa(surveyLightcurves(directory, stars[:1])[0], against))
+    freqs = np.linspace(1/duration, n/duration, 100*n)
+
+    blocks = [stars[start:start + block] for start in range(0, len(stars), block)]
+
+    if workers == 1:
+        tables = [surveyBlock(directory, stars, against, freqs) for stars in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+            tables = list(executor.map(surveyBlock, [directory]*len(blocks), blocks, [against]*len(blocks), [freqs]*len(blocks)))
+
+    table = np.concatenate(tables) if len(tables) else np.zeros(0, dtype = surveyDtype)
+    table.sort(order = 'star')
+
+    if savefile is not None:
+        np.save(savefile, table)
+
+    return table
+
 if __name__ == '__main__':   
     directory = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/lightcurves_2022-06-12')
     lightcurve = directory.joinpath(pathlib.Path('star2441_2022-06-12_Red.txt'))
@@ -170,10 +304,9 @@ if __name__ == '__main__':
 
     frequency = 2*np.pi/float(input('Period estimate? ') )#2*np.pi/8
     lightcurve = lightcurve[0]
-    flux = lightcurve['flux']
-    y_drift = np.array([sum(lightcurve['y_drift'][:i+1]) for i in range(len(lightcurve['y_drift']))])
-    data = np.array(flux['flux'])/np.mean(flux['flux'])
-    y_drift, data = clipper(y_drift, data)
+    clipped = lightcurve.clipped
+    y_drift = lightcurve.y_position[clipped]
+    data = lightcurve.flux[clipped]/np.mean(lightcurve.flux)
     amp, freq, phase, gradient, offset, guesses = sinefit(y_drift, data, frequency)
     
     print('----- Best fit: -----')
@@ -0,0 +1,77 @@
+''' Frame to frame star tracking on NumPy arrays, used by getLightcurves '''
+
+import sep
+import numpy as np
+
+
+def clippedMedianShift(shifts, nsigma = 3., iterations = 5):
+    ''' robust mean shift of the stars between two frames, sigma-clipped median of the (dx, dy) shifts
+    input: shifts of the stars ((N, 2) array), clipping level (in robust standard deviations), maximum number of clipping passes
+    output: (dx, dy) drift (array), mask of the stars kept '''
+
+    keep = np.ones(len(shifts), dtype = bool)
+    if len(shifts) == 0:
+        return np.zeros(2), keep
+
+    for i in range(iterations):
+        drift = np.median(shifts[keep], axis = 0)
+        distance = np.hypot(shifts[:, 0] - drift[0], shifts[:, 1] - drift[1])
+
+        #robust standard deviation from the median absolute deviation, floored to avoid clipping everything on perfect data
+        sigma = max(1.4826*np.median(distance[keep]), 1e-3)
+        clipped = distance <= nsigma*sigma
+
+        if not clipped.any() or (clipped == keep).all():
+            break
+        keep = clipped
+
+    return np.median(shifts[keep], axis = 0), keep
+
+
+class Tracker:
+    ''' Follows the stars from frame to frame.
+    Positions are kept as contiguous (N, 2) arrays, only the current and previous positions are stored.
+    Each frame the stars are re-centred with sep.winpos starting from the current positions, the frame drift
+    is the sigma-clipped median shift of the stars that were not lost (winpos failure or outside the frame),
+    and the new positions are the re-centred positions plus the drift (lost stars just move with the drift). '''
+
+    def __init__(self, positions, sigma, x_length, y_length, edge = 20., nsigma = 3., sep_pool = None):
+        ''' input: initial star positions ((N, 2) array), winpos gaussian sigma (float), image dimensions,
+        distance to the edge under which stars are treated as lost (pixels, as in clipCutStars), drift clipping level,
+        optional sep_shards.SepPool splitting winpos across processes '''
+
+        self.positions = np.array(positions[:, :2], dtype = np.float64, order = 'C')
+        self.spare = np.empty_like(self.positions)        #buffer reused for the next positions
+        self.sigma = sigma
+        self.x_length = x_length
+        self.y_length = y_length
+        self.edge = edge
+        self.nsigma = nsigma
+        self.sep = sep if sep_pool is None else sep_pool
+
+    @property
+    def previous(self):
+        ''' positions before the last call to track '''
+        return self.spare
+
+    def track(self, frame):
+        ''' re-centre the stars on a new frame
+        input: image data (2D array)
+        output: new star positions ((N, 2) array, overwritten two calls later), (dx, dy) frame drift (array) '''
+
+        x, y, flag = self.sep.winpos(frame, self.positions[:, 0], self.positions[:, 1], self.sigma, subpix = 5)
+
+        '''stars lost by winpos or outside the frame don't count towards the drift'''
+        found = (flag == 0) & np.isfinite(x) & np.isfinite(y)
+        found &= (x >= self.edge) & (x < self.x_length - self.edge) & (y >= self.edge) & (y < self.y_length - self.edge)
+
+        shifts = np.column_stack([x - self.positions[:, 0], y - self.positions[:, 1]])
+        drift = clippedMedianShift(shifts[found], self.nsigma)[0]
+
+        new = self.spare
+        new[:, 0] = np.where(found, x, self.positions[:, 0]) + drift[0]
+        new[:, 1] = np.where(found, y, self.positions[:, 1]) + drift[1]
+
+        self.spare, self.positions = self.positions, new
+
+        return self.positions, drift
@@ -0,0 +1,417 @@
+''' Live reduction of a night: minute folders are reduced while their images land on disk.
+
+Each minute is processed as soon as enough frames exist to detect the stars, then every new frame is
+tracked and measured as it arrives, and the lightcurves are appended to the minute's store in chunks.
+Error codes (and the merged hdr set in dual gain mode) are written once the minute is complete, that is
+when a later minute has started and all of its frames are reduced, or when no frame arrived for timeout seconds.
+New files are waited for with inotify when the inotify_simple package is installed, by polling otherwise. '''
+
+import lightcurve_maker as maker
+import lightcurve_store
+import night_reduction
+import calibration
+import tracking
+import frame_pool
+import numpy as np
+import pathlib
+import datetime
+import time
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+try:
+    from inotify_simple import INotify, flags as inotifyFlags
+except ImportError:
+    INotify = None          #polling only
+
+#frames needed before the stars can be detected (detectStars stacks images detectStart to detectStart + detectStack - 1)
+framesToDetect = maker.detectStart + maker.detectStack
+
+
+def readyFiles(folder, RCDfiles, settle):
+    ''' images of a minute folder that are completely written, in order, stops at the first one still being written
+    input: minute directory (pathlib.Path object), RCD or fits files (bool), time without modification before a file is used (s)
+    output: sorted list of image files '''
+
+    ready = []
+    now = time.time()
+    for filename in maker.getImageFiles(folder, RCDfiles):
+        try:
+            if now - os.path.getmtime(filename) < settle:
+                break
+        except FileNotFoundError:
+            break
+        ready.append(filename)
+
+    return ready
+
+
+class LiveMinute:
+    ''' incremental getLightcurves of one minute folder, fed with the images present on disk at each update '''
+
+    def __init__(self, folder, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles, calibration,
+                 chunk_frames = 600, prefetch = 8, text_output = False):
+        ''' input: minute directory (pathlib.Path object), folder to save results in (pathlib.Path object), getLightcurves parameters,
+        (bias, dark, flat) images, frames per store chunk (int), frames read ahead (int), also save .txt lightcurves (bool) '''
+
+        self.folder = folder
+        self.savefolder = savefolder
+        self.ap_r = ap_r
+        self.gain = gain
+        self.telescope = telescope
+        self.detect_thresh = detect_thresh
+        self.RCDfiles = RCDfiles
+        self.calibration = calibration
+        self.chunk_frames = chunk_frames
+        self.prefetch = prefetch
+        self.text_output = text_output
+
+        self.tracker = None
+        self.filenames = []         #frames reduced
+        self.rows = []              #photometry of each frame (from framePhotometry)
+        self.headerTimes = []
+        self.x_drifts, self.y_drifts = [], []
+        self.flushed = 0            #frames already in the stores
+        self.lastFrame = time.time()
+        self.retryAt = framesToDetect
+        self.status = None
+
+    def stores(self):
+        ''' stores written as the frames arrive, the hdr set needs the whole minute and is only written at the end '''
+        sets = ['high', 'low'] if self.gain == 'dual' else [self.gain]
+        return [(setname, maker.storePath(self.savefolder, setname, self.detect_thresh, self.folder.name)) for setname in sets]
+
+    def start(self, files):
+        ''' detect the stars and measure the first frame, returns False if the stars can't be found yet '''
+
+        bias, dark, flat = self.calibration
+        x_length, y_length = (maker.getSizeRCD(files) if self.RCDfiles else maker.getSizeFITS(files))[:2]
+
+        found = maker.detectStars(self.folder, self.savefolder, files, len(files), self.ap_r, self.gain, self.detect_thresh,
+                                  self.RCDfiles, bias, dark, flat, x_length, y_length)
+        if found is None:
+            #try again once twice as many frames are there
+            self.retryAt = 2*len(files)
+            return False
+
+        first_frame, self.positions, radii = found
+        self.size = (x_length, y_length)
+        self.saturation = 0.9*4095 - np.median(bias[1]) if self.gain == 'dual' else None
+        field_name = str(files[0].name).split('_')[0]
+
+        np.save(self.savefolder.joinpath(field_name + '_' + self.folder.name + '_' + self.gain + '_' + str(self.detect_thresh) + 'sig_pos.npy'), self.positions)
+        print(datetime.datetime.now(), self.folder.name, 'number of stars found: ', len(self.positions))
+
+        self.filenames.append(files[0])
+        self.headerTimes.append(first_frame[1])
+        self.rows.append(maker.firstFramePhotometry(first_frame, self.positions, self.ap_r, self.gain, self.saturation))
+        self.x_drifts.append(0)
+        self.y_drifts.append(0)
+
+        GaussSigma = np.mean(radii * 2. / 2.35)
+        self.tracker = tracking.Tracker(maker.refineCentroid(maker.trackingPlane(first_frame[0], self.gain), first_frame[1], self.positions, GaussSigma)[0],
+                                        GaussSigma, x_length, y_length)
+        self.pool = frame_pool.FramePool(np.shape(first_frame[0]), max(1, self.prefetch), maker.imageDtype, raw = self.RCDfiles)
+
+        '''empty stores, error codes are set when the minute is complete'''
+        self.meta = {'telescope': self.telescope, 'field': field_name, 'minute': str(self.folder.name),
+                     'first_image': str(files[0]), 'date_obs': str(first_frame[1])}
+        for setname, store in self.stores():
+            lightcurve_store.createStore(store, maker.starTable(self.positions, np.zeros((1, len(self.positions)))), dict(self.meta, gain = setname))
+
+        return True
+
+    def update(self, files):
+        ''' reduce the frames of files that haven't been reduced yet
+        input: images of the folder ready to be read (sorted list)
+        output: number of frames reduced '''
+
+        if self.tracker is None:
+            if len(files) < self.retryAt or not self.start(files):
+                return 0
+
+        new = files[len(self.filenames):]
+        if len(new) == 0:
+            return 0
+
+        bias, dark, flat = self.calibration
+        frames = maker.streamFrames(self.folder, files, len(self.filenames), len(new), bias, dark, flat, self.gain, self.RCDfiles, depth = self.prefetch,
+                                    pool = self.pool)
+        for filename, imageFile in zip(new, frames):
+            positions, drift = self.tracker.track(maker.trackingPlane(imageFile[0], self.gain))
+
+            self.filenames.append(filename)
+            self.headerTimes.append(imageFile[1])
+            self.x_drifts.append(drift[0])
+            self.y_drifts.append(drift[1])
+            self.rows.append(maker.framePhotometry(imageFile, positions, self.ap_r, self.gain, self.size[0], self.size[1], self.saturation))
+
+        self.lastFrame = time.time()
+
+        if len(self.filenames) - self.flushed >= self.chunk_frames:
+            self.flush()
+
+        return len(new)
+
+    def arrays(self, start = 0):
+        ''' frames x stars photometry arrays of the frames reduced since start, as in getLightcurves '''
+
+        data = np.stack([row[0] for row in self.rows[start:]])
+        if self.gain != 'dual':
+            return data, None, None
+
+        return data, np.stack([row[1] for row in self.rows[start:]]), np.stack([row[2] for row in self.rows[start:]])
+
+    def flush(self):
+        ''' append the frames reduced since the last flush to the stores '''
+
+        if self.flushed == len(self.filenames):
+            return
+
+        start, end = self.flushed, len(self.filenames)
+        data, data_low, saturated = self.arrays(start)
+
+        frames = lightcurve_store.makeFrameTable(self.filenames[start:end], data[:, 0, 4], maker.headerTimeJD(self.headerTimes[start:end])[:, 0],
+                                                 self.x_drifts[start:end], self.y_drifts[start:end])
+        sets = dict((setname, (fluxes, sigmas)) for setname, fluxes, sigmas in maker.lightcurveSets(data, data_low, saturated, self.gain) if setname != 'hdr')
+
+        for setname, store in self.stores():
+            fluxes, sigmas = sets[setname]
+            lightcurve_store.appendFrames(store, frames, {'flux': fluxes, 'sigma': sigmas, 'x': data[:, :, 0], 'y': data[:, :, 1]})
+
+        self.flushed = end
+
+    def finish(self):
+        ''' write the remaining frames, the error codes of the stars and the hdr set
+        output: status ('ok' or 'no good images') '''
+
+        if self.tracker is None:
+            self.status = 'no good images'
+            return self.status
+
+        self.flush()
+
+        data, data_low, saturated = self.arrays()
+        frames = lightcurve_store.makeFrameTable(self.filenames, data[:, 0, 4], maker.headerTimeJD(self.headerTimes)[:, 0], self.x_drifts, self.y_drifts)
+
+        for setname, fluxes, sigmas in maker.lightcurveSets(data, data_low, saturated, self.gain):
+            store = maker.storePath(self.savefolder, setname, self.detect_thresh, self.folder.name)
+            stars = maker.starTable(self.positions, fluxes)
+
+            if setname == 'hdr':
+                lightcurve_store.saveStore(store, stars, dict(self.meta, gain = setname), frames,
+                                           {'flux': fluxes, 'sigma': sigmas, 'x': data[:, :, 0], 'y': data[:, :, 1]})
+            else:
+                lightcurve_store.updateErrors(store, stars['error'])
+
+            if self.text_output:
+                lightcurve_store.exportText(store, self.savefolder.joinpath(setname + '_' + str(self.detect_thresh) + 'sig_lightcurves'))
+
+        self.status = 'ok'
+        return self.status
+
+
+def makeWatcher(night_folder):
+    ''' inotify watcher of a night directory, None when inotify_simple isn't installed '''
+
+    if INotify is None:
+        return None
+
+    watcher = INotify()
+    watcher.add_watch(str(night_folder), inotifyFlags.CREATE | inotifyFlags.MOVED_TO)
+    return watcher
+
+def waitForChanges(watcher, folders, watched, poll):
+    ''' wait until a file is written in the watched folders or poll seconds have passed
+    input: inotify watcher (or None to just sleep), minute folders to watch (list), folders already watched (set), time to wait (s)
+    output: None '''
+
+    if watcher is None:
+        time.sleep(poll)
+        return
+
+    for folder in folders:
+        if folder not in watched:
+            watcher.add_watch(str(folder), inotifyFlags.CREATE | inotifyFlags.CLOSE_WRITE | inotifyFlags.MOVED_TO)
+            watched.add(folder)
+
+    watcher.read(timeout = int(poll*1000))
+
+def watchNight(night_folder, savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles = True, calibration_folder = None,
+               library_folder = None, poll = 5., settle = 2., timeout = 600., chunk_frames = 600, prefetch = 8, text_output = False):
+    ''' reduce the minute folders of a night as their images are written, results of each minute are saved
+    in their own folder inside savefolder as with reduceNight
+    input: night directory (pathlib.Path object), folder to save results in (pathlib.Path object),
+    aperture radius [px], gain ('low', 'high' or 'dual'), telescope name (string), star detection threshold (float), RCD or fits files (bool),
+    folder holding the Bias and Dark directories (pathlib.Path object, defaults to the night directory),
+    master calibration library folder (pathlib.Path object, when given each minute uses the masters closest in time),
+    time between checks for new files (s), time without modification before a file is read (s),
+    time without new frames after which the night is over (s), frames per store chunk (int), frames read ahead (int),
+    also save .txt lightcurves (bool)
+    output: list of (minute folder name, status), sorted by minute '''
+
+    if calibration_folder is None:
+        calibration_folder = night_folder
+
+    if library_folder is None:
+        masters = maker.getCalibration(calibration_folder, gain, RCDfiles)
+
+    print(datetime.datetime.now(), 'Watching', night_folder, 'inotify' if INotify is not None else 'polling')
+
+    live = {}
+    results = {}
+    watcher = makeWatcher(night_folder)
+    watched = set()
+    lastChange = time.time()
+
+    try:
+        while True:
+            minutes = night_reduction.getMinuteFolders(night_folder, RCDfiles)
+
+            for i, minute in enumerate(minutes):
+                if minute.name in results:
+                    continue
+
+                if minute.name not in live:
+                    minute_savefolder = savefolder.joinpath(minute.name)
+                    if not minute_savefolder.exists():
+                        minute_savefolder.mkdir(parents = True)
+
+                    if library_folder is not None:
+                        masters = calibration.getMasters(library_folder, minute, gain, RCDfiles)
+
+                    live[minute.name] = LiveMinute(minute, minute_savefolder, ap_r, gain, telescope, detect_thresh, RCDfiles, masters,
+                                                   chunk_frames, prefetch, text_output)
+                    lastChange = time.time()
+
+                files = readyFiles(minute, RCDfiles, settle)
+                reduced = live[minute.name].update(files)
+                if reduced > 0:
+                    lastChange = time.time()
+
+                '''minute is complete once a later minute has started and all its images are reduced, or nothing came for timeout seconds'''
+                allDone = len(live[minute.name].filenames) == len(maker.getImageFiles(minute, RCDfiles))
+                later = i < len(minutes) - 1
+                idle = time.time() - live[minute.name].lastFrame > timeout
+
+                if reduced == 0 and ((later and allDone) or idle):
+                    results[minute.name] = live.pop(minute.name).finish()
+                    print(datetime.datetime.now(), minute.name, results[minute.name])
+
+            if len(live) == 0 and time.time() - lastChange > timeout:
+                break
+
+            waitForChanges(watcher, minutes, watched, poll)
+
+    except KeyboardInterrupt:
+        print('stopped, finishing the minutes in progress')
+
+    for name, minute in live.items():
+        results[name] = minute.finish()
+        print(datetime.datetime.now(), name, results[name])
+
+    return sorted(results.items())
+
+
+def compareStores(store, reference):
+    ''' check that two stores hold the same run: run information, star table, frame table and columns (whatever their chunks)
+    input: store directories (pathlib.Path objects)
+    output: None, raises AssertionError on the first difference '''
+
+    assert lightcurve_store.getMeta(store) == lightcurve_store.getMeta(reference), ('run information differs', store)
+    assert np.array_equal(lightcurve_store.getStars(store), lightcurve_store.getStars(reference)), ('star table differs', store)
+
+    frames, referenceFrames = lightcurve_store.getFrames(store), lightcurve_store.getFrames(reference)
+    assert frames.dtype == referenceFrames.dtype and len(frames) == len(referenceFrames), ('frame table differs', store)
+    for field in frames.dtype.names:
+        assert np.array_equal(frames[field], referenceFrames[field], equal_nan = frames.dtype[field].kind == 'f'), (field + ' differs', store)
+
+    for column in lightcurve_store.columns:
+        assert np.array_equal(lightcurve_store.getColumn(store, column), lightcurve_store.getColumn(reference, column), equal_nan = True), (column + ' differs', store)
+
+def copyFrames(source_minutes, night_folder, RCDfiles, batch, interval):
+    ''' write the images of source minute folders into a night folder a few at a time, as the camera would
+    input: minute folders to copy (list of pathlib.Path objects), night directory, RCD or fits files (bool),
+    images copied at a time (int), time between copies (s)
+    output: None '''
+
+    for source in source_minutes:
+        minute = night_folder.joinpath(source.name)
+        minute.mkdir()
+        files = maker.getImageFiles(source, RCDfiles)
+        for start in range(0, len(files), batch):
+            for filename in files[start:start + batch]:
+                #written under another name then renamed, the image is never seen half written
+                partial = minute.joinpath(filename.name + '.part')
+                shutil.copyfile(filename, partial)
+                os.replace(partial, minute.joinpath(filename.name))
+            time.sleep(interval)
+
+def simulateNight(workfolder, num_minutes = 2, num_frames = 40, num_stars = 30, RCDfiles = False, gain = 'high', size = 256,
+                  batch = 8, interval = 0.5, chunk_frames = 16):
+    ''' check watchNight against getLightcurves on synthetic minutes arriving on disk: the frames of each minute are copied
+    into a night folder a batch at a time while the night is watched, then every store written live is compared with
+    the store getLightcurves writes from the complete minute folder with the same masters
+    input: empty work directory (pathlib.Path object), number of minutes, frames per minute and stars, RCD or fits files (bool),
+    gain ('low', 'high' or 'dual'), size of the fits images [px], images copied at a time, time between copies (s), frames per store chunk
+    output: list of (minute folder name, status) from watchNight, raises AssertionError if a store differs '''
+
+    import benchmark            #synthetic images
+
+    workfolder = pathlib.Path(workfolder)
+    source, night_folder = workfolder.joinpath('source'), workfolder.joinpath('night')
+    live_savefolder, reference_savefolder = workfolder.joinpath('live'), workfolder.joinpath('reference')
+
+    '''synthetic minutes, the calibration images of the first one are the night's'''
+    start = datetime.datetime(2022, 7, 31, 4, 40, 41, 609000)
+    minutes = []
+    for i in range(num_minutes):
+        minute = source.joinpath((start + datetime.timedelta(minutes = i)).strftime('%Y%m%d_%H.%M.%S.%f')[:-3])
+        benchmark.makeMinute(minute, num_frames, num_stars, RCDfiles, size, seed = i)
+        minutes.append(minute)
+
+    night_folder.mkdir(parents = True)
+    for calibration in ['Bias', 'Dark']:
+        shutil.copytree(minutes[0].joinpath(calibration), night_folder.joinpath(calibration))
+
+    '''frames arrive while the night is watched'''
+    writer = threading.Thread(target = copyFrames, args = (minutes, night_folder, RCDfiles, batch, interval))
+    writer.start()
+    try:
+        results = watchNight(night_folder, live_savefolder, 4, gain, 'Red', 3, RCDfiles, poll = interval/2, settle = 0.,
+                             timeout = 10*interval + 5, chunk_frames = chunk_frames)
+    finally:
+        writer.join()
+
+    '''reference: the finished minute folders reduced in one go'''
+    masters = maker.getCalibration(night_folder, gain, RCDfiles)
+    sets = ['high', 'low', 'hdr'] if gain == 'dual' else [gain]
+    for minute in night_reduction.getMinuteFolders(night_folder, RCDfiles):
+        assert dict(results).get(minute.name) == 'ok', (minute.name, dict(results).get(minute.name))
+
+        reference_minute = reference_savefolder.joinpath(minute.name)
+        reference_minute.mkdir(parents = True)
+        maker.getLightcurves(minute, reference_minute, 4, gain, 'Red', 3, RCDfiles, calibration = masters)
+
+        for setname in sets:
+            compareStores(maker.storePath(live_savefolder.joinpath(minute.name), setname, 3, minute.name),
+                          maker.storePath(reference_minute, setname, 3, minute.name))
+
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['simulate']:
+        #python watch.py simulate: check the live reduction on synthetic frames arriving on disk
+        with tempfile.TemporaryDirectory() as workfolder:
+            print(simulateNight(workfolder))
+        print('live stores match getLightcurves')
+        sys.exit()
+
+    night_folder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/2022-06-18')
+    savefolder = pathlib.Path('/Volumes/1TB HD/Colibri_Obs/LSR J1835+3259/lightcurves_2022-06-18')
+
+    watchNight(night_folder, savefolder, 4, 'high', 'Red', 3, RCDfiles = True)